@@ -1,9 +1,6 @@
 __author__ = "Jeremy Nelson"
 
-import os
-
 from flask import Flask, request
-from werkzeug.contrib.cache import FileSystemCache
 from werkzeug.contrib.fixers import ProxyFix
 from aristotle.blueprint import aristotle
 
@@ -27,14 +24,3 @@ def dcc_404_debug(e):
 #for row in app.jinja_loader.list_templates():
 #    if row in aristotle_templates:
 #        aristotle_templates.pop(row)
-
-        
-
-cache = FileSystemCache(
-    app.config.get(
-        "CACHE_DIR", 
-        os.path.join(
-            os.path.split(
-                os.path.abspath(os.path.curdir))[0],
-                "cache")))
-
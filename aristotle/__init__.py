@@ -2,19 +2,8 @@
 front-end"""
 __author__ = "Jeremy Nelson"
 
-import os
-import requests
-import urllib.parse
-from bs4 import BeautifulSoup
 from flask import Flask, url_for, current_app
-from werkzeug.contrib.cache import FileSystemCache
 try:
-    from .search import REPO_SEARCH
+    from .search import CACHE as cache, REPO_SEARCH
 except ImportError or ValueError:
-    from search import REPO_SEARCH
-
-cache = FileSystemCache(
-    os.path.join(
-        os.path.split(
-            os.path.abspath(os.path.curdir))[0],
-                "cache"))
+    from search import CACHE as cache, REPO_SEARCH
@@ -0,0 +1,175 @@
+"""Module benchmarks the carousel_item and page_display filters against the
+BeautifulSoup implementations they replaced, checking both render the
+same markup and reporting the per-page cost of each"""
+__author__ = "Jeremy Nelson"
+
+import random
+import time
+
+import click
+from bs4 import BeautifulSoup
+from flask import Flask, url_for
+
+from .blueprint import aristotle
+from .filters import build_pagination_button, generate_carousel_item
+
+TITLES = ["Pikes Peak from the Garden of the Gods", "Thin section & notes",
+          "<Untitled>", "Gypsy Ames \"Lecture\"", "Colorado College's Quad",
+          "  Cutler Hall  ", "Shove Chapel\nInterior"]
+
+
+def bs4_carousel_item(hit, count):
+    """Previous carousel_item filter, kept to check and time against"""
+    result = hit.get("_source")
+    carousel = BeautifulSoup()
+    item_attrs = {"class": "carousel-item"}
+    if int(count) < 1:
+        item_attrs["class"] += " active"
+    div = carousel.new_tag("div", **item_attrs)
+    repo_link = carousel.new_tag(
+        "a",
+        **{"href": url_for("aristotle.fedora_object",
+                           identifier="pid",
+                           value=result.get("pid"))})
+    if "islandora:compoundCModel" in result.get("content_models"):
+        for stream in result.get("datastreams"):
+            if stream.get("dsid").startswith("OBJ") and \
+               stream.get("order").startswith('1'):
+                src = url_for("aristotle.fedora_datastream",
+                              pid=stream.get("pid"),
+                              dsid="OBJ",
+                              ext="jpg")
+                break
+    else:
+        src = url_for("aristotle.fedora_datastream",
+            pid=result.get("pid"),
+            dsid="OBJ",
+            ext="jpg")
+    img = carousel.new_tag("img", **{"class": "d-block img-fluid mt-2",
+                                     "style": "height: 450px",
+                                     "src": src,
+                                     "alt": "{} slide".format(count)})
+    repo_link.append(img)
+    div.append(repo_link)
+    title = carousel.new_tag(
+        "div",
+        **{"class": "carousel-caption d-none d-md-block"})
+    h5 = carousel.new_tag("h5")
+    h5.string = result.get("titlePrincipal")
+    title.append(h5)
+    div.append(title)
+    return div.prettify()
+
+def bs4_page_display(number, offset, size, query, current_position,
+                     total_length):
+    """Previous page_display filter, kept to check and time against"""
+    snippet = BeautifulSoup()
+    li = snippet.new_tag("li", **{"class": "page-item"})
+    anchor = snippet.new_tag("a", **{"class": "page-link"})
+    anchor.string = "{:,}".format(number)
+    offset = int(offset)
+    if offset == number:
+        li.attrs["class"].append("active")
+    anchor.attrs["href"] = url_for("aristotle.fedora_object",
+                                   identifier="pid",
+                                   value=query) + "?offset={}".format(number)
+    if number == 0:
+        anchor.string = "1"
+    if total_length >= 10:
+        lower_bound = (offset - 3*size)
+        upper_bound = (offset + 3*size)
+        if (lower_bound > 0 and lower_bound == number) or \
+           (upper_bound == number and current_position+1 != total_length):
+            li.attrs["class"].append("disabled")
+            anchor.attrs["href"] = "#"
+            anchor.string = "..."
+    li.insert(0, anchor)
+    return str(li)
+
+def fixture_page(carousel_size, seed=42):
+    """Function returns the carousel hits and pagination calls for one
+    rendered results page
+
+    Args:
+        carousel_size -- Number of carousel hits
+        seed -- Random seed so runs are comparable
+    """
+    rand = random.Random(seed)
+    hits = []
+    for i in range(carousel_size):
+        pid = "coccc:{}".format(rand.randint(1, 99999))
+        source = {"pid": pid,
+                  "titlePrincipal": rand.choice(TITLES),
+                  "content_models": ["islandora:sp_basic_image"]}
+        if i % 3 == 0:
+            source["content_models"] = ["islandora:compoundCModel"]
+            source["datastreams"] = [
+                {"dsid": "OBJ",
+                 "pid": "coccc:{}".format(rand.randint(1, 99999)),
+                 "order": str(order)}
+                for order in range(3, 0, -1)]
+        hits.append({"_source": source})
+    size, total = 25, 60
+    offset = size * rand.randint(0, total - 1)
+    buttons = [(number*size, offset, size, "coccc:{}".format(i), number, total)
+               for i, number in enumerate(range(total))]
+    return hits, buttons
+
+def render_page(carousel_filter, page_filter, hits, buttons):
+    output = [carousel_filter(hit, count) for count, hit in enumerate(hits)]
+    output.extend(page_filter(*args) for args in buttons)
+    return output
+
+def run(carousel_filter, page_filter, hits, buttons, pages, rounds=3):
+    """Function renders pages results pages rounds times and returns the
+    best per-page time in milliseconds
+
+    Args:
+        carousel_filter -- carousel_item implementation
+        page_filter -- page_display implementation
+        hits -- Carousel hits for a page
+        buttons -- page_display arguments for a page
+        pages -- Pages rendered per round
+        rounds -- Timed rounds, the fastest is reported
+    """
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        for j in range(pages):
+            render_page(carousel_filter, page_filter, hits, buttons)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best / pages * 1000
+
+
+@click.command()
+@click.option("--pages", default=200, help="Pages rendered per round")
+@click.option("--carousel", default=10, help="Carousel items per page")
+@click.option("--rounds", default=3)
+def main(pages, carousel, rounds):
+    app = Flask(__name__)
+    app.register_blueprint(aristotle)
+    hits, buttons = fixture_page(carousel)
+    with app.test_request_context():
+        before = render_page(bs4_carousel_item, bs4_page_display, hits,
+                             buttons)
+        after = render_page(generate_carousel_item, build_pagination_button,
+                            hits, buttons)
+        for old, new in zip(before, after):
+            if old != new:
+                raise click.ClickException(
+                    "Output differs\n{!r}\n{!r}".format(old, new))
+        click.echo("{} carousel items and {} page buttons per page, "
+                   "output identical".format(len(hits), len(buttons)))
+        bs4_ms = run(bs4_carousel_item, bs4_page_display, hits, buttons,
+                     pages, rounds)
+        template_ms = run(generate_carousel_item, build_pagination_button,
+                          hits, buttons, pages, rounds)
+    click.echo("BeautifulSoup: {:.3f} ms/page".format(bs4_ms))
+    click.echo("Templates: {:.3f} ms/page, {:.1f}x faster".format(
+        template_ms, bs4_ms / template_ms))
+
+
+if __name__ == "__main__":
+    main()
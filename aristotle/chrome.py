@@ -0,0 +1,218 @@
+"""Module keeps the library chrome fragments (tabs, scripts and styles)
+scraped from the CC Library homepage fresh from a background thread.
+Filters only ever read what is already cached, stale or not, and fall
+back to the snapshots bundled in templates/chrome when nothing has been
+scraped yet, so no request waits on the homepage."""
+__author__ = "Jeremy Nelson"
+
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+from bs4 import BeautifulSoup
+
+from . import cache
+
+FRAGMENTS = ["tabs", "scripts", "styles"]
+# Keys in the cache's chrome namespace, the fragments are stored together
+# so workers never see tabs from one scrape and styles from another
+CACHE_KEY = "fragments"
+LEASE_KEY = "refresh-lease"
+SNAPSHOT_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "templates",
+    "chrome")
+
+__chromes__ = dict()
+__chromes_lock__ = threading.Lock()
+
+
+def scrape(url, tabs_selector, timeout=10):
+    """Function fetches the library homepage and returns a dict of the
+    tabs, scripts and styles fragments with absolute URLs, raises
+    ValueError if the page no longer has the tabs
+
+    Args:
+        url -- Library homepage URL
+        tabs_selector -- CSS selector for the tabs element
+        timeout -- Seconds before the request is abandoned
+    """
+    result = requests.get(url, timeout=timeout)
+    result.raise_for_status()
+    soup = BeautifulSoup(result.text, "html.parser")
+    for tag, attribute in [("a", "href"),
+                           ("link", "href"),
+                           ("script", "src"),
+                           ("img", "src")]:
+        for element in soup.find_all(tag):
+            if element.get(attribute):
+                element[attribute] = urllib.parse.urljoin(
+                    result.url,
+                    element[attribute])
+    tabs = soup.select_one(tabs_selector)
+    if tabs is None:
+        raise ValueError("{} not found in {}".format(tabs_selector, url))
+    styles = soup.find_all("link", rel="stylesheet") + soup.find_all("style")
+    scripts = [script for script in soup.find_all("script")
+               if script.get("src")]
+    return {"tabs": str(tabs),
+            "scripts": "\n".join(str(script) for script in scripts),
+            "styles": "\n".join(str(style) for style in styles)}
+
+
+class ChromeFragments(object):
+    """Class serves the chrome fragments stale-while-revalidate. Fragments
+    live in the shared cache for every worker, each process keeps its own
+    copy and rereads the shared cache every check seconds. Once the copy
+    is older than refresh seconds a single background refresh is started,
+    in-process with a lock and across processes with a lease in the
+    shared cache.
+
+    Args:
+        url -- Library homepage URL
+        tabs_selector -- CSS selector for the tabs element
+        refresh -- Seconds before fragments are refreshed, default is 1 hour
+        retry -- Seconds before a failed refresh is tried again
+        timeout -- Seconds before the homepage request is abandoned
+        check -- Seconds between reads of the shared cache
+        lease -- Seconds a worker holds the refresh lease
+    """
+
+    def __init__(self, url, tabs_selector, refresh=3600, retry=300,
+                 timeout=10, check=30, lease=120):
+        self.url = url
+        self.tabs_selector = tabs_selector
+        self.refresh = refresh
+        self.retry = retry
+        self.timeout = timeout
+        self.check = check
+        self.lease = lease
+        self.fragments = None
+        self.fetched = 0
+        self.checked = 0
+        self.next_attempt = 0
+        self.refreshing = threading.Lock()
+        self.snapshots = dict()
+        self.thread = None
+
+    def __reload__(self):
+        """Picks up fragments another worker scraped"""
+        self.checked = time.time()
+        shared = cache.get("chrome", CACHE_KEY)
+        if shared is not None and shared.get("fetched", 0) > self.fetched:
+            self.fragments = shared.get("fragments")
+            self.fetched = shared.get("fetched")
+
+    def __snapshot__(self, name):
+        if name not in self.snapshots:
+            path = os.path.join(SNAPSHOT_DIR, "{}.html".format(name))
+            with open(path) as fo:
+                self.snapshots[name] = fo.read()
+        return self.snapshots[name]
+
+    def __stale__(self):
+        now = time.time()
+        return self.fetched + self.refresh < now and self.next_attempt < now
+
+    def __refresh_thread__(self):
+        try:
+            self.update()
+        finally:
+            self.refreshing.release()
+
+    def __schedule__(self):
+        while True:
+            # Jitter keeps workers started together from all waking at once
+            time.sleep(self.check * random.uniform(0.5, 1.5))
+            self.__reload__()
+            if self.__stale__() and self.refreshing.acquire(blocking=False):
+                self.__refresh_thread__()
+
+    def get(self, name):
+        """Method returns a fragment without blocking, starting a
+        background refresh if it is stale
+
+        Args:
+            name -- tabs, scripts or styles
+        """
+        if self.checked + self.check < time.time():
+            self.__reload__()
+        if self.__stale__():
+            self.revalidate()
+        if self.fragments is None or not self.fragments.get(name):
+            return self.__snapshot__(name)
+        return self.fragments.get(name)
+
+    def revalidate(self):
+        """Method starts a background refresh unless one is running in
+        this process"""
+        if not self.refreshing.acquire(blocking=False):
+            return
+        threading.Thread(
+            target=self.__refresh_thread__,
+            name="chrome-refresh",
+            daemon=True).start()
+
+    def start(self):
+        """Method starts the scheduler thread that refreshes the fragments
+        when no requests are coming in"""
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(
+            target=self.__schedule__,
+            name="chrome-schedule",
+            daemon=True)
+        self.thread.start()
+        self.revalidate()
+
+    def update(self):
+        """Method scrapes the homepage and saves the fragments for every
+        worker, returns False if another worker holds the lease or the
+        scrape failed. Failures keep the current fragments until the
+        retry interval has passed."""
+        self.next_attempt = time.time() + self.retry
+        if not cache.add("chrome", LEASE_KEY, os.getpid(), ttl=self.lease):
+            return False
+        try:
+            fragments = scrape(self.url, self.tabs_selector, self.timeout)
+        except (requests.RequestException, ValueError) as error:
+            print("Chrome refresh from {} failed {}".format(self.url, error))
+            return False
+        finally:
+            cache.delete("chrome", LEASE_KEY)
+        self.fragments = fragments
+        self.fetched = time.time()
+        cache.set("chrome",
+                  CACHE_KEY,
+                  {"fragments": fragments, "fetched": self.fetched})
+        return True
+
+
+def get_chrome(config):
+    """Function returns this process's ChromeFragments for a Flask config,
+    starting its scheduler on first use. Instances are keyed by pid so a
+    uWSGI worker never reuses the master's, whose threads didn't survive
+    the fork.
+
+    Args:
+        config -- Flask config
+    """
+    url = config.get("CHROME_URL", "https://www.coloradocollege.edu/library/")
+    key = (os.getpid(), url)
+    with __chromes_lock__:
+        chrome = __chromes__.get(key)
+        if chrome is None:
+            chrome = __chromes__[key] = ChromeFragments(
+                url,
+                config.get("CHROME_TABS_SELECTOR", "ul.nav"),
+                refresh=config.get("CHROME_REFRESH", 3600),
+                retry=config.get("CHROME_RETRY", 300),
+                timeout=config.get("CHROME_TIMEOUT", 10),
+                check=config.get("CHROME_CHECK", 30),
+                lease=config.get("CHROME_LEASE", 120))
+            if config.get("CHROME_SCHEDULE", True):
+                chrome.start()
+    return chrome
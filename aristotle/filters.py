@@ -4,12 +4,45 @@ import re
 
 import click
 
-from bs4 import BeautifulSoup
-from flask import url_for
+from flask import current_app, url_for
 from .blueprint import aristotle
+from .chrome import get_chrome
 import search
 
 
+# Carousel and pagination markup is formatted from these templates instead
+# of built as a BeautifulSoup tree on every call. Output is byte-for-byte
+# what BeautifulSoup's prettify() and str() produced, aristotle/benchmark.py
+# checks and times both
+CAROUSEL_ITEM_TEMPLATE = """<div class="{item_class}">
+ <a href={href}>
+  <img alt={alt} class="d-block img-fluid mt-2" src={src} style="height: 450px"/>
+ </a>
+ <div class="carousel-caption d-none d-md-block">
+  <h5>
+{title}  </h5>
+ </div>
+</div>
+"""
+
+PAGE_ITEM_TEMPLATE = """<li class="{item_class}"><a class="page-link" href={href}>{text}</a></li>"""
+
+
+def __escape__(value):
+    """Escapes &, < and > the same as BeautifulSoup's minimal formatter"""
+    return str(value).replace("&", "&amp;").replace(
+        "<", "&lt;").replace(">", "&gt;")
+
+def __attribute__(value):
+    """Returns a quoted attribute value, single quoted when the value has
+    a double quote, the same as BeautifulSoup"""
+    value = __escape__(value)
+    if '"' in value:
+        if "'" in value:
+            return '"{}"'.format(value.replace('"', "&quot;"))
+        return "'{}'".format(value)
+    return '"{}"'.format(value)
+
 @aristotle.app_template_filter('carousel_item')
 def generate_carousel_item(hit, count):
     """Filter takes an Elasticsearch hit and generates a bootstrap carousel 
@@ -19,16 +52,10 @@ def generate_carousel_item(hit, count):
         hits(list): A list of Elastic search hits
     """
     result = hit.get("_source")
-    carousel = BeautifulSoup()
-    item_attrs = { "class": "carousel-item"}
+    item_class = "carousel-item"
     if int(count) < 1:
-        item_attrs["class"] += " active"   
-    div = carousel.new_tag("div", **item_attrs)
-    repo_link = carousel.new_tag(
-        "a", 
-        **{"href": url_for("aristotle.fedora_object", 
-                           identifier="pid", 
-                           value=result.get("pid"))})
+        item_class += " active"
+    src = None
     if "islandora:compoundCModel" in result.get("content_models"):
         for stream in result.get("datastreams"):
             if stream.get("dsid").startswith("OBJ") and \
@@ -38,27 +65,23 @@ def generate_carousel_item(hit, count):
                               dsid="OBJ",
                               ext="jpg")
                 break
-    else:
+    if src is None:
         src = url_for("aristotle.fedora_datastream",
             pid=result.get("pid"),
             dsid="OBJ",
             ext="jpg")
-    img_attrs = {"class": "d-block img-fluid mt-2",
-                 "style": "height: 450px", 
-                 "src": src,
-                 "alt": "{} slide".format(count)}
-
-    img = carousel.new_tag("img", **img_attrs)
-    repo_link.append(img)
-    div.append(repo_link)
-    title = carousel.new_tag(
-        "div",
-        **{"class": "carousel-caption d-none d-md-block"})
-    h5 = carousel.new_tag("h5")
-    h5.string = result.get("titlePrincipal")
-    title.append(h5)
-    div.append(title)
-    return div.prettify()
+    # prettify() puts the stripped title on its own line, or no line at all
+    title = __escape__(result.get("titlePrincipal") or "").strip()
+    if len(title) > 0:
+        title = "   {}\n".format(title)
+    return CAROUSEL_ITEM_TEMPLATE.format(
+        item_class=item_class,
+        href=__attribute__(url_for("aristotle.fedora_object",
+                                   identifier="pid",
+                                   value=result.get("pid"))),
+        alt=__attribute__("{} slide".format(count)),
+        src=__attribute__(src),
+        title=title)
         
 
 @aristotle.app_template_filter('icon')
@@ -91,56 +114,38 @@ def get_icon(datastream):
 
 @aristotle.app_template_filter('page_display')
 def build_pagination_button(number, offset, size, query, current_position, total_length):
-    snippet = BeautifulSoup()
-    li = snippet.new_tag("li", **{"class":"page-item"})
-    anchor = snippet.new_tag("a", **{"class": "page-link"})
-    anchor.string = "{:,}".format(number)
+    item_class = "page-item"
+    text = "{:,}".format(number)
     offset = int(offset)
-    
     if offset == number:
-        li.attrs["class"].append("active")
-    anchor.attrs["href"] = url_for("aristotle.fedora_object",
-                                     identifier="pid",
-                                     value=query) + "?offset={}".format(number)
+        item_class += " active"
+    href = url_for("aristotle.fedora_object",
+                   identifier="pid",
+                   value=query) + "?offset={}".format(number)
     if number == 0:
-        anchor.string = "1"
+        text = "1"
     if total_length >= 10:
         lower_bound = (offset - 3*size)
         upper_bound = (offset + 3*size)
         if (lower_bound > 0 and lower_bound == number) or \
            (upper_bound == number and current_position+1 != total_length):
-            li.attrs["class"].append("disabled")
-            anchor.attrs["href"] = "#"
-            anchor.string= "..."
-        elif (lower_bound - size) == number or offset == number or (upper_bound - size) == number :
-            print((lower_bound - size), number)
-
-            pass
-        #else:
-            #return ""
-        #return ""   
-        #if not (total_length - current_position) == 1 and \
-        #   not number == current_position and \
-        #   not offset-number == size and \
-        #   not offset-number == -size:
-        #    return "" 
-        #elif (offset-number) == size*2 or (offset-number) == -(size*2):
-        
-    li.insert(0, anchor)
-  
-    return str(li)
+            item_class += " disabled"
+            href = "#"
+            text = "..."
+    return PAGE_ITEM_TEMPLATE.format(
+        item_class=item_class,
+        href=__attribute__(href),
+        text=__escape__(text))
 
-            
-            
-    
 
 @aristotle.app_template_filter('scripts')
 def get_scripts(s):
-    scripts = cache.get('scripts')
-    if scripts:
-        return scripts
-    harvest()
-    return cache.get('scripts')
+    """Filter returns CC Library's homepage scripts
+
+    Args:
+        s -- Ignored string to call from template
+    """
+    return get_chrome(current_app.config).get('scripts')
 
 @aristotle.app_template_filter('slugify')
 def slugify(value):
@@ -173,24 +178,22 @@ def sort_datastreams(datastreams):
 
 @aristotle.app_template_filter('styles')
 def get_styles(s):
-    styles = cache.get('styles')
-    if styles:
-        return styles
-    harvest()
-    return cache.get('styles')
+    """Filter returns CC Library's homepage styles
+
+    Args:
+        s -- Ignored string to call from template
+    """
+    return get_chrome(current_app.config).get('styles')
 
 @aristotle.app_template_filter('tabs')
 def get_tabs(s):
-    """Filter retrieves or harvests CC Library's homepage tabs
+    """Filter returns CC Library's homepage tabs, refreshed in the
+    background by aristotle/chrome.py
   
     Args:
         s -- Ignored string to call from template
     """
-    tabs = cache.get('tabs')
-    if tabs:
-        return tabs
-    harvest()
-    return cache.get('tabs')
+    return get_chrome(current_app.config).get('tabs')
 
 
 @aristotle.app_template_filter('title_principal')
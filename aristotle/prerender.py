@@ -0,0 +1,318 @@
+"""Module pre-renders the landing page and every collection browse and
+object detail page to a static directory that nginx serves before
+falling back to Flask. A manifest records each pid's pages and ancestors
+so after search/poll.py reindexes objects only their pages and their
+collections' pages are rendered again.
+
+Pages are written as
+    index.html -- Landing page, /
+    pid/<pid>/index.html -- /pid/<pid> and /pid/<pid>?offset=0
+    pid/<pid>/offset-<n>.html -- /pid/<pid>?offset=<n>
+"""
+__author__ = "Jeremy Nelson"
+
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from elasticsearch_dsl import Search
+
+from search import CONF, REPO_SEARCH, browse_page, get_generation
+
+MANIFEST = "manifest.json"
+# Elasticsearch's default max_result_window, deeper pages use cursors
+MAX_OFFSET = 10000
+
+
+def page_path(output, pid=None, offset=0):
+    """Function returns the file for a page, the landing page if pid is
+    None
+
+    Args:
+        output -- Pre-render directory
+        pid -- PID of Fedora Object
+        offset -- Browse offset
+    """
+    if pid is None:
+        return os.path.join(output, "index.html")
+    name = "index.html"
+    if int(offset) > 0:
+        name = "offset-{}.html".format(int(offset))
+    return os.path.join(output, "pid", pid, name)
+
+def read_queue(path):
+    """Function takes the pids search/poll.py queued for pre-rendering,
+    renaming the queue first so pids queued meanwhile wait for the next
+    run
+
+    Args:
+        path -- PRERENDER_QUEUE file
+    """
+    if path is None or not os.path.exists(path):
+        return []
+    working = "{}.{}".format(path, os.getpid())
+    os.replace(path, working)
+    with open(working) as fo:
+        pids = [line.strip() for line in fo if len(line.strip()) > 0]
+    os.remove(working)
+    return sorted(set(pids))
+
+def queue_pids(path, pids):
+    """Function appends pids to the pre-render queue, the same format
+    search/poll.py writes
+
+    Args:
+        path -- PRERENDER_QUEUE file
+        pids -- List of PIDs
+    """
+    with open(path, "a") as fo:
+        for pid in pids:
+            fo.write("{}\n".format(pid))
+
+
+class Prerenderer(object):
+    """Class renders pages through the Flask app's own views so the static
+    files are exactly what Flask would send
+
+    Args:
+        app -- Flask app
+        output -- Pre-render directory
+        workers -- Threads rendering pids, default is 4
+    """
+
+    def __init__(self, app, output, workers=4):
+        self.app = app
+        self.output = output
+        self.workers = workers
+        self.size = int(app.config.get("SIZE", 25))
+        self.root = app.config.get("INITIAL_PID")
+        self.lock = threading.Lock()
+        self.rendered = 0
+        self.started = None
+        self.manifest = {"pages": dict()}
+        path = os.path.join(output, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as fo:
+                self.manifest = json.load(fo)
+
+    def __write__(self, path, content):
+        """Writes to a temp file then renames so nginx never serves a
+        partial page"""
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, "wb") as fo:
+            fo.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+    def __render__(self, url, path):
+        with self.app.test_client() as client:
+            response = client.get(url, headers={"Accept": "text/html"})
+        if response.status_code != 200:
+            raise ValueError("{} returned {}".format(url,
+                                                     response.status_code))
+        self.__write__(path, response.get_data())
+        with self.lock:
+            self.rendered += 1
+
+    def __children__(self, pid):
+        search = Search(using=REPO_SEARCH, index="repository") \
+            .filter("term", **{"parent.keyword": pid}) \
+            .source(["pid"])
+        return [hit.pid for hit in search.scan()]
+
+    def __remove__(self, pid):
+        with self.lock:
+            entry = self.manifest["pages"].pop(pid, None)
+        if entry is None:
+            return
+        for offset in entry.get("offsets", []):
+            path = page_path(self.output, pid, offset)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def render_landing(self):
+        """Method renders the landing page"""
+        self.__render__("/", page_path(self.output))
+
+    def render_pid(self, pid):
+        """Method renders every page of a pid, removing pages for offsets
+        it no longer has, and returns its child pids. A pid no longer in
+        the index has its pages removed."""
+        page = browse_page(pid, size=self.size)
+        info = page.info
+        if len(info) < 1:
+            self.__remove__(pid)
+            return []
+        total = page.results['hits']['total']
+        if total < 1:
+            offsets = [0]
+        else:
+            offsets = list(range(0, min(total, MAX_OFFSET), self.size))
+        old = self.manifest["pages"].get(pid, dict())
+        for offset in set(old.get("offsets", [])) - set(offsets):
+            path = page_path(self.output, pid, offset)
+            if os.path.exists(path):
+                os.remove(path)
+        url = "/pid/{}".format(pid)
+        for offset in offsets:
+            self.__render__(
+                url if offset == 0 else "{}?offset={}".format(url, offset),
+                page_path(self.output, pid, offset))
+        children = self.__children__(pid) if total > 0 else []
+        ancestors = list(info.get("inCollections", []))
+        if info.get("parent") and info.get("parent") not in ancestors:
+            ancestors.append(info.get("parent"))
+        with self.lock:
+            self.manifest["pages"][pid] = {
+                "offsets": offsets,
+                "ancestors": ancestors,
+                "children": len(children),
+                "rendered": datetime.datetime.utcnow().isoformat()}
+        return children
+
+    def __render_all__(self, pids, recurse):
+        seen = set()
+        frontier = [pid for pid in pids if pid]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while len(frontier) > 0:
+                frontier = [pid for pid in frontier if pid not in seen]
+                seen.update(frontier)
+                next_frontier = []
+                for pid, children in zip(
+                        frontier, pool.map(self.__safe_render__, frontier)):
+                    if recurse:
+                        next_frontier.extend(children)
+                frontier = next_frontier
+        return seen
+
+    def __safe_render__(self, pid):
+        try:
+            return self.render_pid(pid)
+        except Exception as error:
+            click.echo("Failed to render {} {}".format(pid, error), err=True)
+            with self.lock:
+                self.manifest.setdefault("errors", dict())[pid] = str(error)
+            return []
+
+    def build(self):
+        """Method walks the collection tree from INITIAL_PID and the
+        FEATURED_COLLECTION and renders every page"""
+        self.started = time.time()
+        previous = self.manifest["pages"]
+        self.manifest = {"pages": dict()}
+        self.render_landing()
+        rendered = self.__render_all__(
+            [self.root, self.app.config.get("FEATURED_COLLECTION")],
+            recurse=True)
+        # Pids left over from an earlier build are no longer reachable
+        for pid in set(previous) - rendered:
+            self.manifest["pages"][pid] = previous[pid]
+            self.__remove__(pid)
+        self.save()
+        return rendered
+
+    def update(self, pids):
+        """Method renders the pages of reindexed pids, their ancestors'
+        pages, new children of those pids and the landing page
+
+        Args:
+            pids -- List of reindexed PIDs
+        """
+        self.started = time.time()
+        affected = set(pids)
+        for pid in pids:
+            affected.update(
+                self.manifest["pages"].get(pid, dict()).get("ancestors", []))
+        # Pids new to the index aren't in the manifest yet, their parents
+        # come from the index
+        search = Search(using=REPO_SEARCH, index="repository") \
+            .filter("terms", **{"pid.keyword": list(pids)}) \
+            .source(["pid", "parent", "inCollections"])
+        for hit in search.scan():
+            source = hit.to_dict()
+            affected.update(source.get("inCollections", []))
+            if source.get("parent"):
+                affected.add(source.get("parent"))
+        self.manifest.pop("errors", None)
+        rendered = self.__render_all__(sorted(affected), recurse=False)
+        self.render_landing()
+        self.save()
+        return rendered
+
+    def save(self):
+        self.manifest["generation"] = get_generation(refresh=True)
+        self.manifest["built"] = datetime.datetime.utcnow().isoformat()
+        self.manifest["size"] = self.size
+        self.__write__(
+            os.path.join(self.output, MANIFEST),
+            json.dumps(self.manifest, indent=2, sort_keys=True).encode())
+
+    def report(self):
+        seconds = time.time() - self.started
+        return "{:,} pages for {:,} pids in {:.1f}s, {} errors".format(
+            self.rendered,
+            len(self.manifest["pages"]),
+            seconds,
+            len(self.manifest.get("errors", [])))
+
+
+def __prerenderer__(output, workers):
+    from app import app
+    # Pages must come from the views, not a previous pre-render
+    app.config["PRERENDER_DIR"] = None
+    return Prerenderer(app, output, workers)
+
+@click.group()
+def main():
+    pass
+
+@main.command()
+@click.option("--output", default=getattr(CONF, "PRERENDER_DIR", None),
+    help="Pre-render directory, default is PRERENDER_DIR")
+@click.option("--workers", default=4)
+def build(output, workers):
+    """Renders every collection and object page"""
+    if output is None:
+        raise click.UsageError("--output or PRERENDER_DIR is required")
+    prerenderer = __prerenderer__(output, workers)
+    prerenderer.build()
+    click.echo(prerenderer.report())
+
+@main.command()
+@click.option("--output", default=getattr(CONF, "PRERENDER_DIR", None),
+    help="Pre-render directory, default is PRERENDER_DIR")
+@click.option("--queue", default=getattr(CONF, "PRERENDER_QUEUE", None),
+    help="File of pids queued by search/poll.py")
+@click.option("--workers", default=4)
+@click.argument("pids", nargs=-1)
+def update(output, queue, workers, pids):
+    """Renders the pages affected by queued or given pids"""
+    if output is None:
+        raise click.UsageError("--output or PRERENDER_DIR is required")
+    pids = sorted(set(pids).union(read_queue(queue)))
+    if len(pids) < 1:
+        click.echo("No pids to render")
+        return
+    prerenderer = __prerenderer__(output, workers)
+    try:
+        if not os.path.exists(os.path.join(output, MANIFEST)):
+            prerenderer.build()
+        else:
+            prerenderer.update(pids)
+    except Exception:
+        # Put the pids back for the next run
+        if queue is not None:
+            queue_pids(queue, pids)
+        raise
+    click.echo(prerenderer.report())
+
+
+if __name__ == "__main__":
+    main()
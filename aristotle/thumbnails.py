@@ -0,0 +1,223 @@
+"""Module provides a content-addressed on-disk store for Fedora TN
+datastreams, kept apart from the tiered search.cache so thumbnails
+have their own size budget and eviction"""
+__author__ = "Jeremy Nelson"
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+from fedora import FedoraError
+
+__stores__ = dict()
+__stores_lock__ = threading.Lock()
+
+
+class ThumbnailStore(object):
+    """Class stores thumbnail bytes under the SHA1 of their content in
+    sharded subdirectories, with a small per-pid record of the digest and
+    Fedora's datastream date used to revalidate.
+
+    Args:
+        directory -- Root directory of the store
+        max_bytes -- Size budget for stored thumbnails, default is 256MB
+        revalidate -- Seconds before a pid is checked against Fedora again
+    """
+
+    def __init__(self, directory, max_bytes=256*1024*1024, revalidate=3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.lock = threading.Lock()
+        self.total_bytes = None
+        for name in ["blobs", "pids"]:
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def __shard__(self, kind, digest):
+        return os.path.join(self.directory, kind, digest[0:2], digest[2:4])
+
+    def __blob_path__(self, digest):
+        return os.path.join(self.__shard__("blobs", digest), digest)
+
+    def __record_path__(self, pid):
+        digest = hashlib.sha1(pid.encode()).hexdigest()
+        return os.path.join(
+            self.__shard__("pids", digest),
+            "{}.json".format(digest))
+
+    def __write__(self, path, content):
+        """Writes to a temp file then renames so concurrent workers never
+        read a partial file"""
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, "wb") as fo:
+            fo.write(content)
+        os.replace(tmp_path, path)
+
+    def __read_record__(self, pid):
+        try:
+            with open(self.__record_path__(pid)) as fo:
+                return json.load(fo)
+        except (IOError, ValueError):
+            return
+
+    def __write_record__(self, pid, record):
+        self.__write__(self.__record_path__(pid),
+                       json.dumps(record).encode())
+
+    def __read_blob__(self, digest):
+        path = self.__blob_path__(digest)
+        try:
+            with open(path, "rb") as fo:
+                content = fo.read()
+        except IOError:
+            return
+        # Touch mtime so eviction is least recently used
+        os.utime(path, None)
+        return content
+
+    def __blobs__(self):
+        blob_root = os.path.join(self.directory, "blobs")
+        for root, dirs, files in os.walk(blob_root):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def __put_blob__(self, content):
+        digest = hashlib.sha1(content).hexdigest()
+        path = self.__blob_path__(digest)
+        if not os.path.exists(path):
+            self.__write__(path, content)
+            with self.lock:
+                if self.total_bytes is None:
+                    self.total_bytes = sum(
+                        row[1] for row in self.__blobs__())
+                else:
+                    self.total_bytes += len(content)
+                if self.total_bytes > self.max_bytes:
+                    self.evict()
+        return digest
+
+    def evict(self):
+        """Removes least recently used blobs until the store is under 90%
+        of its size budget, pid records pointing to removed blobs are
+        treated as misses and refetched"""
+        blobs = sorted(self.__blobs__(), key=lambda row: row[2])
+        total = sum(row[1] for row in blobs)
+        target = int(self.max_bytes * 0.9)
+        for path, size, mtime in blobs:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+        self.total_bytes = total
+
+    def get(self, pid, fedora):
+        """Method returns a dict with content, mime_type and etag for the
+        pid's TN datastream, or None if the object has no thumbnail.
+        Stored thumbnails are revalidated against Fedora's datastream date
+        once every revalidate seconds. When Fedora fails the stored
+        thumbnail, if any, is returned and nothing is recorded so the next
+        request tries again.
+
+        Args:
+            pid -- PID of Fedora Object
+            fedora -- FedoraClient
+        """
+        now = time.time()
+        record = self.__read_record__(pid)
+        if record and now - record.get("checked", 0) < self.revalidate:
+            return self.__from_record__(pid, record, fedora)
+        try:
+            profile = fedora.datastream_profile(pid, "TN")
+        except (FedoraError, requests.RequestException):
+            return self.__stored__(record)
+        if profile is None:
+            self.__write_record__(pid, {"digest": None, "checked": now})
+            return
+        modified = profile.get("dsCreateDate")
+        if record and record.get("modified") == modified and \
+           record.get("digest"):
+            record["checked"] = now
+            self.__write_record__(pid, record)
+            return self.__from_record__(pid, record, fedora)
+        return self.__fetch__(pid, fedora, modified, record)
+
+    def __stored__(self, record):
+        """Returns the record's thumbnail or None if it has none or the
+        blob was evicted"""
+        if not record or record.get("digest") is None:
+            return
+        content = self.__read_blob__(record["digest"])
+        if content is None:
+            return
+        return {"content": content,
+                "mime_type": record.get("mime_type"),
+                "etag": record["digest"]}
+
+    def __from_record__(self, pid, record, fedora):
+        if record.get("digest") is None:
+            return
+        thumbnail = self.__stored__(record)
+        if thumbnail is None:
+            # Blob was evicted
+            return self.__fetch__(pid, fedora, record.get("modified"))
+        return thumbnail
+
+    def __fetch__(self, pid, fedora, modified, record=None):
+        try:
+            result = fedora.get_datastream(pid, "TN")
+        except requests.RequestException:
+            return self.__stored__(record)
+        if result.status_code == 404:
+            self.__write_record__(pid, {"digest": None, "checked": time.time()})
+            return
+        if result.status_code > 399:
+            # Only a missing datastream is remembered, other errors fall
+            # back to the stored thumbnail
+            return self.__stored__(record)
+        content = result.content
+        record = {"digest": self.__put_blob__(content),
+                  "mime_type": result.headers.get("Content-Type", "image/jpeg"),
+                  "modified": modified,
+                  "checked": time.time()}
+        self.__write_record__(pid, record)
+        return {"content": content,
+                "mime_type": record["mime_type"],
+                "etag": record["digest"]}
+
+
+def get_store(config):
+    """Function returns the process-wide ThumbnailStore for a Flask config
+
+    Args:
+        config -- Flask config
+    """
+    directory = config.get(
+        "THUMBNAIL_DIR",
+        os.path.join(
+            os.path.split(
+                os.path.abspath(os.path.curdir))[0],
+                "thumbnails"))
+    with __stores_lock__:
+        store = __stores__.get(directory)
+        if store is None:
+            store = ThumbnailStore(
+                directory,
+                max_bytes=config.get("THUMBNAIL_MAX_BYTES", 256*1024*1024),
+                revalidate=config.get("THUMBNAIL_REVALIDATE", 3600))
+            __stores__[directory] = store
+    return store
@@ -4,31 +4,107 @@ __author__ = "Jeremy Nelson"
 
 import click
 import datetime
+import hashlib
+import json
 import os
-import requests
 
 import click
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 HOME = os.path.abspath(os.curdir)
 with open(os.path.join(HOME, "VERSION")) as fo:
     VERSION = fo.read()
 
 from flask import abort, jsonify, render_template, redirect, request,\
-    Response, url_for, current_app
+    Response, stream_with_context, url_for, current_app
 from . import cache, REPO_SEARCH
 from .blueprint import aristotle
 from .forms import SimpleSearch, AdvancedSearch
-from search import advanced_search, browse, filter_query, get_aggregations,\
-    get_detail, get_pid, specific_search
+from .prerender import page_path
+from .thumbnails import get_store
+from fedora import get_client
+from search import advanced_search, browse, browse_page, compact_results,\
+    filter_query, get_aggregations, get_detail, get_generation, get_pid,\
+    get_titles, index_info, specific_search
+
+# Headers passed between browser and Fedora by the datastream proxy
+PROXY_REQUEST_HEADERS = ["If-Modified-Since", "If-None-Match", "If-Range",
+                         "Range"]
+PROXY_RESPONSE_HEADERS = ["Accept-Ranges", "Content-Disposition",
+                          "Content-Length", "Content-Range", "ETag",
+                          "Last-Modified"]
+
+def __dumps__(value):
+    """Helper function serializes a JSON response with orjson or ujson when
+    either is installed, otherwise compact json"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    if ujson is not None:
+        return ujson.dumps(value, ensure_ascii=False).encode("utf-8")
+    return json.dumps(
+        value,
+        ensure_ascii=False,
+        separators=(",", ":")).encode("utf-8")
+
+def __etag__(params):
+    """Helper function returns a strong ETag for the current endpoint from
+    the index generation and the request parameters, ignoring empty
+    values and parameter order
+
+    Args:
+        params -- Dict of request parameters
+    """
+    generation = get_generation()
+    normalized = sorted((key, str(value).strip())
+                        for key, value in params.items()
+                        if value is not None and str(value).strip() != "")
+    digest = hashlib.sha1(json.dumps(
+        [request.endpoint, generation, normalized]).encode()).hexdigest()
+    return "g{}-{}".format(generation, digest[0:24])
+
+def __conditional_json__(params, build):
+    """Helper function returns the JSON from build() with an ETag. A GET
+    whose If-None-Match has the ETag gets a 304 without calling build(),
+    so Elasticsearch isn't queried. GET responses are public for
+    JSON_MAX_AGE seconds so nginx can micro-cache them.
+
+    Args:
+        params -- Dict of request parameters the response depends on
+        build -- Callable returning the JSON serializable response
+    """
+    etag = __etag__(params)
+    cacheable = request.method in ["GET", "HEAD"]
+    # nginx weakens ETags when it gzips, so compare weakly
+    if cacheable and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(__dumps__(build()), mimetype="application/json")
+    response.set_etag(etag)
+    response.vary.add("Accept")
+    if cacheable:
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get(
+            "JSON_MAX_AGE", 60)
+    else:
+        response.cache_control.no_cache = True
+    return response
 
 @aristotle.route("/digitalcc/about")
 @aristotle.route("/about")
 def about_aristotle():
     """Displays details of current version of Aristotle"""
-    index_created_on = REPO_SEARCH.indices.get('repository').get('repository').get('settings').get('index').get('creation_date')
-    indexed_on = datetime.datetime.utcfromtimestamp(int(index_created_on[0:10]))
+    info = index_info()
     return render_template("discovery/About.html",
-        indexed_on = indexed_on,
+        index=info.get("index"),
+        indexed_on=info.get("built"),
+        generation=info.get("generation"),
         search_form=SimpleSearch(),
         version = VERSION)
     
@@ -43,15 +119,33 @@ def browser():
     if request.method.startswith("POST"):
         pid = request.form["pid"]
         from_ = request.form.get("from", 0)
+        after = request.form.get("after")
     else:
         pid = request.args.get('pid')
         from_ = request.args.get('from', 0)
-    cache_key = "{}-{}".format(pid, from_)
-    browsed = cache.get(cache_key)
-    if not browsed:
-        browsed = browse(pid, from_)
-        cache.set(cache_key, browsed)
-    return jsonify(browsed)
+        after = request.args.get('after')
+
+    def build():
+        # Browse pages are keyed on the index generation, a reindex
+        # retires them
+        cache_key = "{}-{}-{}".format(pid, from_, after)
+        browsed = cache.get("browse", cache_key)
+        if not browsed:
+            browsed = compact_results(browse(pid, from_, after=after))
+            cache.set("browse", cache_key, browsed)
+        return browsed
+
+    return __conditional_json__(
+        {"pid": pid, "from": from_, "after": after},
+        build)
+
+@aristotle.route("/cache/stats")
+def cache_stats():
+    """Returns this worker's cache hit and miss counters, only to requests
+    from the host itself, everyone else gets a 404"""
+    if request.remote_addr not in ["127.0.0.1", "::1"]:
+        abort(404)
+    return jsonify(cache.stats())
 
 @aristotle.route("/contribute")
 def view_contribute():
@@ -78,6 +172,53 @@ def view_help():
     return render_template("discovery/Help.html",
         search_form=SimpleSearch())	
 	
+def __proxy_datastream__(pid, dsid, mimetype=None):
+    """Helper function streams a Fedora datastream back to the browser in
+    chunks, forwarding Range and conditional headers so that players can
+    seek and browsers can revalidate without buffering the whole object
+    in the worker.
+
+    Args:
+        pid -- Fedora Object's PID
+        dsid -- Datastream ID
+        mimetype -- Optional mimetype, defaults to Fedora's Content-Type
+    """
+    headers = dict()
+    for name in PROXY_REQUEST_HEADERS:
+        if name in request.headers:
+            headers[name] = request.headers.get(name)
+    result = get_client(current_app.config).get_datastream(
+        pid,
+        dsid,
+        stream=True,
+        headers=headers)
+    if result.status_code == 404:
+        result.close()
+        abort(404)
+    response_headers = dict()
+    for name in PROXY_RESPONSE_HEADERS:
+        if name in result.headers:
+            response_headers[name] = result.headers.get(name)
+    if result.status_code == 304:
+        result.close()
+        return Response(status=304, headers=response_headers)
+    chunk_size = current_app.config.get("STREAM_CHUNK_SIZE", 64 * 1024)
+
+    def generate():
+        try:
+            for chunk in result.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    yield chunk
+        finally:
+            result.close()
+
+    return Response(
+        stream_with_context(generate()),
+        status=result.status_code,
+        headers=response_headers,
+        mimetype=mimetype or result.headers.get('Content-Type'),
+        direct_passthrough=True)
+
 @aristotle.route("/pid/<pid>/datastream/<dsid>")
 @aristotle.route("/pid/<pid>/datastream/<dsid>.<ext>")
 def get_datastream(pid, dsid, ext=None):
@@ -87,19 +228,10 @@ def get_datastream(pid, dsid, ext=None):
         pid -- Fedora Object's PID
         dsid -- Either datastream ID of PID
     """
-    fedora_url = "{}{}/datastreams/{}/content".format(
-        current_app.config.get("REST_URL"),
-        pid,
-        dsid)
-    exists_result = requests.get(fedora_url)
-    if exists_result.status_code == 404:
-        abort(404)
-    return Response(
-        exists_result.content, 
-        mimetype=exists_result.headers.get('Content-Type'))
+    return __proxy_datastream__(pid, dsid)
 
 
-@aristotle.route("/detail", methods=["POST"])
+@aristotle.route("/detail", methods=["POST", "GET"])
 def detailer():
     """Detail view for AJAX call from client based on the PID in
 	the Form.
@@ -109,9 +241,44 @@ def detailer():
     """
     if request.method.startswith("POST"):
         pid = request.form["pid"]
-        detailed_info = get_detail(pid)
-        return jsonify(detailed_info)
+    else:
+        pid = request.args.get("pid")
+        if pid is None:
+            abort(400)
+    return __conditional_json__(
+        {"pid": pid},
+        lambda: compact_results(get_detail(pid)))
+
 
+def __thumbnail__(pid):
+    """Helper function returns the pid's thumbnail from the thumbnail
+    store, or the default thumbnail, with long-lived caching headers and
+    a 304 if the browser already has it.
+
+    Args:
+        pid -- Fedora Object's PID
+    """
+    thumbnail = get_store(current_app.config).get(
+        pid,
+        get_client(current_app.config))
+    if thumbnail is None:
+        default_tn = cache.get("static", "default-thumbnail")
+        if not default_tn:
+            with current_app.open_resource(
+                "static/img/default-tn.png") as fo:
+                default_tn = fo.read()
+                cache.set("static", "default-thumbnail", default_tn)
+        response = Response(default_tn, mimetype="image/png")
+        response.add_etag()
+    else:
+        response = Response(
+            thumbnail.get("content"),
+            mimetype=thumbnail.get("mime_type"))
+        response.set_etag(thumbnail.get("etag"))
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get(
+        "THUMBNAIL_MAX_AGE", 86400)
+    return response.make_conditional(request)
 
 @aristotle.route("/image/<uid>")
 def image(uid):
@@ -122,16 +289,7 @@ def image(uid):
         uid: Elasticsearch ID
     """
     pid = get_pid(uid)
-    thumbnail_url = "{}{}/datastreams/TN/content".format(
-        app.config.get("REST_URL"),
-        pid)
-    raw_thumbnail = cache.get(thumbnail_url)
-    if not raw_thumbnail:
-        result = requests.get(thumbnail_url)
-        if result.status_code > 399:
-           abort(500)
-        #raw_thumbnail = result.text
-        return Response(result.text, mimetype="image/jpeg")
+    return __thumbnail__(pid)
 
 @aristotle.route("/advanced-search",  methods=["POST", "GET"])
 def advanced_searching():
@@ -198,48 +356,65 @@ def query():
         facet_val = request.form.get('val')
         offset = request.form.get('offset', 0)
         size = request.form.get('size', 25)
+        after = request.form.get('after')
         query = request.form["q"]
     else:
         mode = request.args.get('mode', 'keyword')
         facet = request.args.get('facet')
         offset = request.args.get('offset', 0)
         size = request.args.get('size', 25)
+        after = request.args.get('after')
         facet_val = request.args.get('val')
         query = request.args.get('q', None)
-    search_results = None
-    if mode in ["creator", "title", "subject", "number"]:
-         search_results = specific_search(
+
+    def build():
+        search_results = None
+        if mode in ["creator", "title", "subject", "number"]:
+             search_results = specific_search(
+                    query,
+                    mode,
+                    size,
+                    offset,
+                    after=after)
+        if mode.startswith("facet"):
+            search_results = filter_query(
+                facet, 
+                facet_val, 
                 query,
-                mode,
                 size,
-                offset)
-    if mode.startswith("facet"):
-        search_results = filter_query(
-            facet, 
-            facet_val, 
-            query,
-            size,
-            offset)
-    if not search_results and query is not None:
-       search_results = specific_search(
-           query,
-           "keyword",
-           size,
-           offset)
-    if "html" in request.headers.get("Accept"):
+                offset,
+                after)
+        if not search_results and query is not None:
+           search_results = specific_search(
+               query,
+               "keyword",
+               size,
+               offset,
+               after=after)
+        return search_results
+
+    if "html" in request.headers.get("Accept", ""):
         return render_template(
             'discovery/search-results.html',
             facet=facet,
             facet_val=facet_val,
             mode=mode,
-            results = search_results,
+            results = build(),
             search_form=SimpleSearch(),
             q=query,
             size=size,
             offset=offset
         )
     else:
-        return jsonify(search_results)
+        return __conditional_json__(
+            {"mode": mode,
+             "facet": facet,
+             "val": facet_val,
+             "offset": offset,
+             "size": size,
+             "after": after,
+             "q": query},
+            lambda: compact_results(build()))
     
 @aristotle.route("/pid/<pid>/datastream/<dsid>.<ext>")
 def fedora_datastream(pid, dsid, ext):
@@ -251,11 +426,7 @@ def fedora_datastream(pid, dsid, ext):
         dsid -- Datastream ID
         ext -- Extension for datastream
     """
-    ds_url = "{}{}/datastream/{}".format(
-        app.config.get("REST_URL"),
-        pid,
-        dsid)
-    result = requests.get(ds_url)
+    mimetype = None
     if ext.startswith("pdf"):
         mimetype = 'application/pdf'
     if ext.startswith("jpg"):
@@ -264,7 +435,7 @@ def fedora_datastream(pid, dsid, ext):
         mimetype = "audio/mpeg"
     if ext.startswith("wav"):
         mimetype = "audio/wav"
-    return Response(result.text, mimetype=mimetype) 
+    return __proxy_datastream__(pid, dsid, mimetype)
 
 
 @aristotle.route("/<identifier>/<value>")
@@ -285,50 +456,47 @@ def fedora_object(identifier, value):
         size = current_app.config.get("SIZE", 25) # Default size is 25
     if identifier.startswith("pid"):
         offset = request.args.get("offset", 0)
-        results = browse(value, from_=offset, size=size)
+        after = request.args.get("after")
+        is_root = value == current_app.config.get("INITIAL_PID")
+        # Hits, facets, and detail in one round trip, breadcrumb titles
+        # are resolved by the planner
+        page = browse_page(value,
+                           from_=offset,
+                           size=size,
+                           detail=not is_root,
+                           after=after)
+        results = page.results
         if results['hits']['total'] < 1:
-            detail_result = get_detail(value)
+            detail_result = page.detail
+            if detail_result is None:
+                # The root's page skips its own document
+                detail_result = get_detail(value)
+            if detail_result is None or \
+               len(detail_result['hits']['hits']) < 1:
+                abort(404)
+            detail = detail_result['hits']['hits'][0]
             if not 'islandora:collectionCModel' in\
-                detail_result['hits']['hits'][0]['_source']['content_models']:
+                detail['_source'].get('content_models', []):
                 return render_template(
                     'discovery/detail.html',
                     pid=value,
                     mode='detail',
                     size=size,
-                    info=detail_result['hits']['hits'][0],
+                    info=detail,
                     search_form=SimpleSearch())
-        if value == current_app.config.get("INITIAL_PID"):
-            info = dict()
-        else:
-            info = get_detail(value)['hits']['hits'][0]['_source']
         return render_template(
             'discovery/index.html',
             pid=value,
             results=results,
-            info=info,
+            info=page.info,
             search_form=SimpleSearch(),
             q=value,
             mode='browse',
             size=size,
             offset=offset,
-            facets=get_aggregations(value))
+            facets=page.facets)
     if identifier.startswith("thumbnail"):
-        thumbnail_url = "{}{}/datastreams/TN/content".format(
-            current_app.config.get("REST_URL"),
-            value)
-        tn_result = requests.get(thumbnail_url)
-        if tn_result.status_code == 404:
-            thumbnail = cache.get('default-thumbnail')
-            if not thumbnail:
-                with current_app.open_resource(
-                    "static/img/default-tn.png") as fo:
-                    thumbnail = fo.read()
-                    cache.set('default-thumbnail', thumbnail)
-            mime_type = "image/png"
-        else:
-            thumbnail = tn_result.content
-            mime_type = "image/jpg"
-        return Response(thumbnail, mimetype=mime_type)
+        return __thumbnail__(value)
 
 
     return "Should return detail for {} {}".format(identifier, value)
@@ -338,6 +506,14 @@ def fedora_object(identifier, value):
 @aristotle.route("/")
 def index():
     """Displays Home-page of Digital Repository"""
+    # The landing page is pre-rendered by aristotle/prerender.py after
+    # each reindex, nginx normally serves it before reaching Flask
+    prerender_dir = current_app.config.get("PRERENDER_DIR")
+    if prerender_dir and len(request.args) < 1:
+        landing = page_path(prerender_dir)
+        if os.path.exists(landing):
+            with open(landing, "rb") as fo:
+                return Response(fo.read(), mimetype="text/html")
     query = request.args.get('q', None)
     mode=request.args.get('mode', 'landing')
     pid = request.args.get('pid', current_app.config.get("INITIAL_PID"))
@@ -345,6 +521,7 @@ def index():
         results = browse(pid)
     else:
         results = search(q=query)
+    get_titles([current_app.config.get("FEATURED_COLLECTION")])
     return render_template(
         'discovery/index.html',
         pid=pid,
@@ -353,6 +530,7 @@ def index():
         results = results,
         search_form=SimpleSearch(),
         featured_collection=browse(
-            current_app.config.get("FEATURED_COLLECTION")),
+            current_app.config.get("FEATURED_COLLECTION"),
+            view="tile"),
         mode=mode
     )
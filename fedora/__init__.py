@@ -0,0 +1,367 @@
+"""Module provides a pooled HTTP client for the Fedora 3 REST API and
+Resource Index shared by Aristotle, the search poller, the BIBFRAME
+migrator and the CONTENTdm harvesters"""
+__author__ = "Jeremy Nelson"
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import urllib.parse
+
+import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Default connect and read timeouts in seconds
+DEFAULT_TIMEOUT = (5, 60)
+RETRY_STATUSES = [500, 502, 503, 504]
+# POST is left out so new objects and datastreams are never created twice,
+# Resource Index queries are read-only and get their own adapter
+RETRY_METHODS = frozenset(["DELETE", "GET", "HEAD", "OPTIONS", "PUT"])
+
+# Fedora checksumType values to hashlib names
+CHECKSUM_ALGORITHMS = {"MD5": "md5",
+                       "SHA-1": "sha1",
+                       "SHA-256": "sha256",
+                       "SHA-512": "sha512"}
+
+__clients__ = dict()
+__clients_lock__ = threading.Lock()
+
+
+class FedoraError(Exception):
+    """Raised when Fedora returns an error status"""
+
+    def __init__(self, status_code, message):
+        super(FedoraError, self).__init__(status_code, message)
+        self.status_code = status_code
+        self.message = message
+
+
+def __retry__(retries, backoff, methods):
+    """Helper function builds a urllib3 Retry that backs off on 5xx"""
+    kwargs = {"total": retries,
+              "backoff_factor": backoff,
+              "status_forcelist": RETRY_STATUSES,
+              "raise_on_status": False}
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=methods, **kwargs)
+
+def __setting__(conf, name, default=None):
+    """Helper function reads a setting from a Flask config, dict, or the
+    instance conf module"""
+    if isinstance(conf, dict):
+        return conf.get(name, default)
+    return getattr(conf, name, default)
+
+def __xml__(content):
+    """Helper function parses a Fedora REST API XML response without
+    resolving entities or fetching DTDs"""
+    return etree.fromstring(
+        content,
+        etree.XMLParser(resolve_entities=False, no_network=True))
+
+def __local_name__(element):
+    return etree.QName(element).localname
+
+def parse_profile(content):
+    """Function returns a dict of element name to text for the children
+    of an objectProfile or datastreamProfile. Fedora 3 releases put the
+    profiles in different namespaces so only local names are used.
+
+    Args:
+        content -- XML profile as bytes
+    """
+    profile = dict()
+    for child in __xml__(content):
+        if not isinstance(child.tag, str):
+            continue
+        profile[__local_name__(child)] = child.text
+    return profile
+
+def parse_datastreams(content):
+    """Function returns a list of dicts with the dsid, label and mimeType
+    of every datastream element in an objectDatastreams listing
+
+    Args:
+        content -- XML listing as bytes
+    """
+    return [{"dsid": element.get("dsid"),
+             "label": element.get("label"),
+             "mimeType": element.get("mimeType")}
+            for element in __xml__(content).iter()
+            if isinstance(element.tag, str) and
+               __local_name__(element) == "datastream"]
+
+def new_session(pool_size=10, retries=3, backoff=0.5):
+    """Function returns a keep-alive requests Session with a connection
+    pool of pool_size and retry with backoff on 5xx responses
+
+    Args:
+        pool_size -- Max connections kept open per host, default is 10
+        retries -- Number of retries, default is 3
+        backoff -- Backoff factor in seconds, default is 0.5
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=__retry__(retries, backoff, RETRY_METHODS))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def spool_response(response, max_memory=8*1024*1024, checksum_type="MD5",
+                   chunk_size=64*1024):
+    """Function reads a streamed Response once, computing its checksum in
+    the same pass. Bodies up to max_memory are returned as bytes, larger
+    bodies are spilled to a temporary file that is returned rewound, so
+    memory per transfer is bounded.
+
+    Args:
+        response -- requests Response opened with stream=True
+        max_memory -- Bytes kept in memory before spilling to disk
+        checksum_type -- Fedora checksumType, default is MD5
+        chunk_size -- Bytes per read, default is 64KB
+
+    Returns:
+        content, checksum hex digest
+    """
+    digest = hashlib.new(CHECKSUM_ALGORITHMS[checksum_type])
+    buffer, spool = io.BytesIO(), None
+    try:
+        for chunk in response.iter_content(chunk_size):
+            digest.update(chunk)
+            if spool is None and buffer.tell() + len(chunk) > max_memory:
+                spool = tempfile.TemporaryFile()
+                spool.write(buffer.getvalue())
+                buffer = None
+            (spool or buffer).write(chunk)
+    except Exception:
+        if spool is not None:
+            spool.close()
+        raise
+    finally:
+        response.close()
+    if spool is None:
+        return buffer.getvalue(), digest.hexdigest()
+    spool.seek(0)
+    return spool, digest.hexdigest()
+
+
+class FedoraClient(object):
+    """Class wraps a pooled requests Session for Fedora REST and Resource
+    Index calls"""
+
+    def __init__(self, rest_url, ri_url=None, auth=None, **kwargs):
+        self.rest_url = rest_url
+        self.ri_url = ri_url
+        self.auth = auth
+        self.timeout = kwargs.get("timeout", DEFAULT_TIMEOUT)
+        pool_size = kwargs.get("pool_size", 10)
+        retries = kwargs.get("retries", 3)
+        backoff = kwargs.get("backoff", 0.5)
+        self.session = new_session(pool_size, retries, backoff)
+        if self.ri_url:
+            self.session.mount(
+                self.ri_url,
+                HTTPAdapter(
+                    pool_connections=pool_size,
+                    pool_maxsize=pool_size,
+                    max_retries=__retry__(
+                        retries,
+                        backoff,
+                        RETRY_METHODS | frozenset(["POST"]))))
+
+    def __url__(self, pid, *parts):
+        return "{}{}".format(self.rest_url, "/".join((pid,) + parts))
+
+    def request(self, method, url, **kwargs):
+        """Method sends a request through the pooled session, applying
+        default auth and timeout"""
+        kwargs.setdefault("auth", self.auth)
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def get_datastream(self, pid, dsid, stream=False, **kwargs):
+        """Method returns the Response for a datastream's content
+
+        Args:
+            pid -- PID of Fedora Object
+            dsid -- Datastream ID
+            stream -- Stream the body instead of reading it, default False
+        """
+        return self.get(
+            self.__url__(pid, "datastreams", dsid, "content"),
+            stream=stream,
+            **kwargs)
+
+    def datastream_profile(self, pid, dsid, **kwargs):
+        """Method returns the datastream profile as a dict of element name,
+        dsLabel, dsCreateDate, dsMIME..., to text or None if the datastream
+        doesn't exist
+
+        Args:
+            pid -- PID of Fedora Object
+            dsid -- Datastream ID
+        """
+        result = self.get(
+            self.__url__(pid, "datastreams", dsid),
+            params={"format": "xml"},
+            **kwargs)
+        if result.status_code == 404:
+            return
+        if result.status_code > 399:
+            raise FedoraError(result.status_code, result.text)
+        return parse_profile(result.content)
+
+    def object_profile(self, pid, **kwargs):
+        """Method returns the object profile as a dict of element name,
+        objLabel, objLastModDate..., to text or None if the object doesn't
+        exist
+
+        Args:
+            pid -- PID of Fedora Object
+        """
+        result = self.get(
+            self.__url__(pid),
+            params={"format": "xml"},
+            **kwargs)
+        if result.status_code == 404:
+            return
+        if result.status_code > 399:
+            raise FedoraError(result.status_code, result.text)
+        return parse_profile(result.content)
+
+    def list_datastreams(self, pid, **kwargs):
+        """Method returns a list of dicts with each datastream's dsid, label
+        and mimeType
+
+        Args:
+            pid -- PID of Fedora Object
+        """
+        result = self.get(
+            self.__url__(pid, "datastreams"),
+            params={"format": "xml"},
+            **kwargs)
+        if result.status_code > 399:
+            raise FedoraError(result.status_code, result.text)
+        return parse_datastreams(result.content)
+
+    def ri_sparql(self, sparql, **kwargs):
+        """Method runs a SPARQL query against the Resource Index and
+        returns the list of result rows
+
+        Args:
+            sparql -- SPARQL query
+        """
+        result = self.post(
+            self.ri_url,
+            data={"type": "tuples",
+                  "lang": "sparql",
+                  "format": "json",
+                  "query": sparql},
+            **kwargs)
+        if result.status_code > 399:
+            raise FedoraError(result.status_code, result.text)
+        return result.json().get("results")
+
+    def add_datastream(self, pid, dsid, content, label, mime_type,
+                       **kwargs):
+        """Method adds a managed datastream to a Fedora Object and returns
+        the Response
+
+        Args:
+            pid -- PID of Fedora Object
+            dsid -- Datastream ID
+            content -- str, bytes or file-like object, file-like content
+                       is streamed as the request body
+            label -- Datastream label
+            mime_type -- Datastream mime-type
+            checksum_type -- Optional Fedora checksumType, i.e. MD5
+            checksum -- Optional checksum Fedora verifies the content against
+        """
+        params = {"controlGroup": kwargs.pop("control_group", "M"),
+                  "dsLabel": label,
+                  "mimeType": mime_type}
+        checksum_type = kwargs.pop("checksum_type", None)
+        checksum = kwargs.pop("checksum", None)
+        if checksum_type is not None:
+            params["checksumType"] = checksum_type
+        if checksum is not None:
+            params["checksum"] = checksum
+        add_url = "{}?{}".format(
+            self.__url__(pid, "datastreams", dsid),
+            urllib.parse.urlencode(params))
+        if hasattr(content, "read"):
+            # Fedora accepts the raw entity body, which requests streams
+            # from the file instead of building a multipart body in memory
+            headers = kwargs.pop("headers", {})
+            headers.setdefault("Content-Type", mime_type)
+            return self.post(add_url, data=content, headers=headers, **kwargs)
+        return self.post(add_url, files={"content": content}, **kwargs)
+
+    def new_object(self, label, namespace="coccc", state="A", **kwargs):
+        """Method creates a new Fedora Object, sets its label, owner and
+        state, and returns the new PID or None if Fedora failed
+
+        Args:
+            label -- Object label
+            namespace -- PID namespace, default is coccc
+            state -- Object state, default is A
+        """
+        new_pid_result = self.post(
+            "{}new?namespace={}".format(self.rest_url, namespace),
+            **kwargs)
+        if new_pid_result.status_code > 399:
+            return
+        new_pid = new_pid_result.text
+        params = {"label": label, "state": state}
+        if self.auth:
+            params["ownerID"] = self.auth[0]
+        self.put(
+            "{}?{}".format(self.__url__(new_pid),
+                           urllib.parse.urlencode(params)),
+            **kwargs)
+        return new_pid
+
+
+def get_client(conf):
+    """Function returns the process-wide FedoraClient for a configuration,
+    a new client is built after a fork so pooled sockets are never shared
+    between uWSGI workers.
+
+    Args:
+        conf -- Flask config, dict, or instance conf module
+    """
+    rest_url = __setting__(conf, "REST_URL")
+    key = (os.getpid(), rest_url)
+    with __clients_lock__:
+        client = __clients__.get(key)
+        if client is None:
+            client = FedoraClient(
+                rest_url,
+                ri_url=__setting__(conf, "RI_URL"),
+                auth=__setting__(conf, "FEDORA_AUTH"),
+                pool_size=__setting__(conf, "FEDORA_POOL_SIZE", 10),
+                retries=__setting__(conf, "FEDORA_RETRIES", 3),
+                backoff=__setting__(conf, "FEDORA_BACKOFF", 0.5),
+                timeout=__setting__(conf, "FEDORA_TIMEOUT", DEFAULT_TIMEOUT))
+            __clients__[key] = client
+    return client
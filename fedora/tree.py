@@ -0,0 +1,117 @@
+"""Module builds an in-memory index of the repository's collection tree
+from a handful of paged Resource Index queries instead of one query per
+object"""
+__author__ = "Jeremy Nelson"
+
+from collections import defaultdict
+
+COLLECTION_MODEL = "islandora:collectionCModel"
+
+# SPARQL Templates, ORDER BY keeps LIMIT/OFFSET pages stable
+MEMBERSHIP_SPARQL = """SELECT ?s ?o
+WHERE {{
+  ?s <fedora-rels-ext:isMemberOfCollection> ?o .
+}}
+ORDER BY ?s ?o
+LIMIT {limit}
+OFFSET {offset}"""
+
+MODELS_SPARQL = """SELECT ?s ?o
+WHERE {{
+  ?s <fedora-model:hasModel> ?o .
+}}
+ORDER BY ?s ?o
+LIMIT {limit}
+OFFSET {offset}"""
+
+CONSTITUENT_SPARQL = """SELECT ?s ?o
+WHERE {{
+  ?s <fedora-rels-ext:isConstituentOf> ?o .
+}}
+ORDER BY ?s ?o
+LIMIT {limit}
+OFFSET {offset}"""
+
+
+def __pid__(uri):
+    return uri.split("/")[-1]
+
+
+class RepositoryTree(object):
+    """Class holds pid to children, content models and isConstituentOf
+    for the whole repository
+
+    Args:
+        fedora -- FedoraClient
+        page_size -- Rows per Resource Index query, default is 10,000
+    """
+
+    def __init__(self, fedora, page_size=10000):
+        self.fedora = fedora
+        self.page_size = page_size
+        self.members = defaultdict(list)
+        self.parents = defaultdict(list)
+        self.models = defaultdict(set)
+        self.constituent_of = defaultdict(list)
+        self.loaded = False
+
+    def __rows__(self, template):
+        offset = 0
+        while True:
+            rows = self.fedora.ri_sparql(
+                template.format(limit=self.page_size, offset=offset))
+            for row in rows:
+                yield __pid__(row.get("s")), __pid__(row.get("o"))
+            if len(rows) < self.page_size:
+                break
+            offset += self.page_size
+
+    def load(self):
+        """Method runs the paged membership, content model and constituent
+        queries and builds the adjacency index"""
+        for child, parent in self.__rows__(MEMBERSHIP_SPARQL):
+            self.members[parent].append(child)
+            self.parents[child].append(parent)
+        for pid, model in self.__rows__(MODELS_SPARQL):
+            self.models[pid].add(model)
+        for pid, parent in self.__rows__(CONSTITUENT_SPARQL):
+            self.constituent_of[pid].append(parent)
+        self.loaded = True
+        return self
+
+    def children(self, pid):
+        """Returns the pids that are members of the collection pid"""
+        return self.members.get(pid, [])
+
+    def content_models(self, pid):
+        return self.models.get(pid, set())
+
+    def is_collection(self, pid):
+        return COLLECTION_MODEL in self.models.get(pid, set())
+
+    def is_constituent(self, pid):
+        """Returns True if pid is a page or part of a compound object"""
+        return len(self.constituent_of.get(pid, [])) > 0
+
+    def ancestors(self, pid):
+        """Returns the list of collections above pid, root first, following
+        the first parent of each object"""
+        output, seen = [], set([pid])
+        parents = self.parents.get(pid, [])
+        while len(parents) > 0 and parents[0] not in seen:
+            parent = parents[0]
+            output.insert(0, parent)
+            seen.add(parent)
+            parents = self.parents.get(parent, [])
+        return output
+
+    def walk(self, pid):
+        """Generator yields every pid below pid, depth first"""
+        stack, seen = list(reversed(self.children(pid))), set([pid])
+        while len(stack) > 0:
+            child = stack.pop()
+            if child in seen:
+                continue
+            seen.add(child)
+            yield child
+            stack.extend(reversed(self.children(child)))
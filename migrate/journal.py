@@ -0,0 +1,122 @@
+"""Module provides a SQLite checkpoint journal so an interrupted BIBFRAME
+migration can resume where it stopped"""
+__author__ = "Jeremy Nelson"
+
+import datetime
+import sqlite3
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS pids (
+    pid TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    error TEXT,
+    updated TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS frontier (
+    pid TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    updated TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT);"""
+
+DONE = "done"
+FAILED = "failed"
+PENDING = "pending"
+SKIPPED = "skipped"
+# Meta key of the output's byte offset at the last checkpoint
+OUTPUT_OFFSET = "output_offset"
+
+
+class CheckpointJournal(object):
+    """Class records completed, skipped and failed pids and the collection
+    frontier. Writes are committed in batches, checkpoint() should only be
+    called after the output has been flushed so a committed pid always
+    has its triples on disk.
+
+    Args:
+        path -- SQLite database path
+        commit_every -- Number of marks between checkpoints, default 500
+    """
+
+    def __init__(self, path, commit_every=500):
+        self.path = path
+        self.commit_every = commit_every
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+        self.pending = 0
+
+    def __now__(self):
+        return datetime.datetime.utcnow().isoformat()
+
+    def get_meta(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        if row:
+            return row[0]
+
+    def set_meta(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, value))
+        self.connection.commit()
+
+    def is_done(self, pid):
+        """Returns True if pid was completed or skipped in an earlier run"""
+        row = self.connection.execute(
+            "SELECT status FROM pids WHERE pid=?", (pid,)).fetchone()
+        return row is not None and row[0] in (DONE, SKIPPED)
+
+    def is_collection_done(self, pid):
+        row = self.connection.execute(
+            "SELECT status FROM frontier WHERE pid=?", (pid,)).fetchone()
+        return row is not None and row[0] == DONE
+
+    def mark(self, pid, status, error=None):
+        """Method records a pid's status and returns True when enough
+        marks are pending that the caller should checkpoint"""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO pids (pid, status, error, updated) "
+            "VALUES (?, ?, ?, ?)",
+            (pid, status, error, self.__now__()))
+        self.pending += 1
+        return self.pending >= self.commit_every
+
+    def mark_collection(self, pid, status):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO frontier (pid, status, updated) "
+            "VALUES (?, ?, ?)",
+            (pid, status, self.__now__()))
+        self.pending += 1
+        return self.pending >= self.commit_every
+
+    def checkpoint(self, output_offset=None):
+        """Method commits the pending marks, with the output's byte offset
+        when given, so a resume can truncate the output to what the
+        committed pids wrote"""
+        if output_offset is not None:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (OUTPUT_OFFSET, str(output_offset)))
+        self.connection.commit()
+        self.pending = 0
+
+    def output_offset(self):
+        """Returns the output byte offset of the last checkpoint or None"""
+        value = self.get_meta(OUTPUT_OFFSET)
+        if value is not None:
+            return int(value)
+
+    def failures(self):
+        """Returns a list of (pid, error) for failed pids"""
+        return self.connection.execute(
+            "SELECT pid, error FROM pids WHERE status=? ORDER BY pid",
+            (FAILED,)).fetchall()
+
+    def counts(self):
+        """Returns a dict of status to number of pids"""
+        return dict(self.connection.execute(
+            "SELECT status, COUNT(*) FROM pids GROUP BY status").fetchall())
+
+    def close(self):
+        self.checkpoint()
+        self.connection.close()
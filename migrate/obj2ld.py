@@ -5,17 +5,72 @@ import datetime
 import io
 import os
 import sys
+import threading
+import time
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # External moudles
 import click
+import lxml.etree
 import rdflib
-import requests 
 from bibcat.ingesters.rels_ext import RELSEXTIngester
 from bibcat.rml.processor import  XMLProcessor
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fedora import FedoraError, get_client, new_session
+from fedora.tree import RepositoryTree
+from migrate.journal import CheckpointJournal, DONE, FAILED, SKIPPED
+from migrate.sinks import GraphSink, NTriplesSink, is_streaming
+
 BF = rdflib.Namespace("http://id.loc.gov/ontologies/bibframe/")
 
+def __echo__(msg, nl=True):
+    try:
+        click.echo(msg, nl=nl)
+    except io.UnsupportedOperation:
+        print(msg, end="\n" if nl else "")
+
+
+class CrawlProgress(object):
+    """Class tracks objects, collections and errors for a crawl and
+    reports throughput at most once every interval seconds"""
+
+    def __init__(self, interval=30):
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = self.start
+        self.objects = 0
+        self.collections = 0
+        self.skipped = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        elapsed = max(time.time() - self.start, 0.001)
+        return "{:,} objects ({:.1f}/s), {:,} collections, {:,} skipped, "\
+               "{:,} errors in {:,.1f} mins".format(
+                   self.objects,
+                   self.objects / elapsed,
+                   self.collections,
+                   self.skipped,
+                   self.errors,
+                   elapsed / 60.0)
+
+    def update(self, objects=0, collections=0, skipped=0, errors=0):
+        with self.lock:
+            self.objects += objects
+            self.collections += collections
+            self.skipped += skipped
+            self.errors += errors
+            now = time.time()
+            if now - self.last_report < self.interval:
+                return
+            self.last_report = now
+        __echo__(str(self))
+
+
 class MetadataMigrator(object):
     """Class creates BIBCAT Library Linked Data from Colorado College's 
     Islandora based Fedora 3.8 environment"""
@@ -35,94 +90,166 @@ class MetadataMigrator(object):
             rdflib.URIRef("http://rightsstatements.org/vocab/InC/1.0/")) 
         self.base_url=config.BASE_URL
         self.rels_processor = RELSEXTIngester(base_url=self.base_url)    
-        self.fedora_ri_search = config.RI_URL
-        self.fedora_auth = config.FEDORA_AUTH
-        self.cc_repo_base = config.REPOSITORY_URL
+        self.fedora = get_client(config)
         # URL Minter for supporting DP.LA project
         self.minter = kwargs.get("minter") 
         self.start_pid = kwargs.get("start_pid", "coccc:root")
         self.repo_graph = rdflib.Graph()
         self.repo_graph.namespace_manager.bind("bf", BF)
+        # Triples go to the sink, harvest swaps in an NTriplesSink when
+        # the output is .nt or .nt.gz
+        self.sink = GraphSink(self.repo_graph)
+        # Fetches run in a bounded thread pool, graph building stays on the
+        # main thread because the RML processors aren't thread-safe.
+        # FEDORA_POOL_SIZE should be at least workers.
+        self.workers = kwargs.get("workers", 8)
+        self.window = kwargs.get("window", self.workers * 4)
+        self.progress = CrawlProgress(kwargs.get("report_interval", 30))
+        self.pool = None
+        # Collection tree from bulk Resource Index queries, loaded in
+        # harvest if not passed in
+        self.tree = kwargs.get("tree")
+        # Optional CheckpointJournal, opened by harvest for streamed output
+        self.journal = kwargs.get("journal")
 
     def __cc_collection__(self,
         pid, 
         rights_stmt=None):
         if rights_stmt is None:
             rights_stmt = self.default_copyright 
-        child_results = requests.post(self.fedora_ri_search,
-            data={"type": "tuples",
-              "lang": "sparql",
-              "format": "json",
-              "query": CHILD_PIDS.format(pid)},
-            auth=self.fedora_auth)
-        if child_results.status_code > 399:
-            raise ValueError("Could not add CC collection")
+        if self.journal is not None and self.journal.is_collection_done(pid):
+            __echo__("Skipping completed collection {}".format(pid))
+            return
+        if self.tree is not None:
+            child_pids = self.tree.children(pid)
+        else:
+            try:
+                child_results = self.fedora.ri_sparql(CHILD_PIDS.format(pid))
+            except FedoraError:
+                raise ValueError("Could not add CC collection")
+            child_pids = [row.get("s").split("/")[-1] for row in child_results]
         collection_iri = rdflib.URIRef("{}pid/{}".format(
             self.base_url, pid))
-        self.repo_graph.add(
+        self.sink.add(
             (collection_iri, 
              rdflib.RDF.type, 
              BF.Collection))
         self.__set_label__(pid, collection_iri)
         count = 0
         start = datetime.datetime.utcnow()
-        start_msg = "Start processing collection {} at {}".format(
-            pid,
-            start)
-        try:
-            click.echo(start_msg)
-        except io.UnsupportedOperation:
-            print(start_msg)
-        for i,child_row in enumerate(child_results.json().get("results")):
-            child_pid = child_row.get("s").split("/")[-1]
-            if self.__cc_is_collection__(child_pid):
-                self.__cc_collection__(child_pid, rights_stmt)
+        __echo__("Start processing collection {} at {}".format(pid, start))
+        if self.journal is not None:
+            # Resumed run, only objects without a done or skipped entry
+            child_pids = [child for child in child_pids
+                          if not self.journal.is_done(child)]
+        sub_collections = []
+        for fetched in self.__crawl__(child_pids):
+            child_pid = fetched.get("pid")
+            if fetched.get("collection"):
+                sub_collections.append(child_pid)
+                continue
+            try:
+                item_iri = self.__cc_pid__(child_pid,
+                    fetched,
+                    rights_stmt=rights_stmt,
+                    collection_iri=collection_iri)
+            except Exception as error:
+                __echo__("Error processing {}: {}".format(child_pid, error))
+                self.__journal__(child_pid, FAILED, repr(error))
+                self.progress.update(errors=1)
                 continue
-            item_iri = self.__cc_pid__(child_pid)
             if item_iri is None:
+                self.__journal__(child_pid, SKIPPED)
+                self.progress.update(skipped=1)
                 continue
-            self.repo_graph.add((item_iri, BF.usageAndAccessPolicy, rights_stmt))
-            instance_iri = self.repo_graph.value(subject=item_iri,
-                predicate=BF.itemOf)
-            work_iri = self.repo_graph.value(subject=instance_iri,
-                predicate=BF.instanceOf)
-            self.repo_graph.add((work_iri, BF.partOf, collection_iri))
-            if not i%5 and i>0:
-                try:
-                    click.echo(".", nl=False)
-                except io.UnsupportedOperation:
-                    print('.', end="")
-            if not i%10:
-                count_msg = "{:,}".format(i)
-                try:
-                    click.echo(count_msg, nl=False)
-                except io.UnsupportedOperation:
-                    print(count_msg, end="")
+            self.__journal__(child_pid, DONE)
             count += 1
+            self.progress.update(objects=1)
+        self.progress.update(collections=1)
         end = datetime.datetime.utcnow()
-        end_msg = """Finished processing at {}
+        __echo__("""Finished processing at {}
 Total {:,} mins, {} objects for PID {}""".format(
-        end,
-        (end-start).seconds / 60.0,
-        count,
-        pid)
-        try:
-            click.echo(end_msg)
-        except io.UnsupportedOperation:
-            print(end_msg) 
+            end,
+            (end-start).seconds / 60.0,
+            count,
+            pid))
+        for child_pid in sub_collections:
+            self.__cc_collection__(child_pid, rights_stmt)
+        if self.journal is not None:
+            # Collection's whole subtree is finished
+            self.journal.mark_collection(pid, DONE)
+            self.__checkpoint__()
 
+    def __checkpoint__(self):
+        """Makes the output durable before committing the journal so every
+        pid recorded as done has its triples on disk, the output's offset
+        is committed with them for resume to truncate to"""
+        self.journal.checkpoint(self.sink.checkpoint())
 
-    def __cc_pid__(self, pid):
-        if self.__cc_is_member__(pid):
+    def __journal__(self, pid, status, error=None):
+        if self.journal is None:
             return
-        mods_url = "{}/objects/{}/datastreams/MODS/content".format(
-            self.cc_repo_base, 
-            pid)
-        mods_result = requests.get(mods_url)
+        if self.journal.mark(pid, status, error):
+            self.__checkpoint__()
+
+    def __crawl__(self, pids):
+        """Generator fetches pids in the thread pool and yields the fetched
+        datastreams in order. No more than window fetches are in flight,
+        a new fetch is only submitted after a result is consumed."""
+        pids = iter(pids)
+        pending = deque()
+        for pid in pids:
+            pending.append((pid, self.pool.submit(self.__fetch_pid__, pid)))
+            if len(pending) >= self.window:
+                break
+        while len(pending) > 0:
+            pid, future = pending.popleft()
+            next_pid = next(pids, None)
+            if next_pid is not None:
+                pending.append(
+                    (next_pid, self.pool.submit(self.__fetch_pid__, next_pid)))
+            try:
+                yield future.result()
+            except Exception as error:
+                __echo__("Error fetching {}: {}".format(pid, error))
+                self.__journal__(pid, FAILED, repr(error))
+                self.progress.update(errors=1)
+
+    def __fetch_pid__(self, pid):
+        """Runs in a worker thread, returns a dict with everything the
+        graph building needs for pid from Fedora and the minter"""
+        output = {"pid": pid}
+        if self.__cc_is_collection__(pid):
+            output["collection"] = True
+            return output
+        if self.tree is not None and self.tree.is_constituent(pid):
+            output["member"] = True
+            return output
+        rels_result = self.fedora.get_datastream(pid, "RELS-EXT")
+        if rels_result.status_code < 399:
+            output["rels_ext"] = rels_result.content
+            if self.tree is None and \
+               self.__cc_is_member__(pid, output["rels_ext"]):
+                output["member"] = True
+                return output
+        mods_result = self.fedora.get_datastream(pid, "MODS")
         if mods_result.status_code > 399:
+            return output
+        output["mods"] = mods_result.text
+        if self.minter:
+            output["item_iri"] = self.minter.item(pid)
+        return output
+
+    def __cc_pid__(self, pid, fetched=None, rights_stmt=None,
+        collection_iri=None):
+        """Builds the object's BIBFRAME graph and writes it to the sink,
+        returns the item IRI or None if the object was skipped"""
+        if fetched is None:
+            fetched = self.__fetch_pid__(pid)
+        if fetched.get("member") or fetched.get("mods") is None:
             return
         if self.minter:
-            item_iri = self.minter.item(pid)
+            item_iri = fetched.get("item_iri")
             if item_iri is None: # Can't reach so don't continue
                 return
             instance_iri = self.minter.instance(item=item_iri, pid=pid)
@@ -131,60 +258,58 @@ Total {:,} mins, {} objects for PID {}""".format(
             item_iri = rdflib.URIRef("{}pid/{}".format(self.base_url, pid))
             instance_iri = rdflib.URIRef("{}#Instance".format(item_iri))
             work_uri = rdflib.URIRef("{}#Work".format(item_iri))
-        mods_xml = mods_result.text
+        mods_xml = fetched.get("mods")
         self.cc_processor.run(mods_xml, 
             instance_iri=instance_iri,
             item_iri=item_iri,
             work_iri=work_uri)
-        self.repo_graph += self.cc_processor.output
-        self.repo_graph.add((item_iri, 
+        self.sink.write(self.cc_processor.output)
+        object_graph = rdflib.Graph()
+        object_graph.add((item_iri, 
                            BF.heldBy, 
                            rdflib.URIRef("https://www.coloradocollege.edu/")))
 
-        self.repo_graph.add((work_uri, rdflib.RDF.type, BF.Work))
-        self.repo_graph.add((instance_iri, BF.instanceOf, work_uri))
-        rels_url = "{}/objects/{}/datastreams/RELS-EXT/content".format(
-            self.cc_repo_base, 
-            pid)
-        rels_result = requests.get(rels_url)
-        self.rels_processor.run(rels_result.text,
-            instance_iri=instance_iri,
-            work_iri=str(work_uri))
-        self.repo_graph += self.rels_processor.output
+        object_graph.add((work_uri, rdflib.RDF.type, BF.Work))
+        object_graph.add((instance_iri, BF.instanceOf, work_uri))
+        if rights_stmt is not None:
+            object_graph.add((item_iri, BF.usageAndAccessPolicy, rights_stmt))
+        if collection_iri is not None:
+            object_graph.add((work_uri, BF.partOf, collection_iri))
+        self.sink.write(object_graph)
+        # Reuses the RELS-EXT fetched for the membership check
+        if fetched.get("rels_ext") is not None:
+            self.rels_processor.run(fetched.get("rels_ext").decode("utf-8"),
+                instance_iri=instance_iri,
+                work_iri=str(work_uri))
+            self.sink.write(self.rels_processor.output)
         return item_iri
 
 
     def __cc_is_collection__(self, pid):
+        if self.tree is not None:
+            return self.tree.is_collection(pid)
         sparql = IS_COLLECTION.format(pid)
-        collection_result = requests.post(self.fedora_ri_search,
-            data={"type": "tuples",
-                "lang": "sparql",
-                "format": "json",
-                "query": sparql},
-            auth=self.fedora_auth)
-        if len(collection_result.json().get('results')) > 0:
+        collection_result = self.fedora.ri_sparql(sparql)
+        if len(collection_result) > 0:
             return True
         return False
 
-    def __cc_is_member__(self, pid):
-        rels_ext_url = "{}{}/datastream/RELS-EXT".format(
-            self.cc_repo_base,
-            pid)
-        rels_ext_result = requests.get(rels_ext_url)
-        if rels_ext_result.status_code < 399:
-            rels_ext_xml = lxml.etree.XML(rels_ext_result.text)
-            is_constituent =  rels_ext_xml.xpath(
-                "rdf:Description/fedora:isConstituentOf",
-                namespaces=self.rels_processor.xml_ns)
-            if len(is_constituent) > 0:
-                return True
+    def __cc_is_member__(self, pid, rels_ext=None):
+        if rels_ext is None:
+            rels_ext_result = self.fedora.get_datastream(pid, "RELS-EXT")
+            if rels_ext_result.status_code > 399:
+                return False
+            rels_ext = rels_ext_result.content
+        rels_ext_xml = lxml.etree.XML(rels_ext)
+        is_constituent =  rels_ext_xml.xpath(
+            "rdf:Description/fedora:isConstituentOf",
+            namespaces=self.rels_processor.xml_ns)
+        if len(is_constituent) > 0:
+            return True
         return False
 
     def __set_label__(self, pid, entity_iri):
-        mods_url = "{}{}/datastream/MODS".format(
-            self.cc_repo_base, 
-            pid)
-        result = requests.get(mods_url)
+        result = self.fedora.get_datastream(pid, "MODS")
         if result.status_code > 399:
             return
         mods_xml = lxml.etree.XML(result.text)
@@ -192,30 +317,79 @@ Total {:,} mins, {} objects for PID {}""".format(
             namespaces=self.cc_processor.xml_ns)
         if title is None:
             return
-        self.repo_graph.add((entity_iri, 
+        self.sink.add((entity_iri, 
             rdflib.RDFS.label, 
             rdflib.Literal(title[0].text, lang="en")))
 
 
-    def harvest(self, output_path=None):
+    def harvest(self, output_path=None, resume=False, journal_path=None):
+        """Method crawls the repository from start_pid. An output_path
+        ending in .nt or .nt.gz streams each object's triples to disk as
+        it is produced and checkpoints progress to a SQLite journal, any
+        other path is serialized as turtle from the in-memory graph at
+        the end.
+
+        Args:
+            output_path -- Output file path
+            resume -- Truncate output_path to the journal's last checkpoint
+                      and continue, skipping pids the journal has as done
+                      and retrying failures, default False
+            journal_path -- Journal path, default is output_path.journal
+        """
         start = datetime.datetime.utcnow()
-        start_msg = "Starting CC Migration to BF Linked Data at {}".format(
-            start)
+        if resume and not is_streaming(output_path):
+            raise ValueError(
+                "Resuming requires a streamed .nt or .nt.gz output_path")
+        if is_streaming(output_path):
+            if self.journal is None:
+                journal_path = journal_path or "{}.journal".format(output_path)
+                if not resume and os.path.exists(journal_path):
+                    # Fresh run truncates the output, so the old journal
+                    # no longer describes it
+                    os.remove(journal_path)
+                self.journal = CheckpointJournal(journal_path)
+            offset = None
+            if resume:
+                offset = self.journal.output_offset()
+                if offset is None and len(self.journal.counts()) > 0:
+                    raise ValueError(
+                        "Journal {} has no output offset to resume "
+                        "from, start a new run".format(self.journal.path))
+                # Anything after the last checkpoint, a partial line or
+                # gzip member and objects the journal never committed, is
+                # truncated and those pids are crawled again
+                __echo__("Resuming with {} from byte {:,}".format(
+                    self.journal.counts(),
+                    offset or 0))
+            self.sink = NTriplesSink(output_path,
+                                     append=resume,
+                                     offset=offset or 0)
+        __echo__("Starting CC Migration to BF Linked Data at {}".format(start))
+        if self.tree is None:
+            self.tree = RepositoryTree(self.fedora).load()
+            __echo__("Loaded collection tree, {:,} collections".format(
+                len(self.tree.members)))
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
         try:
-            click.echo(start_msg)
-        except io.UnsupportedOperation:
-            print(start_msg)
-        self.__cc_collection__(self.start_pid)
-        if output_path:
+            self.__cc_collection__(self.start_pid)
+        finally:
+            self.pool.shutdown()
+            self.pool = None
+            if self.journal is not None:
+                self.__checkpoint__()
+                __echo__("Journal {}, {:,} failed pids".format(
+                    self.journal.path,
+                    len(self.journal.failures())))
+            self.sink.close()
+            if self.journal is not None:
+                self.journal.close()
+        __echo__(str(self.progress))
+        if output_path and not is_streaming(output_path):
             with open(output_path, 'wb+') as fo:
                 fo.write(self.repo_graph.serialize(format='turtle'))
         end = datetime.datetime.utcnow()
-        end_msg = """Finished CC Migration harvest at {}, total time {:,} minutes
-Total number of triples {:,}""".format(end, (end-start).seconds / 60.0, len(self.repo_graph))
-        try:
-            click.echo(end_msg)
-        except io.UnsupportedOperation:
-            print(end_msg)
+        __echo__("""Finished CC Migration harvest at {}, total time {:,} minutes
+Total number of triples {:,}""".format(end, (end-start).seconds / 60.0, len(self.sink)))
         
 
 
@@ -238,11 +412,12 @@ class P2PMinter(object):
     def __init__(self):
         self.base_url = "https://plains2peaks.org/"
         self.islandora_url = "https://digitalcc.coloradocollege.edu/islandora/object/"
+        self.session = new_session()
 
     def item(self, pid):
         # Returns Islandora URL if available
         islandora_pid_url = "{}{}".format(self.islandora_url, pid)
-        test_available = requests.get(islandora_pid_url)
+        test_available = self.session.get(islandora_pid_url)
         if test_available.status_code < 400:
             return rdflib.URIRef(islandora_pid_url)
 
@@ -257,8 +432,15 @@ class P2PMinter(object):
 @click.command()
 @click.option("--minter", prompt="Alternate Minter")
 @click.option("--cc_rules", prompt="Full path to Colorado College RML")
-@click.option("--output_path", prompt="Full path to output turtle file")
-def main(minter=None, cc_rules=[], output_path=None):
+@click.option("--output_path",
+    prompt="Full path to output turtle, or streamed .nt/.nt.gz, file")
+@click.option("--workers", default=8, help="Concurrent Fedora fetches")
+@click.option("--resume", is_flag=True, default=False,
+    help="Resume a streamed run from its checkpoint journal")
+@click.option("--journal", default=None,
+    help="Checkpoint journal path, default is output_path.journal")
+def main(minter=None, cc_rules=[], output_path=None, workers=8, resume=False,
+         journal=None):
     sys.path.append(os.path.abspath(
         os.path.dirname(
             os.path.dirname(__name__))))
@@ -266,14 +448,16 @@ def main(minter=None, cc_rules=[], output_path=None):
     if minter is None:
         migrator = MetadataMigrator(
             config=config,
-            cc_rules=cc_rules)
+            cc_rules=cc_rules,
+            workers=workers)
     elif minter.startswith("plains2peak"):
         minter = P2PMinter()
         migrator = MetadataMigrator(
             config=config,
             cc_rules=cc_rules,
-            minter=minter)
-    migrator.harvest(output_path)
+            minter=minter,
+            workers=workers)
+    migrator.harvest(output_path, resume=resume, journal_path=journal)
     
     
 
@@ -0,0 +1,169 @@
+"""Module provides triple sinks for the BIBFRAME migration, either an
+in-memory rdflib Graph or a streaming N-Triples file"""
+__author__ = "Jeremy Nelson"
+
+import gzip
+import os
+import time
+
+import click
+import rdflib
+
+
+class GraphSink(object):
+    """Class collects triples in an rdflib Graph, memory grows with the
+    size of the repository"""
+
+    def __init__(self, graph=None):
+        if graph is None:
+            graph = rdflib.Graph()
+        self.graph = graph
+
+    def __len__(self):
+        return len(self.graph)
+
+    def add(self, triple):
+        self.graph.add(triple)
+
+    def write(self, graph):
+        for triple in graph:
+            self.graph.add(triple)
+
+    def flush(self):
+        pass
+
+    def checkpoint(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NTriplesSink(object):
+    """Class writes each object's triples to an N-Triples file as soon as
+    they are produced, so peak memory is one object's graph. Paths ending
+    in .gz are gzip compressed, every checkpoint ends a gzip member so the
+    file up to a checkpoint's offset is always a complete gzip file.
+
+    Args:
+        path -- Output file path
+        flush_every -- Flush after this many triples, default is 10,000
+        flush_interval -- Or after this many seconds, default is 30
+        append -- Keep the existing file and write after it
+        offset -- With append, truncate the file to this checkpoint offset
+                  first, dropping anything written after the checkpoint
+    """
+
+    def __init__(self, path, flush_every=10000, flush_interval=30, append=False,
+                 offset=None):
+        self.path = path
+        self.compressed = path.endswith(".gz")
+        if append and os.path.exists(path):
+            self.raw = open(path, "r+b")
+            if offset is not None:
+                self.raw.truncate(offset)
+            self.raw.seek(0, os.SEEK_END)
+        else:
+            self.raw = open(path, "wb")
+        self.output = self.__open__()
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.count = 0
+        self.unflushed = 0
+        self.last_flush = time.time()
+
+    def __open__(self):
+        if self.compressed:
+            return gzip.GzipFile(fileobj=self.raw, mode="wb")
+        return self.raw
+
+    def __len__(self):
+        return self.count
+
+    def add(self, triple):
+        graph = rdflib.Graph()
+        graph.add(triple)
+        self.write(graph)
+
+    def write(self, graph):
+        size = len(graph)
+        if size < 1:
+            return
+        raw = graph.serialize(format="nt")
+        if isinstance(raw, str):
+            raw = raw.encode("utf-8")
+        self.output.write(raw)
+        self.count += size
+        self.unflushed += size
+        if self.unflushed >= self.flush_every or \
+           time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.output.flush()
+        self.unflushed = 0
+        self.last_flush = time.time()
+
+    def checkpoint(self):
+        """Method makes everything written so far durable and returns the
+        file's byte offset, resuming with this offset truncates anything
+        written later, including a partial line or gzip member"""
+        self.flush()
+        if self.compressed:
+            # Closing the GzipFile writes the member's trailer but leaves
+            # the file open
+            self.output.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        offset = self.raw.tell()
+        if self.compressed:
+            self.output = self.__open__()
+        return offset
+
+    def close(self):
+        self.flush()
+        self.output.close()
+        self.raw.close()
+
+
+def is_streaming(path):
+    """Returns True if path is an N-Triples file the migrator should stream"""
+    return path is not None and \
+        (path.endswith(".nt") or path.endswith(".nt.gz"))
+
+def convert(sources, output_path, output_format="turtle"):
+    """Function merges N-Triples exports into a single Graph and
+    serializes it, run offline after the crawl
+
+    Args:
+        sources -- List of N-Triples file paths, .gz files are decompressed
+        output_path -- Output file path
+        output_format -- rdflib serialization format, default is turtle
+    """
+    graph = rdflib.Graph()
+    graph.namespace_manager.bind(
+        "bf",
+        rdflib.Namespace("http://id.loc.gov/ontologies/bibframe/"))
+    for source in sources:
+        opener = gzip.open if source.endswith(".gz") else open
+        with opener(source, "rb") as fo:
+            graph.parse(file=fo, format="nt")
+    with open(output_path, "wb+") as fo:
+        raw = graph.serialize(format=output_format)
+        if isinstance(raw, str):
+            raw = raw.encode("utf-8")
+        fo.write(raw)
+    return len(graph)
+
+
+@click.command()
+@click.argument("sources", nargs=-1, required=True)
+@click.option("--output_path", prompt="Full path to output file")
+@click.option("--output_format", default="turtle")
+def main(sources, output_path, output_format):
+    total = convert(sources, output_path, output_format)
+    click.echo("Wrote {:,} triples to {}".format(total, output_path))
+
+
+if __name__ == "__main__":
+    main()
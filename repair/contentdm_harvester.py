@@ -1,18 +1,20 @@
 __author__ = "Jeremy Nelson, Sarah Bogard"
 
+import click
 import csv
 import datetime
+import json
 import logging
 import mimetypes
 import os
 import re
-import requests
 import rdflib
 import sys
-import urllib.parse
+import threading
 import warnings
 import xml.etree.ElementTree as etree
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search, Q
 from jinja2 import Template
@@ -21,6 +23,8 @@ from jinja2 import Template
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(BASE_DIR)
 from instance import conf as CONF
+from fedora import FedoraError, get_client, new_session, spool_response
+from repair.pipeline import Pipeline, Stage
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 
@@ -36,14 +40,30 @@ with open(os.path.join(BASE_DIR, "repair", "rels-ext.xml")) as fo:
     RELS_EXT_TEMPLATE = Template(fo.read())
 
 
+# Stands in for the new pid in staged RELS-EXT and GEO_LD, replaced by
+# the loader once Fedora has minted the object
+STAGED_PID = "__STAGED_PID__"
+
 GET_FILE_URL = "http://cdm16304.contentdm.oclc.org/utils/getfile/collection/"
 
-EXISTING_SPARQL = """SELECT DISTINCT ?s
+EXISTING_SPARQL = """SELECT DISTINCT ?s ?creator
 WHERE {{
-  ?s <dc:title> "{0}" 
+  ?s <dc:title> {0} .
+  OPTIONAL {{ ?s <dc:creator> ?creator }}
 }}
 """
 
+# ORDER BY keeps LIMIT/OFFSET pages stable
+COLLECTION_TITLES_SPARQL = """SELECT ?s ?title ?creator
+WHERE {{
+  ?s <fedora-rels-ext:isMemberOfCollection> <info:fedora/{pid}> .
+  ?s <dc:title> ?title .
+  OPTIONAL {{ ?s <dc:creator> ?creator }}
+}}
+ORDER BY ?s ?title ?creator
+LIMIT {limit}
+OFFSET {offset}"""
+
 GEOSCIML_BASIC = rdflib.Namespace("http://xmlns.geosciml.org/GeoSciML-Basic/4.0/")
 GEOSCIML_EXT = rdflib.Namespace("http://xmlns.geosciml.org/GeoSciML-Extension/4.0/")
 GEOSCIML_PORTRAYAL = rdflib.Namespace("http://xmlns.geosciml.org/geosciml-portrayal/4.0/")
@@ -51,21 +71,19 @@ GEOCONTAT_TYPE = rdflib.Namespace("http://resource.geosciml.org/classifierscheme
 GEOSTR_RANK = rdflib.Namespace("http://resource.geosciml.org/classifier/cgi/stratigraphicrank/")
 SCHEMA_ORG = rdflib.Namespace("https://schema.org/")
 
-def _add_datastream(pid, raw_datastream, ident, label, mime_type):
-    add_file_url = "{}{}/datastreams/{}?{}".format(
-        CONF.REST_URL,
+def _add_datastream(pid, raw_datastream, ident, label, mime_type,
+                    checksum_type=None, checksum=None):
+    repo_add_result = get_client(CONF).add_datastream(
         pid,
         ident,
-        urllib.parse.urlencode({"controlGroup": "M",
-               "dsLabel": label,
-               "mimeType": mime_type}))
-    repo_add_result = requests.post(
-         add_file_url,
-         files={"content": raw_datastream},
-         auth=CONF.FEDORA_AUTH)
+        raw_datastream,
+        label,
+        mime_type,
+        checksum_type=checksum_type,
+        checksum=checksum)
     if repo_add_result.status_code > 399:
         print("Error {} with {}".format(
-            repo_add_result.status_code, add_file_url))
+            repo_add_result.status_code, repo_add_result.url))
         return False
     return True
 
@@ -82,32 +100,109 @@ def _add_rels_ext(pid, collection_pid, content_model):
          "application/rdf+xml")
      
     
-def _check_existing(title, creator):
+def _sparql_literal(value):
+    """Returns value as a quoted SPARQL string literal"""
+    value = value.replace("\\", "\\\\").replace('"', '\\"')
+    value = value.replace("\n", "\\n").replace("\r", "\\r")
+    return '"{}"'.format(value)
+
+def _normalize(value):
+    if value is None:
+        return
+    value = " ".join(value.split())
+    if len(value) > 0:
+        return value
+
+
+class TitleIndex(object):
+    """Class holds an in-memory title to PID and creator map of a
+    collection, loaded with a few paged Resource Index queries, so
+    duplicate checks are dictionary lookups instead of one SPARQL query
+    per CSV row.
+
+    Args:
+        fedora -- FedoraClient
+        collection_pid -- PID of the collection to index
+        page_size -- Rows per Resource Index query, default is 10,000
+    """
+
+    def __init__(self, fedora, collection_pid, page_size=10000):
+        self.fedora = fedora
+        self.collection_pid = collection_pid
+        self.page_size = page_size
+        self.titles = dict()
+        self.lock = threading.Lock()
+
+    def load(self):
+        offset = 0
+        while True:
+            rows = self.fedora.ri_sparql(
+                COLLECTION_TITLES_SPARQL.format(
+                    pid=self.collection_pid,
+                    limit=self.page_size,
+                    offset=offset))
+            for row in rows:
+                self.add(row.get("s").split("/")[-1],
+                         row.get("title"),
+                         row.get("creator"))
+            if len(rows) < self.page_size:
+                break
+            offset += self.page_size
+        return self
+
+    def add(self, pid, title, creator=None):
+        """Method adds an object, the harvester adds each object it creates
+        so duplicates within the same CSV are found too"""
+        title = _normalize(title)
+        if title is None:
+            return
+        with self.lock:
+            creators = self.titles.setdefault(title, dict()).setdefault(
+                pid, set())
+            creator = _normalize(creator)
+            if creator is not None:
+                creators.add(creator)
+
+    def lookup(self, title, creator=None):
+        """Method returns the PID of the single object with an exact title
+        match, and the creator if given, or None"""
+        candidates = self.titles.get(_normalize(title), dict())
+        creator = _normalize(creator)
+        if creator is not None:
+            candidates = dict((pid, creators)
+                              for pid, creators in candidates.items()
+                              if creator in creators)
+        if len(candidates) == 1:
+            return list(candidates)[0]
+
+    def __len__(self):
+        return len(self.titles)
+
+
+def _check_existing(title, creator, index=None):
     """Internal function takes a title and creator and searches Repository 
     for exact match on title and creator
 
     Args:
         title: Title string
         creator: Creator string
+        index: Optional TitleIndex, otherwise the Resource Index is queried
     Returns:
         PID of exact match 
     """
-    sparql = EXISTING_SPARQL.format(title)
-    existing_response = requests.post(
-        CONF.RI_URL,
-        data={"type": "tuples",
-              "lang": "sparql",
-               "format": "json",
-               "query": sparql},
-            auth=CONF.FEDORA_AUTH)
-    if existing_response.status_code > 399:
+    if index is not None:
+        return index.lookup(title, creator)
+    if _normalize(title) is None:
+        return
+    sparql = EXISTING_SPARQL.format(_sparql_literal(title))
+    try:
+        rows = get_client(CONF).ri_sparql(sparql)
+    except FedoraError:
         return
-        print("Error with {}\nSPARQL\n{}".format(title, sparql))
-        raise ValueError(existing_response.status_code,
-                         existing_response.text)
-    existing_pids = existing_response.json().get('results')
-    if len(existing_pids) == 1:
-        return existing_pids[0].get('s').split("/")[-1]
+    index = TitleIndex(None, None)
+    for row in rows:
+        index.add(row.get('s').split("/")[-1], title, row.get('creator'))
+    return index.lookup(title, creator)
     
 
 def _convert_date(date_str):
@@ -116,63 +211,388 @@ def _convert_date(date_str):
     
 
 class Harvester(object):
+    """Base class for CONTENTdm ingests. Subclasses implement
+    __transform__, turning a CSV row into a record plan, and the harvest
+    runs plans through a staged pipeline with separately sized pools for
+    fetching from CONTENTdm, creating Fedora objects and uploading
+    datastreams.
+
+    Args:
+        filepath -- Tab-delimited CONTENTdm export, None when only loading
+                    a staging package
+        collection_pid -- PID of the Fedora collection
+        conf -- Instance configuration, worker and queue sizes are read
+                from HARVEST_FETCH_WORKERS, HARVEST_CREATE_WORKERS,
+                HARVEST_UPLOAD_WORKERS, HARVEST_PAGE_WORKERS and
+                HARVEST_QUEUE_SIZE. Downloads larger than
+                HARVEST_SPOOL_BYTES are spooled to disk and checksummed
+                with HARVEST_CHECKSUM_TYPE. stage() uses
+                HARVEST_STAGE_PROCESSES, default is the number of CPUs
+    """
 
     def __init__(self, filepath, collection_pid, conf=CONF):
-        reader = csv.DictReader(
-	    open(filepath, errors='ignore'),
-	    dialect='excel-tab')
+        self.records = []
+        if filepath is not None:
+            reader = csv.DictReader(
+                open(filepath, errors='ignore'),
+                dialect='excel-tab')
+            self.records = [r for r in reader]
         self.collection_pid = collection_pid
-        self.records = [r for r in reader]
         self.existing_pids = []
         self.conf = conf 
+        self.fedora = get_client(conf)
+        self.title_index = None
+        self.lock = threading.Lock()
+        self.fetch_workers = getattr(conf, "HARVEST_FETCH_WORKERS", 4)
+        self.create_workers = getattr(conf, "HARVEST_CREATE_WORKERS", 2)
+        self.upload_workers = getattr(conf, "HARVEST_UPLOAD_WORKERS", 4)
+        self.page_workers = getattr(conf, "HARVEST_PAGE_WORKERS", 4)
+        self.queue_size = getattr(conf, "HARVEST_QUEUE_SIZE", 16)
+        self.spool_bytes = getattr(conf, "HARVEST_SPOOL_BYTES", 8*1024*1024)
+        self.checksum_type = getattr(conf, "HARVEST_CHECKSUM_TYPE", "MD5")
+        self.stage_processes = getattr(conf, "HARVEST_STAGE_PROCESSES", None)
+        # Staging transforms never contact Fedora
+        self.offline = False
+        # Pooled keep-alive session for CONTENTdm downloads, sized for
+        # the fetch workers plus their parallel page fetches
+        self.contentdm = new_session(
+            pool_size=self.fetch_workers + self.page_workers)
+
+    def __getstate__(self):
+        """Drops the CSV rows, clients, pools and locks so the harvester
+        can be sent to staging worker processes"""
+        state = self.__dict__.copy()
+        for name in ["conf", "contentdm", "fedora", "lock", "page_pool",
+                     "records", "title_index"]:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.records = []
+        self.conf, self.fedora, self.contentdm = None, None, None
+        self.title_index = None
+        self.lock = threading.Lock()
 
     def __new_fedora_object__(self, label):
-        new_pid_result = requests.post(
-            "{}new?namespace={}".format(
-                self.conf.REST_URL,
-                "coccc"),
-            auth=self.conf.FEDORA_AUTH) 
-        if new_pid_result.status_code > 399:
+        return self.fedora.new_object(label, namespace="coccc")
+
+    def __check_existing__(self, title, creator=None):
+        """Method returns the PID of an existing object in the collection
+        with the same title and creator, loading the title index once"""
+        if self.offline:
+            # Checked by the loader instead
             return
-        new_pid = new_pid_result.text
-        modify_obj_url = "{}{}?{}".format(
-            self.conf.REST_URL,
-            new_pid,
-            urllib.parse.urlencode(
-                {"label": label,
-                 "ownerID": CONF.FEDORA_AUTH[0],
-                 "state": 'A'}))
-        repo_modify_obj_result = requests.put(
-            modify_obj_url,
-            auth=self.conf.FEDORA_AUTH)
-        return new_pid
-       
+        with self.lock:
+            if self.title_index is None:
+                self.title_index = TitleIndex(
+                    self.fedora,
+                    self.collection_pid).load()
+        return _check_existing(title, creator, self.title_index)
 
-    def harvest(self):
+    def __transform__(self, row):
+        """Method returns a record plan for a CSV row or None to skip it.
+        A plan is a dict with the object's title and an ordered list of
+        datastreams, each a dict with dsid, label, mime_type and either
+        content, a callable taking the new pid, or a url to download.
+
+        Args:
+            row -- CSV row dict
+        """
+        raise NotImplementedError
+
+    def __get__(self, url):
+        result = self.contentdm.get(url)
+        if result.status_code > 399:
+            print("Failed to get {}".format(url))
+            return
+        return result.content
+
+    def __download__(self, url):
+        """Method streams a CONTENTdm file into memory or a spool file,
+        returning the content and its checksum or (None, None)"""
+        result = self.contentdm.get(url, stream=True)
+        if result.status_code > 399:
+            result.close()
+            print("Failed to get {}".format(url))
+            return None, None
+        return spool_response(
+            result,
+            max_memory=self.spool_bytes,
+            checksum_type=self.checksum_type)
+
+    def __fetch__(self, job):
+        """Fetch stage, builds the row's plan and downloads its files"""
+        index, row = job
+        plan = self.__transform__(row)
+        if plan is None:
+            return
+        plan["index"] = index
+        return self.__fetch_files__(plan)
+
+    def __fetch_files__(self, plan):
+        for datastream in plan["datastreams"]:
+            if "url" in datastream:
+                datastream["content"], datastream["checksum"] = \
+                    self.__download__(datastream["url"])
+        return plan
+
+    def __create__(self, plan):
+        """Create stage, mints the new Fedora object"""
+        new_pid = self.__new_fedora_object__(plan["title"])
+        if new_pid is None:
+            raise FedoraError(500, "Could not create {}".format(plan["title"]))
+        plan["pid"] = new_pid
+        if self.title_index is not None:
+            self.title_index.add(new_pid, plan["title"], plan.get("creator"))
+        return plan
+
+    def __upload__(self, plan):
+        """Upload stage, adds the plan's datastreams in order"""
+        new_pid = plan["pid"]
+        try:
+            for datastream in plan["datastreams"]:
+                content = datastream.get("content")
+                if callable(content):
+                    content = content(new_pid)
+                if content is None:
+                    continue
+                checksum = datastream.get("checksum")
+                added = _add_datastream(
+                    new_pid,
+                    content,
+                    datastream["dsid"],
+                    datastream["label"],
+                    datastream["mime_type"],
+                    checksum_type=self.checksum_type if checksum else None,
+                    checksum=checksum)
+                if not added:
+                    # HTTP error or checksum mismatch, the pipeline's
+                    # on_error records it
+                    raise FedoraError(500, "Could not add {} to {}".format(
+                        datastream["dsid"],
+                        new_pid))
+        finally:
+            # Removes any spooled downloads
+            for datastream in plan["datastreams"]:
+                if hasattr(datastream.get("content"), "close"):
+                    datastream["content"].close()
+        return plan
+
+    def __stage_record__(self, job):
+        """Runs in a staging worker process, transforms a row and writes
+        its metadata datastreams under staging_dir/records, returning the
+        row's manifest entry"""
+        index, row, staging_dir = job
+        try:
+            plan = self.__transform__(row)
+        except Exception as error:
+            return {"index": index, "error": repr(error)}
+        if plan is None:
+            return {"index": index, "skipped": True}
+        entry = dict((key, value) for key, value in plan.items()
+                     if key != "datastreams")
+        entry["index"] = index
+        entry["datastreams"] = []
+        record_dir = os.path.join("records", "{:06d}".format(index))
+        os.makedirs(os.path.join(staging_dir, record_dir), exist_ok=True)
+        for datastream in plan["datastreams"]:
+            staged = dict((key, value) for key, value in datastream.items()
+                          if key != "content")
+            if "url" not in datastream:
+                content = datastream.get("content")
+                if callable(content):
+                    content = content(STAGED_PID)
+                    staged["pid_template"] = True
+                if content is None:
+                    continue
+                if isinstance(content, str):
+                    content = content.encode("utf-8")
+                staged["path"] = os.path.join(record_dir, datastream["dsid"])
+                with open(os.path.join(staging_dir, staged["path"]), "wb+") as fo:
+                    fo.write(content)
+            entry["datastreams"].append(staged)
+        return entry
+
+    def stage(self, staging_dir, processes=None):
+        """Method transforms every CSV row into a staging package with a
+        process pool, no Fedora or CONTENTdm calls are made. The package
+        has per-record MODS, RELS-EXT and GEO_LD files, manifest.jsonl with
+        one entry per record, errors.jsonl for rows that failed and
+        package.json describing the run.
+
+        Args:
+            staging_dir -- Directory for the staging package
+            processes -- Worker processes, default HARVEST_STAGE_PROCESSES
+        """
+        start = datetime.datetime.utcnow()
+        os.makedirs(staging_dir, exist_ok=True)
+        self.offline = True
+        counts = {"staged": 0, "skipped": 0, "errors": 0}
+        jobs = ((i, row, staging_dir) for i, row in enumerate(self.records))
+        try:
+            with ProcessPoolExecutor(
+                max_workers=processes or self.stage_processes) as executor, \
+                open(os.path.join(staging_dir, "manifest.jsonl"), "w+") as manifest, \
+                open(os.path.join(staging_dir, "errors.jsonl"), "w+") as errors:
+                for entry in executor.map(self.__stage_record__,
+                                          jobs,
+                                          chunksize=16):
+                    if "error" in entry:
+                        counts["errors"] += 1
+                        errors.write("{}\n".format(json.dumps(entry)))
+                    elif entry.get("skipped"):
+                        counts["skipped"] += 1
+                    else:
+                        counts["staged"] += 1
+                        manifest.write("{}\n".format(json.dumps(entry)))
+        finally:
+            self.offline = False
+        end = datetime.datetime.utcnow()
+        seconds = max((end-start).total_seconds(), 0.001)
+        with open(os.path.join(staging_dir, "package.json"), "w+") as fo:
+            json.dump({"harvester": self.__class__.__name__,
+                       "collection_pid": self.collection_pid,
+                       "created": end.isoformat(),
+                       "counts": counts},
+                      fo,
+                      indent=2)
+        print("transform: {:,} rows, {:,} staged, {:,} skipped, {:,} errors, "
+              "{:.1f} rows/s".format(
+                  len(self.records),
+                  counts["staged"],
+                  counts["skipped"],
+                  counts["errors"],
+                  len(self.records)/seconds))
+        return counts
+
+    def __fetch_staged__(self, job):
+        """Loader fetch stage, checks for an existing object then builds
+        the plan from a manifest entry and downloads its files"""
+        staging_dir, entry = job
+        existing_ = self.__check_existing__(
+            entry["title"],
+            entry.get("creator"))
+        if existing_ is not None:
+            self.existing_pids.append(existing_)
+            if entry.get("unique"):
+                return
+        plan = dict(entry)
+        plan["datastreams"] = []
+        for staged in entry["datastreams"]:
+            datastream = dict(staged)
+            if "path" in staged:
+                with open(os.path.join(staging_dir, staged["path"]), "rb") as fo:
+                    content = fo.read()
+                if staged.get("pid_template"):
+                    content = lambda pid, raw=content: raw.replace(
+                        STAGED_PID.encode(), pid.encode())
+                datastream["content"] = content
+            plan["datastreams"].append(datastream)
+        return self.__fetch_files__(plan)
+
+    def load(self, staging_dir):
+        """Method pushes a staging package to Fedora through the fetch,
+        create and upload pipeline
+
+        Args:
+            staging_dir -- Directory written by stage()
+        """
+        with open(os.path.join(staging_dir, "package.json")) as fo:
+            package = json.load(fo)
+        if package.get("collection_pid") != self.collection_pid:
+            raise ValueError("{} was staged for collection {}".format(
+                staging_dir,
+                package.get("collection_pid")))
+        def __entries__():
+            with open(os.path.join(staging_dir, "manifest.jsonl")) as fo:
+                for line in fo:
+                    if len(line.strip()) > 0:
+                        yield staging_dir, json.loads(line)
+        return self.__run__(
+            Stage("fetch", self.__fetch_staged__, self.fetch_workers),
+            __entries__(),
+            package.get("counts", {}).get("staged"))
+
+    def __process_record__(self, row):
+        """Runs a single row through every stage in the calling thread"""
+        plan = self.__fetch__((0, row))
+        if plan is not None:
+            return self.__upload__(self.__create__(plan))
+
+    def __on_error__(self, stage, item, error):
+        if isinstance(item, tuple):
+            index = item[0]
+            if isinstance(index, str):
+                # Staged entry
+                index = item[1].get("index")
+        else:
+            index = item.get("index")
+        print("Error {} in {} with {}".format(error, stage.name, index))
+
+    def __progress__(self, plan, completed):
+        if not completed%10:
+            print(".", end="", flush=True)
+        if not completed%100:
+            print(" {} ".format(completed), end="", flush=True)
+
+    def __run__(self, fetch_stage, jobs, total):
         start = datetime.datetime.utcnow()
         warnings.filterwarnings("ignore")
         print("Starting {} Harvester at {} for {} records".format(
-            Harvester.__name__,
+            self.__class__.__name__,
             start,
-            len(self.records)))  
-        for i, row in enumerate(self.records):
-            try:
-                self.__process_record__(row)
-            except:
-                print("Error {} with {}".format(sys.exc_info()[0], i))
-            if not i%10 and i > 0:
-                print(".", end="")
-            if not i%100:
-                print(" {} ".format(i), end="")
+            total))
+        self.__check_existing__(None)
+        print("Loaded {:,} existing titles for {}".format(
+            len(self.title_index),
+            self.collection_pid))
+        pipeline = Pipeline(
+            [fetch_stage,
+             Stage("create", self.__create__, self.create_workers),
+             Stage("upload", self.__upload__, self.upload_workers)],
+            queue_size=self.queue_size,
+            on_error=self.__on_error__)
+        completed = pipeline.run(jobs, self.__progress__)
         end = datetime.datetime.utcnow()
         print("Total {} finished at {} total = {} seconds".format(
-            i, 
+            completed,
             end, 
             (end-start).seconds))     
+        print(pipeline.report())
+        return completed
+
+    def harvest(self):
+        return self.__run__(
+            Stage("fetch", self.__fetch__, self.fetch_workers),
+            enumerate(self.records),
+            len(self.records))
+
+
+def _rels_ext_datastream(collection_pid, content_model):
+    """Returns a plan datastream rendering RELS-EXT once the pid is known"""
+    return {"dsid": "RELS-EXT",
+            "label": "RDF Statements about this Object",
+            "mime_type": "application/rdf+xml",
+            "content": lambda pid: RELS_EXT_TEMPLATE.render(
+                object_pid=pid,
+                collection_pid=collection_pid,
+                content_model=content_model)}
+
+def _mods_datastream(mods_xml):
+    return {"dsid": "MODS",
+            "label": "Metadata Object Description Schema",
+            "mime_type": "text/xml",
+            "content": mods_xml}
 
 
 class GeologyThinSlices(Harvester):
 
+    def __init__(self, filepath, collection_pid, conf=CONF):
+        super(GeologyThinSlices, self).__init__(filepath, collection_pid, conf)
+        # Shared by the fetch workers for compound object pages
+        self.page_pool = ThreadPoolExecutor(max_workers=self.page_workers)
+
     def __geo_linked_data__(self, pid, row):
         geo_subject = rdflib.URIRef(
             "https://digitalcc.coloradocollege.edu/pid/{}".format(pid))
@@ -283,9 +703,9 @@ class GeologyThinSlices(Harvester):
         return output 
 
 
-    def __process_record__(self, row):
+    def __transform__(self, row):
         title = row.get("Thin Section ID")
-        existing_ = _check_existing(title, None)
+        existing_ = self.__check_existing__(title)
         if existing_ is not None:
             self.existing_pids.append(existing_)
         ref_url = row.get('Reference URL')
@@ -293,18 +713,7 @@ class GeologyThinSlices(Harvester):
         if filename.endswith('jpg'):
             # Skip processing record should card
             return
-        new_pid = self.__new_fedora_object__(title)
-        _add_rels_ext(
-            new_pid,  
-            self.collection_pid,
-            "islandora:sp_large_image_cmodel")
-        ld_result = self.__geo_linked_data__(new_pid, row)
-        _add_datastream(
-            new_pid,
-            ld_result.get('graph-rdf'),
-            "GEO_LD",
-            "Geology Linked Data",
-            "application/rdf+xml")
+        ld_result = self.__geo_linked_data__(None, row)
         mods_xml = MODS_TEMPLATE.render(
             abstract=ld_result.get('abstract', None),
             names=ld_result.get('names', []),
@@ -315,21 +724,42 @@ class GeologyThinSlices(Harvester):
             date_captured=row.get('Year Collected', None),
             date_created=row.get('Date created'),
             title=title)
-        _add_datastream(
-            new_pid,
-            mods_xml,
-            "MODS",
-            "Metadata Object Description Schema",
-            "text/xml")
         collection_frag = ref_url.split("collection/")[-1]
-        page_collection = collection_frag.split("id/")[0]
-        postcard_url = "{}{}/filename/{}".format(GET_FILE_URL, 
-            collection_frag,
-            filename)
-        postcard_result = requests.get(postcard_url)
-        raw_postcard = postcard_result.content
+        return {
+            "title": title,
+            "datastreams": [
+                _rels_ext_datastream(
+                    self.collection_pid,
+                    "islandora:sp_large_image_cmodel"),
+                # GEO_LD subject is the new pid, rendered at upload
+                {"dsid": "GEO_LD",
+                 "label": "Geology Linked Data",
+                 "mime_type": "application/rdf+xml",
+                 "content": lambda pid: self.__geo_linked_data__(
+                     pid, row).get('graph-rdf')},
+                _mods_datastream(mods_xml)],
+            "postcard_url": "{}{}/filename/{}".format(GET_FILE_URL,
+                collection_frag,
+                filename),
+            "page_collection": collection_frag.split("id/")[0]}
+
+    def __fetch_files__(self, plan):
+        plan = super(GeologyThinSlices, self).__fetch_files__(plan)
+        plan["datastreams"].extend(
+            self.__fetch_pages__(
+                plan.pop("postcard_url"),
+                plan.pop("page_collection")))
+        return plan
+
+    def __fetch_pages__(self, postcard_url, page_collection):
+        """Method reads the compound object's postcard XML and downloads
+        its pages in parallel, returning OBJ, OBJ1, ... datastreams"""
+        raw_postcard = self.__get__(postcard_url)
+        if raw_postcard is None:
+            return []
         postcard = etree.XML(raw_postcard)
         pages = postcard.findall("page")
+        datastreams = []
         for i, page in enumerate(pages):
             obj_id = "OBJ"
             if i > 0:
@@ -338,40 +768,37 @@ class GeologyThinSlices(Harvester):
             page_img = pagefile.text
             title = page.find('pagetitle')
             page_id = page_img.split(".")[0]
-            file_url = "{}{}id/{}/filename/{}".format(
-                GET_FILE_URL,
-                page_collection,
-                page_id,
-                page_img)
-            raw_request = requests.get(file_url)
-            if raw_request.status_code > 399:
-                print("Failed to get {}".format(file_url))
-                continue
-            raw_file = raw_request.content
-            _add_datastream(
-                new_pid, 
-                raw_file, 
-                obj_id,
-                "{}-{}".format(title.text,
-                              page_img), 
-                mimetypes.guess_type(page_img)[0])
+            datastreams.append(
+                {"dsid": obj_id,
+                 "label": "{}-{}".format(title.text, page_img),
+                 "mime_type": mimetypes.guess_type(page_img)[0],
+                 "url": "{}{}id/{}/filename/{}".format(
+                     GET_FILE_URL,
+                     page_collection,
+                     page_id,
+                     page_img)})
+        contents = self.page_pool.map(
+            self.__download__,
+            [datastream["url"] for datastream in datastreams])
+        for datastream, download in zip(datastreams, contents):
+            datastream["content"], datastream["checksum"] = download
+        return datastreams
  
               
 
           
 class GypsyAmes(Harvester):
 
-    def __process_record__(self, row):
+    def __transform__(self, row):
         title = row.get('Title')
         creator=row.get("Creator")
         ref_url = row.get('Reference URL')
-        existing_ = _check_existing(title, creator)
+        existing_ = self.__check_existing__(title, creator)
         if existing_ is not None:
             self.existing_pids.append(
                 {"ref-url": ref_url,
                  "pid": existing_})
             return
-        new_pid = self.__new_fedora_object__(title)
         collection_frag = ref_url.split("collection/")[-1]
         filename = row.get('CONTENTdm file name')
         mods_xml = MODS_TEMPLATE.render(
@@ -381,27 +808,24 @@ class GypsyAmes(Harvester):
             department="Theatre and Dance Department",
             title=title,
             type_of_resource=row.get('Type'))
-        _add_datastream(
-            new_pid,
-            mods_xml,
-            "MODS",
-            "Metadata Object Description Schema",
-            "text/xml")
         file_url = "{}{}/filename/{}".format(GET_FILE_URL, 
             collection_frag,
             filename)
-        raw_file = requests.get(file_url).content
-        _add_datastream(
-            new_pid, 
-            raw_file, 
-            "OBJ",
-            "{}{}".format(row.get('Local Identifier'),
-                          filename), 
-            mimetypes.guess_type(file_url)[0])
-        _add_rels_ext(
-            new_pid,  
-            self.collection_pid,
-            "islandora:sp_large_image_cmodel")
+        return {
+            "title": title,
+            "creator": creator,
+            # Existing objects are skipped, not duplicated
+            "unique": True,
+            "datastreams": [
+                _mods_datastream(mods_xml),
+                {"dsid": "OBJ",
+                 "label": "{}{}".format(row.get('Local Identifier'),
+                                        filename),
+                 "mime_type": mimetypes.guess_type(file_url)[0],
+                 "url": file_url},
+                _rels_ext_datastream(
+                    self.collection_pid,
+                    "islandora:sp_large_image_cmodel")]}
 
    
  
@@ -588,7 +1012,7 @@ class IDEASMerged(Harvester):
         return topics
         
 
-    def __process_record__(self, row):
+    def __transform__(self, row):
         abstract = None
         title = row.get('Title')
         names, notes = self.__handle_creator__(row)
@@ -631,15 +1055,6 @@ class IDEASMerged(Harvester):
             title=title,
             type_of_resource=type_of_resource)
         etree.XML(mods_xml) # Parse to insure valid MODS
-        # First create new fedora obj
-        new_pid = self.__new_fedora_object__(title)
-        # Add MODS
-        _add_datastream(
-            new_pid,
-            mods_xml,
-            "MODS",
-            "Metadata Object Description Schema",
-            "text/xml")
         content_model = "islandora:sp_large_image_cmodel"
         if type_of_resource.startswith('sound recording'):
             content_model = "islandora:sp-audioCModel"
@@ -647,25 +1062,64 @@ class IDEASMerged(Harvester):
             content_model = "islandora:sp_videoCModel"
         if type_of_resource.startswith("text"):
             content_model = "islandora:sp_document"
-        # Add RELS-EXT datastream
-        _add_rels_ext(
-            new_pid,  
-            self.collection_pid,
-            "islandora:sp_large_image_cmodel")
         filename = row.get("CONTENTdm file name")
         collection_frag = ref_url.split("collection/")[-1]
         file_url = "{}{}/filename/{}".format(GET_FILE_URL, 
             collection_frag,
             filename)
-        file_result = requests.get(file_url)
-        raw_file = file_result.content
-        # Add Object
-        _add_datastream(
-            new_pid, 
-            raw_file, 
-            "OBJ",
-            filename,               
-            mimetypes.guess_type(file_url)[0])
+        return {
+            "title": title,
+            "datastreams": [
+                _mods_datastream(mods_xml),
+                _rels_ext_datastream(
+                    self.collection_pid,
+                    "islandora:sp_large_image_cmodel"),
+                {"dsid": "OBJ",
+                 "label": filename,
+                 "mime_type": mimetypes.guess_type(file_url)[0],
+                 "url": file_url}]}
+
+HARVESTERS = {"GeologyThinSlices": GeologyThinSlices,
+              "GypsyAmes": GypsyAmes,
+              "IDEASMerged": IDEASMerged}
+
+harvester_option = click.option(
+    "--harvester",
+    type=click.Choice(sorted(HARVESTERS)),
+    required=True)
+
+@click.group()
+def main():
+    pass
+
+@main.command()
+@harvester_option
+@click.argument("filepath")
+@click.argument("collection_pid")
+def harvest(harvester, filepath, collection_pid):
+    """Transforms and loads a CONTENTdm export in one run"""
+    HARVESTERS[harvester](filepath, collection_pid).harvest()
+
+@main.command()
+@harvester_option
+@click.option("--processes", default=None, type=int)
+@click.argument("filepath")
+@click.argument("collection_pid")
+@click.argument("staging_dir")
+def stage(harvester, processes, filepath, collection_pid, staging_dir):
+    """Dry run, transforms a CONTENTdm export into a staging package"""
+    HARVESTERS[harvester](filepath, collection_pid).stage(
+        staging_dir,
+        processes=processes)
+
+@main.command()
+@harvester_option
+@click.argument("collection_pid")
+@click.argument("staging_dir")
+def load(harvester, collection_pid, staging_dir):
+    """Loads a staging package into Fedora"""
+    HARVESTERS[harvester](None, collection_pid).load(staging_dir)
+
 
 if __name__ == "__main__":
-    harvest()
+    main()
@@ -0,0 +1,157 @@
+"""Module provides a staged, threaded pipeline for the CONTENTdm ingests
+so downloads, object creation and datastream uploads overlap instead of
+running one row at a time"""
+__author__ = "Jeremy Nelson"
+
+import queue
+import threading
+import time
+
+__stop__ = object()
+
+
+class Stage(object):
+    """Class describes one step of a Pipeline
+
+    Args:
+        name -- Stage name used in error messages
+        func -- Callable taking an item and returning the item for the next
+                stage, or None to drop it
+        workers -- Number of worker threads, default is 1
+    """
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+
+
+class Pipeline(object):
+    """Class runs items through a list of Stages. Every stage has its own
+    worker threads and a bounded input queue, so a slow stage applies back
+    pressure to the ones before it and at most queue_size items are held
+    between any two stages.
+
+    Args:
+        stages -- List of Stage
+        queue_size -- Max items waiting in front of each stage, default 16
+        on_error -- Callable(stage, item, error), default prints the error
+    """
+
+    def __init__(self, stages, queue_size=16, on_error=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error or self.__print_error__
+        self.completed = 0
+        self.lock = threading.Lock()
+        self.started = None
+        self.stats = dict((stage.name, {"items": 0,
+                                        "errors": 0,
+                                        "callback_errors": 0,
+                                        "busy": 0.0,
+                                        "elapsed": 0.0})
+                          for stage in stages)
+
+    def __print_error__(self, stage, item, error):
+        print("Error {} in {} with {}".format(error, stage.name, item))
+
+    def __callback__(self, stage, callback, *args):
+        """Calls on_error or on_complete, counting and printing anything
+        it raises so the worker keeps draining its queue and the stage
+        before it never blocks on a full queue"""
+        try:
+            callback(*args)
+        except Exception as error:
+            with self.lock:
+                self.stats[stage.name]["callback_errors"] += 1
+            print("Error {} in {} callback {}".format(
+                error, stage.name, getattr(callback, "__name__", callback)))
+
+    def __worker__(self, stage, inbox, outbox, on_complete):
+        while True:
+            item = inbox.get()
+            if item is __stop__:
+                break
+            stats = self.stats[stage.name]
+            start = time.time()
+            try:
+                result = stage.func(item)
+            except Exception as error:
+                with self.lock:
+                    stats["errors"] += 1
+                    stats["busy"] += time.time() - start
+                self.__callback__(stage, self.on_error, stage, item, error)
+                continue
+            with self.lock:
+                stats["items"] += 1
+                stats["busy"] += time.time() - start
+            if result is None:
+                continue
+            if outbox is not None:
+                outbox.put(result)
+                continue
+            with self.lock:
+                self.completed += 1
+                completed = self.completed
+            if on_complete is not None:
+                self.__callback__(stage, on_complete, result, completed)
+
+    def run(self, items, on_complete=None):
+        """Method feeds items through every stage and blocks until the last
+        stage has finished, returns the number of items that completed
+
+        Args:
+            items -- Iterable of items for the first stage
+            on_complete -- Optional Callable(item, completed_count) called
+                           for each item leaving the last stage
+        """
+        self.started = time.time()
+        queues = [queue.Queue(maxsize=self.queue_size) for stage in self.stages]
+        threads = []
+        for i, stage in enumerate(self.stages):
+            outbox = queues[i+1] if i+1 < len(queues) else None
+            stage_threads = []
+            for j in range(stage.workers):
+                thread = threading.Thread(
+                    target=self.__worker__,
+                    args=(stage, queues[i], outbox, on_complete),
+                    name="{}-{}".format(stage.name, j),
+                    daemon=True)
+                thread.start()
+                stage_threads.append(thread)
+            threads.append(stage_threads)
+        for item in items:
+            queues[0].put(item)
+        # Drain stages in order so every item reaches the next queue before
+        # that stage is told to stop
+        for i, stage in enumerate(self.stages):
+            for thread in threads[i]:
+                queues[i].put(__stop__)
+            for thread in threads[i]:
+                thread.join()
+            self.stats[stage.name]["elapsed"] = time.time() - self.started
+        return self.completed
+
+    def report(self):
+        """Method returns a line per stage with items, errors, throughput
+        over the stage's wall time and total worker busy time, and any
+        errors raised by the callbacks"""
+        lines = []
+        for stage in self.stages:
+            stats = self.stats[stage.name]
+            rate = 0.0
+            if stats["elapsed"] > 0:
+                rate = stats["items"] / stats["elapsed"]
+            lines.append(
+                "{}: {:,} items, {:,} errors, {:.1f}/s, {:.1f}s busy "
+                "across {} workers".format(
+                    stage.name,
+                    stats["items"],
+                    stats["errors"],
+                    rate,
+                    stats["busy"],
+                    stage.workers))
+            if stats["callback_errors"] > 0:
+                lines[-1] += ", {:,} callback errors".format(
+                    stats["callback_errors"])
+        return "\n".join(lines)
@@ -2,16 +2,25 @@
 
 __author__ = "Jeremy Nelson, Sarah Bogard"
 
+import base64
+import binascii
 import click
+import datetime
+import json
 import os
+import re
 import requests
 import sys
+import threading
+import time
 
 from collections import OrderedDict
 from copy import deepcopy
 from flask import abort
 from elasticsearch import Elasticsearch
-from elasticsearch_dsl import Search, Q, A
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch_dsl import MultiSearch, Search, Q, A
+from . import cache
 import xml.etree.ElementTree as etree
 
 etree.register_namespace("mods", "http://www.loc.gov/mods/v3")
@@ -74,13 +83,139 @@ if not REPO_SEARCH:
     # 9200 and 9300
     REPO_SEARCH = Elasticsearch()
 
-def advanced_search(form):
+
+class TitleCache(object):
+    """Thread-safe LRU map of pid to titlePrincipal, entries expire after
+    ttl seconds and the whole map is dropped when the index generation
+    changes"""
+
+    def __init__(self, max_size=2048, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.titles = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = None
+
+    def get(self, pid):
+        """Returns cached title for pid or None if missing or expired"""
+        with self.lock:
+            entry = self.titles.get(pid)
+            if entry is None:
+                return
+            title, expires = entry
+            if expires < time.time():
+                del self.titles[pid]
+                return
+            self.titles.move_to_end(pid)
+            return title
+
+    def check_generation(self, generation):
+        """Drops every title if the index generation has changed since
+        they were cached, checked and reset under one lock so a title
+        cached for the new generation is never cleared"""
+        with self.lock:
+            if self.generation != generation:
+                self.titles.clear()
+                self.generation = generation
+
+    def set(self, pid, title, generation=None):
+        """Caches a title, skipped if generation is given and the cache
+        has moved on to another one while the title was fetched"""
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.titles[pid] = (title, time.time() + self.ttl)
+            self.titles.move_to_end(pid)
+            while len(self.titles) > self.max_size:
+                self.titles.popitem(last=False)
+
+    def invalidate(self, pids=None):
+        """Removes pids from the cache, clears everything if pids is None"""
+        with self.lock:
+            if pids is None:
+                self.titles.clear()
+                return
+            for pid in pids:
+                self.titles.pop(pid, None)
+
+TITLE_CACHE = TitleCache(
+    max_size=getattr(CONF, "TITLE_CACHE_SIZE", 2048),
+    ttl=getattr(CONF, "TITLE_CACHE_TTL", 3600))
+
+# Cursor pagination sorts, pid.keyword is the tiebreaker that makes
+# search_after positions unique
+CURSOR_SORT = [("titlePrincipal.keyword", "asc"), ("pid.keyword", "asc")]
+SCORE_CURSOR_SORT = [("_score", "desc"), ("pid.keyword", "asc")]
+
+# Queries use the repository alias, full rebuilds load a new
+# repository-<timestamp> index and move the alias to it
+REPOSITORY_ALIAS = "repository"
+GENERATION_INDEX_RE = re.compile(r"^{}-\d{{14}}$".format(REPOSITORY_ALIAS))
+
+# Index generation is a counter stored in META_INDEX that search/poll.py
+# bumps after every indexing run, caches key on it instead of expiring
+META_INDEX = "repository-meta"
+GENERATION_TTL = getattr(CONF, "GENERATION_TTL", 30)
+__generation__ = {"value": None, "checked": 0}
+__generation_lock__ = threading.Lock()
+
+# _source includes for each view, pushed down so Elasticsearch only sends
+# the fields the templates read, None returns the whole document
+#   results -- results.html list, also the /search and /browse JSON
+#   tile -- Featured collection carousel, the carousel_item filter
+#   detail -- Object page, detail.html reads most fields
+SOURCE_FIELDS = {
+    "results": ["pid", "titlePrincipal", "creator", "abstract"],
+    "tile": ["pid", "titlePrincipal", "content_models",
+             "datastreams.dsid", "datastreams.order", "datastreams.pid"],
+    "detail": None,
+}
+SOURCE_FIELDS.update(getattr(CONF, "SOURCE_FIELDS", dict()))
+
+# Tiered cache shared by the web workers and the poller, facet counts are
+# keyed on the index generation
+CACHE = cache.from_config(
+    CONF,
+    generation=lambda: get_generation(),
+    default_dir=os.path.join(
+        os.path.dirname(os.path.abspath(BASE_DIR)),
+        "cache"))
+
+def __source__(search, view):
+    """Helper function limits an elasticsearch_dsl Search's _source to a
+    view's SOURCE_FIELDS"""
+    fields = SOURCE_FIELDS.get(view)
+    if fields is None:
+        return search
+    return search.source(includes=fields)
+
+def compact_results(output):
+    """Function trims an Elasticsearch response to what the views send,
+    the hit total, each hit's _id and _source, aggregations and cursor
+
+    Args:
+        output -- Search response dict
+    """
+    if output is None:
+        return
+    hits = output.get('hits', dict())
+    compact = {"hits": {"total": hits.get('total'),
+                        "hits": [{"_id": hit.get('_id'),
+                                  "_source": hit.get('_source')}
+                                 for hit in hits.get('hits', [])]}}
+    for key in ['aggregations', 'cursor']:
+        if key in output:
+            compact[key] = output[key]
+    return compact
+
+def advanced_search(form, view="results"):
     """Function takes the Advanced Search form and builds query
 
     Args:
         form(AdvancedSearch): Advanced Search form
+        view: SOURCE_FIELDS view, default is results
     """
-    search = Search(using=REPO_SEARCH, index="repository")
+    search = __source__(Search(using=REPO_SEARCH, index="repository"), view)
     query_chain = None
     for row in form.text_search:
         if len(row.q.data) < 1:
@@ -173,7 +308,196 @@ def __by_topic__(search, topic_data):
     return search
     
 
-def browse(pid, from_=0, size=25):
+def encode_cursor(cursor):
+    """Function returns an opaque, URL-safe page token for a cursor dict
+
+    Args:
+        cursor -- Dict with optional after and reverse keys
+    """
+    raw = json.dumps(cursor, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(token):
+    """Function returns the cursor dict for a page token, an empty dict
+    for no token, and aborts with a 400 for a malformed token
+
+    Args:
+        token -- Page token from encode_cursor
+    """
+    if not token:
+        return dict()
+    padded = token + "=" * (-len(token) % 4)
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        abort(400)
+    if not isinstance(cursor, dict):
+        abort(400)
+    return cursor
+
+def __cursor_body__(cursor, sort_fields):
+    """Helper function returns the sort and search_after body for a
+    cursor, a reverse cursor flips every sort order so previous and last
+    pages are also a single search_after query"""
+    reverse = cursor.get("reverse", False)
+    sort = []
+    for field, order in sort_fields:
+        if reverse:
+            order = "asc" if order == "desc" else "desc"
+        sort.append({field: {"order": order}})
+    body = {"sort": sort}
+    if cursor.get("after"):
+        body["search_after"] = cursor["after"]
+    return body
+
+def __cursor_tokens__(output, cursor):
+    """Helper function puts hits from a reverse cursor back in display
+    order and adds next, prev and last page tokens to the output"""
+    hits = output['hits']['hits']
+    if cursor.get("reverse"):
+        hits.reverse()
+    tokens = {"last": {"reverse": True}}
+    if len(hits) > 0:
+        tokens["next"] = {"after": hits[-1].get("sort")}
+        tokens["prev"] = {"after": hits[0].get("sort"), "reverse": True}
+    output['cursor'] = dict()
+    for name, token in tokens.items():
+        output['cursor'][name] = encode_cursor(token)
+    return output
+
+def __paginate__(search, size, from_, after, sort_fields):
+    """Helper function applies size and either from_ or a cursor to an
+    elasticsearch_dsl Search"""
+    cursor = decode_cursor(after)
+    body = __cursor_body__(cursor, sort_fields)
+    if len(cursor) < 1:
+        body["from_"] = int(from_)
+    return search.extra(size=int(size), **body), cursor
+
+
+class BrowsePage(object):
+    """Class holds the combined results of the queries planned for a
+    collection or object page.
+
+    Attributes:
+        pid -- PID of Fedora Object
+        results -- Child hits with the collection's aggregations
+        facets -- OrderedDict of non-empty aggregations, like get_aggregations
+        detail -- Search result for the pid itself, like get_detail, or None
+        titles -- Dict of breadcrumb pid to titlePrincipal
+    """
+
+    def __init__(self, pid, results, facets, detail=None):
+        self.pid = pid
+        self.results = results
+        self.facets = facets
+        self.detail = detail
+        self.titles = dict()
+
+    @property
+    def info(self):
+        """Returns the _source of the pid's own document or empty dict"""
+        if self.detail is None or len(self.detail['hits']['hits']) < 1:
+            return dict()
+        return self.detail['hits']['hits'][0]['_source']
+
+
+def __add_facets__(search):
+    """Helper function adds the AGGS_DSL facet buckets to a search"""
+    for name, agg in AGGS_DSL['aggs'].items():
+        search.aggs.bucket(name, A("terms", field=agg['terms']['field']))
+    return search
+
+def __ordered_facets__(aggregations):
+    """Helper function returns aggregations sorted by name, dropping
+    aggregations without any buckets"""
+    output = OrderedDict()
+    for key in sorted(aggregations):
+        aggregation = aggregations[key]
+        if len(aggregation.get('buckets')) > 0:
+            output[key] = aggregation
+    return output
+
+def plan_browse(pid, from_=0, size=25, detail=True, facets=True, after=None,
+                view="results"):
+    """Function builds the child hits, and optional facet and detail
+    queries for a collection page
+
+    Args:
+        pid: PID of Fedora Object
+        from_(int): Start result from, default is 0
+        size(int): Size of shard, default is 25
+        detail(bool): Include the pid's own document, default is True
+        facets(bool): Include the facet aggregations, default is True
+        after: Page token, if present from_ is ignored
+        view: SOURCE_FIELDS view for the child hits, default is results
+
+    Returns:
+        Tuple of list of Searches, hits first, and the cursor dict
+    """
+    hits, cursor = __paginate__(
+        __source__(Search(using=REPO_SEARCH, index="repository") \
+             .filter("term", **{"parent.keyword": pid}), view),
+        size,
+        from_,
+        after,
+        CURSOR_SORT)
+    searches = [hits]
+    if facets:
+        searches.append(
+            __add_facets__(
+                Search(using=REPO_SEARCH, index="repository") \
+                    .filter("term", inCollections=pid) \
+                    .extra(size=0)))
+    if detail:
+        searches.append(
+            __source__(Search(using=REPO_SEARCH, index="repository") \
+                .filter("term", **{"pid.keyword": pid}), "detail"))
+    return searches, cursor
+
+def browse_page(pid, from_=0, size=25, detail=True, after=None,
+                view="results"):
+    """Function runs all of a collection page's queries in one _msearch
+    round trip and resolves the breadcrumb titles through the title cache,
+    facets already cached for the index generation are not re-run
+
+    Args:
+        pid: PID of Fedora Object
+        from_(int): Start result from, default is 0
+        size(int): Size of shard, default is 25
+        detail(bool): Include the pid's own document, default is True
+        after: Page token from a previous page's cursor, default is None
+        view: SOURCE_FIELDS view for the child hits, default is results
+
+    Returns:
+        BrowsePage
+    """
+    generation = get_generation()
+    facets = cached_aggregations(pid, generation)
+    searches, cursor = plan_browse(pid,
+                                   from_,
+                                   size,
+                                   detail,
+                                   facets is None,
+                                   after,
+                                   view)
+    multi = MultiSearch(using=REPO_SEARCH, index="repository")
+    for search in searches:
+        multi = multi.add(search)
+    responses = list(multi.execute())
+    output = responses.pop(0).to_dict()
+    __cursor_tokens__(output, cursor)
+    if facets is None:
+        facets = __ordered_facets__(responses.pop(0).to_dict()["aggregations"])
+        __store_facets__(pid, generation, facets)
+    output['aggregations'] = facets
+    page = BrowsePage(pid, output, facets)
+    if detail:
+        page.detail = responses.pop(0).to_dict()
+        page.titles = get_titles(page.info.get('inCollections', []) + [pid])
+    return page
+
+def browse(pid, from_=0, size=25, after=None, view="results"):
     """Function takes a pid and runs query to retrieve all of it's children
     pids
 
@@ -181,28 +505,18 @@ def browse(pid, from_=0, size=25):
 		pid: PID of Fedora Object
         from_(int): Start result from, default is 0
         size(int): Size of shard, default is 25
+        after: Page token, default is None
+        view: SOURCE_FIELDS view, default is results
     """
-    search = Search(using=REPO_SEARCH, index="repository") \
-             .filter("term", **{"parent.keyword": pid}) \
-             .params(size=size, from_=from_) \
-             .sort("titlePrincipal.keyword")
-    results = search.execute()
-    output = results.to_dict()
-    search = Search(using=REPO_SEARCH, index="repository") \
-             .filter("term", inCollections=pid) \
-             .params(size=0)
-    search.aggs.bucket("Format", A("terms", field="typeOfResource.keyword"))
-    search.aggs.bucket("Geographic", A("terms", field="subject.geographic.keyword"))
-    search.aggs.bucket("Genres", A("terms", field="genre.keyword"))
-    search.aggs.bucket("Languages", A("terms", field="language.keyword"))
-    search.aggs.bucket("Publication Year", A("terms", field="publicationYear.keyword"))
-    search.aggs.bucket("Temporal (Time)", A("terms", field="subject.temporal.keyword"))
-    search.aggs.bucket("Topic", A("terms", field="subject.topic.keyword"))
-    facets = search.execute()
-    output['aggregations'] = facets.to_dict()["aggregations"]
-    return output
+    return browse_page(pid,
+                       from_,
+                       size,
+                       detail=False,
+                       after=after,
+                       view=view).results
 
-def filter_query(facet, facet_value, query=None, size=25, from_=0):
+def filter_query(facet, facet_value, query=None, size=25, from_=0, after=None,
+                 view="results"):
     """Function takes a facet, facet_value, and query string, and constructs
     filter for Elastic search.
 
@@ -212,12 +526,19 @@ def filter_query(facet, facet_value, query=None, size=25, from_=0):
 		query: Query, if blank searches entire index
 		size: size of result set, defaults to 25
 		from_: From location, used for infinite browse
+		after: Page token, if present from_ is ignored
+		view: SOURCE_FIELDS view, default is results
     """
+    cursor = decode_cursor(after)
     dsl = {
-        "size": size,
-	"from": from_,
+        "size": int(size),
         "aggs": AGGS_DSL['aggs'],
     }
+    if SOURCE_FIELDS.get(view) is not None:
+        dsl["_source"] = {"includes": SOURCE_FIELDS[view]}
+    dsl.update(__cursor_body__(cursor, SCORE_CURSOR_SORT))
+    if len(cursor) < 1:
+        dsl["from"] = int(from_)
     field_name = AGGS_DSL["aggs"][facet]["terms"]["field"] 
     if query is not None:
         dsl["query"] = {
@@ -244,11 +565,14 @@ def filter_query(facet, facet_value, query=None, size=25, from_=0):
                 field_name : facet_value
             }
         }
-    results = REPO_SEARCH.search(body=dsl, index="repository")
-    return results
+    results = REPO_SEARCH.search(
+        body=dsl,
+        index="repository")
+    return __cursor_tokens__(results, cursor)
 
 
-def specific_search(query, type_of, size=25, from_=0, pid=None):
+def specific_search(query, type_of, size=25, from_=0, pid=None, after=None,
+                    view="results"):
     """Function takes a query and fields list and runs a search on those
     specific fields.
 
@@ -256,11 +580,13 @@ def specific_search(query, type_of, size=25, from_=0, pid=None):
         query: query terms to search on
         type_of: Type of query, choices should be creator, title, subject,
                  and number
+        after: Page token, if present from_ is ignored
+        view: SOURCE_FIELDS view, default is results
 
     Returns:
 	    A dict of the search results
     """
-    search = Search(using=REPO_SEARCH, index="repository")
+    search = __source__(Search(using=REPO_SEARCH, index="repository"), view)
     if type_of.startswith("creator"):
         search = search.query("match_phrase", creator=query)
     elif type_of.startswith("number"):
@@ -272,13 +598,16 @@ def specific_search(query, type_of, size=25, from_=0, pid=None):
                      Q("match_phrase", **{"subject.geographic": query}) |\
                      Q("match_phrase", **{"subject.temporal": query}))
     elif query is None and pid is not None:
-        search = search.filter("term", parent=pid) \
-                 .params(size=size, from_=from_) \
-                 .sort("titlePrincipal")
+        search = search.filter("term", parent=pid)
     else:
         search = search.query(
             Q("query_string", query=query, default_operator="AND"))
-        search = search.params(size=size, from_=from_)
+    search, cursor = __paginate__(
+        search,
+        size,
+        from_,
+        after,
+        CURSOR_SORT if query is None else SCORE_CURSOR_SORT)
     search.aggs.bucket("Format", A("terms", field="typeOfResource.keyword"))
     search.aggs.bucket("Geographic", A("terms", field="subject.geographic.keyword"))
     search.aggs.bucket("Genres", A("terms", field="genre.keyword"))
@@ -287,30 +616,146 @@ def specific_search(query, type_of, size=25, from_=0, pid=None):
     search.aggs.bucket("Temporal (Time)", A("terms", field="subject.temporal.keyword"))
     search.aggs.bucket("Topic", A("terms", field="subject.topic.keyword"))
     results = search.execute()
-    return results.to_dict()
+    return __cursor_tokens__(results.to_dict(), cursor)
+
+def get_generation(refresh=False):
+    """Function returns the current index generation, re-read from
+    Elasticsearch at most once every GENERATION_TTL seconds
+
+    Args:
+        refresh -- Skip the per-process cached value, default False
+    """
+    with __generation_lock__:
+        if not refresh and __generation__["value"] is not None and \
+           time.time() - __generation__["checked"] < GENERATION_TTL:
+            return __generation__["value"]
+    try:
+        doc = REPO_SEARCH.get_source(index=META_INDEX, id="generation")
+        generation = doc.get("value", 0)
+    except NotFoundError:
+        generation = 0
+    with __generation_lock__:
+        __generation__["value"] = generation
+        __generation__["checked"] = time.time()
+    return generation
+
+def bump_generation():
+    """Function increments the index generation after new objects are
+    indexed and returns the new generation"""
+    REPO_SEARCH.update(
+        index=META_INDEX,
+        id="generation",
+        body={"script": {"source": "ctx._source.value += 1"},
+              "upsert": {"value": 1}},
+        refresh=True)
+    return get_generation(refresh=True)
+
+def active_index(elastic=None):
+    """Function returns the concrete index the repository alias points to,
+    the repository index itself before the first versioned rebuild, or
+    None if neither exists
+
+    Args:
+        elastic -- Elasticsearch client, default is REPO_SEARCH
+    """
+    elastic = elastic or REPO_SEARCH
+    if elastic.indices.exists_alias(name=REPOSITORY_ALIAS):
+        return sorted(elastic.indices.get_alias(name=REPOSITORY_ALIAS))[-1]
+    if elastic.indices.exists(index=REPOSITORY_ALIAS):
+        return REPOSITORY_ALIAS
+
+def index_generations(elastic=None):
+    """Function returns the repository-<timestamp> indices, newest first
+
+    Args:
+        elastic -- Elasticsearch client, default is REPO_SEARCH
+    """
+    elastic = elastic or REPO_SEARCH
+    names = elastic.indices.get(index="{}-*".format(REPOSITORY_ALIAS))
+    return sorted([name for name in names if GENERATION_INDEX_RE.match(name)],
+                  reverse=True)
+
+def index_info():
+    """Function returns a dict with the active index name, when it was
+    built and the current index generation for the About page"""
+    index = active_index()
+    info = {"index": index, "built": None, "generation": get_generation()}
+    if index is None:
+        return info
+    if GENERATION_INDEX_RE.match(index):
+        info["built"] = datetime.datetime.strptime(
+            index.split("-")[-1], "%Y%m%d%H%M%S")
+    else:
+        created = REPO_SEARCH.indices.get_settings(index=index)[index]\
+            ["settings"]["index"]["creation_date"]
+        info["built"] = datetime.datetime.utcfromtimestamp(
+            int(created[0:10]))
+    return info
+
+def cached_aggregations(pid=None, generation=None):
+    """Function returns the cached facet counts for a pid at an index
+    generation, or None if they haven't been computed
+
+    Args:
+        pid -- PID of Fedora Object, default is None for the full index
+        generation -- Index generation, defaults to the current generation
+    """
+    return CACHE.get("facets", str(pid), generation=generation)
 
-def get_aggregations(pid=None):
+def __store_facets__(pid, generation, facets):
+    """Helper function saves facets in process and in the shared cache"""
+    CACHE.set("facets", str(pid), facets, generation=generation)
+
+def warm_facets(pids=None, size=None):
+    """Function precomputes facet counts for the current generation,
+    called by search/poll.py after indexing so page loads for the top
+    collections never run the aggregations.
+
+    Args:
+        pids -- List of PIDs, defaults to the collections with the most
+                objects
+        size -- Number of top collections, default is FACET_WARM_SIZE or 50
+    """
+    generation = get_generation(refresh=True)
+    if pids is None:
+        if size is None:
+            size = getattr(CONF, "FACET_WARM_SIZE", 50)
+        result = REPO_SEARCH.search(
+            index="repository",
+            body={"size": 0,
+                  "aggs": {"top": {"terms": {"field": "inCollections",
+                                             "size": size}}}})
+        pids = [None] + [bucket['key'] for bucket in
+                         result['aggregations']['top']['buckets']]
+    for pid in pids:
+        get_aggregations(pid, generation)
+    return pids
+
+def get_aggregations(pid=None, generation=None):
     """Function takes an optional pid and returns the aggregations
     scoped by the pid, if pid is None, runs aggregation on full ES
-    index.
+    index. Results are cached by pid and index generation.
 
     Args:
-        pid -- PID of Fedora Object, default is NoneBASE_DIR = os.path.dirname(os.path.dirname(__file__))
+        pid -- PID of Fedora Object, default is None
+        generation -- Index generation, defaults to the current generation
 
     Returns:
         dictionary of the results
     """
+    if generation is None:
+        generation = get_generation()
+    facets = cached_aggregations(pid, generation)
+    if facets is not None:
+        return facets
     #search = Search(using=REPO_SEARCH, index="repository) \
     dsl = deepcopy(AGGS_DSL)
     if pid is not None:
         dsl["query"] = {"term": { "inCollections": pid } }
     results = REPO_SEARCH.search(index="repository", body=dsl)['aggregations']
-    output = OrderedDict()
-    for key in sorted(results):
-        aggregation = results[key]
-        if len(aggregation.get('buckets')) > 0:
-            output[key] = aggregation
-    return output
+    facets = __ordered_facets__(results)
+    __store_facets__(pid, generation, facets)
+    return facets
         
 def get_detail(pid):
     """Function takes a pid and returns the detailed dictionary from 
@@ -319,8 +764,8 @@ def get_detail(pid):
     Args:
         pid -- PID of Fedora Object
     """
-    search = Search(using=REPO_SEARCH, index="repository") \
-             .filter("term", **{"pid.keyword":pid})
+    search = __source__(Search(using=REPO_SEARCH, index="repository") \
+             .filter("term", **{"pid.keyword":pid}), "detail")
     result = search.execute()
     if len(result) > 0:
         return result.to_dict()
@@ -342,12 +787,52 @@ def get_title(pid):
     Args:
         pid -- PID of Fedora Object
     """
-    result = REPO_SEARCH.search(body={"query": {"term": {"pid.keyword": pid }},
-			                         "_source": ["titlePrincipal"]},
-                                index='repository')
-    if result.get('hits').get('total') == 1:
-        return result['hits']['hits'][0]['_source']['titlePrincipal']
-    return "Home"
+    return get_titles([pid]).get(pid, "Home")
+
+def get_titles(pids):
+    """Function takes a list of pids and returns a dict of pid to
+    titlePrincipal, resolving any pids not in the TITLE_CACHE with a
+    single terms query.
+
+    Args:
+        pids -- List of Fedora Object PIDs
+    """
+    generation = get_generation()
+    TITLE_CACHE.check_generation(generation)
+    output, missing = dict(), []
+    for pid in pids:
+        if pid is None or pid in output:
+            continue
+        title = TITLE_CACHE.get(pid)
+        if title is None:
+            missing.append(pid)
+        else:
+            output[pid] = title
+    if len(missing) < 1:
+        return output
+    result = REPO_SEARCH.search(
+        body={"query": {"terms": {"pid.keyword": missing}},
+              "_source": ["pid", "titlePrincipal"],
+              "size": len(missing)},
+        index='repository')
+    for hit in result['hits']['hits']:
+        source = hit['_source']
+        if source.get('pid') in output:
+            continue
+        output[source.get('pid')] = source.get('titlePrincipal')
+    for pid in missing:
+        # Unknown pids fall back to Home like the original filter
+        title = output.setdefault(pid, "Home")
+        TITLE_CACHE.set(pid, title, generation)
+    return output
+
+def invalidate_titles(pids=None):
+    """Function removes pids from the title cache, called after indexing
+
+    Args:
+        pids -- List of PIDs, default of None clears the whole cache
+    """
+    TITLE_CACHE.invalidate(pids)
 
 if __name__ == "__main__":
     print()
@@ -0,0 +1,134 @@
+"""Module benchmarks the MODS to search document transform on a fixture
+corpus rendered from the CONTENTdm harvester's repair/mods.xml template,
+or on a directory of MODS files exported from Fedora"""
+__author__ = "Jeremy Nelson"
+
+import os
+import random
+import time
+
+import click
+from jinja2 import Template
+
+from .transform import apply_mods, mods_document, new_pool, transform_many
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOPICS = ["Geology", "Pikes Peak", "Buddhism", "Theatre", "Dance",
+          "Thin sections", "Mineralogy", "Colorado Springs", "Architecture"]
+NAMES = ["Ames, Gypsy", "Bogard, Sarah", "Nelson, Jeremy", "Smith, Jane",
+         "Jackson, William Henry"]
+LANGUAGES = ["English", "Chinese", "Japanese", "Sanskrit", "Tibetan"]
+DEPARTMENTS = ["Geology Department", "Theatre and Dance Department",
+               "Asian Studies Program"]
+
+
+def fixture_corpus(size, seed=42):
+    """Function returns a list of size MODS documents rendered from
+    repair/mods.xml with the kinds of values the harvesters supply
+
+    Args:
+        size -- Number of records
+        seed -- Random seed so runs are comparable
+    """
+    with open(os.path.join(BASE_DIR, "repair", "mods.xml")) as fo:
+        template = Template(fo.read())
+    rand = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        names = [{"role": rand.choice(["creator", "photographer", "Collector"]),
+                  "type": "personal",
+                  "name": name}
+                 for name in rand.sample(NAMES, rand.randint(1, 3))]
+        corpus.append(template.render(
+            abstract="Record {} {}".format(i, " ".join(
+                rand.sample(TOPICS, 4))),
+            dates=[{"tag": "dateCreated",
+                    "keyDate": "yes",
+                    "value": str(rand.randint(1880, 2017))}],
+            department=rand.choice(DEPARTMENTS),
+            extent="{} pages".format(rand.randint(1, 400)),
+            identifiers=[{"type": "local",
+                          "displayLabel": "Local Identifier",
+                          "value": "cc-{:06d}".format(i)}],
+            languages=rand.sample(LANGUAGES, rand.randint(1, 2)),
+            locations=rand.sample(TOPICS, 2),
+            names=names,
+            notes=[{"displayLabel": "Course ID and Name",
+                    "text": "GY{} {}".format(rand.randint(100, 499),
+                                             rand.choice(TOPICS))}],
+            temporal=[str(rand.randint(1880, 2017))],
+            title="{} {}".format(rand.choice(TOPICS), i),
+            topics=rand.sample(TOPICS, 3),
+            type_of_resource=rand.choice(["text", "still image",
+                                          "sound recording"])).encode("utf-8"))
+    return corpus
+
+def load_corpus(directory):
+    """Function reads every .xml file in directory as a MODS record"""
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".xml"):
+            with open(os.path.join(directory, name), "rb") as fo:
+                corpus.append(fo.read())
+    return corpus
+
+def run(corpus, processes=1, rounds=3):
+    """Function transforms the corpus rounds times and returns the best
+    objects/second overall and per core
+
+    Args:
+        corpus -- List of MODS documents as bytes
+        processes -- Worker processes, 1 runs in this process
+        rounds -- Timed rounds, the fastest is reported
+    """
+    pool = new_pool(processes) if processes > 1 else None
+    try:
+        # Warm up compiles the extractors in every worker
+        transform_many(
+            [{"pid": "warm", "_mods": raw} for raw in corpus[:processes*32]],
+            pool)
+        best = None
+        for i in range(rounds):
+            docs = [{"pid": str(j), "_mods": raw} for j, raw in enumerate(corpus)]
+            start = time.perf_counter()
+            if pool is None:
+                for doc in docs:
+                    apply_mods(doc)
+            else:
+                transform_many(docs, pool, chunksize=64)
+            seconds = time.perf_counter() - start
+            if best is None or seconds < best:
+                best = seconds
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    rate = len(corpus) / best
+    return {"objects_per_second": rate,
+            "per_core": rate / processes,
+            "seconds": best}
+
+
+@click.command()
+@click.option("--size", default=5000, help="Fixture records to render")
+@click.option("--corpus", default=None,
+    help="Directory of MODS .xml files instead of the fixture corpus")
+@click.option("--processes", default=os.cpu_count() or 1)
+@click.option("--rounds", default=3)
+def main(size, corpus, processes, rounds):
+    records = load_corpus(corpus) if corpus else fixture_corpus(size)
+    # Fail fast on a record the transform can't handle
+    mods_document(records[0])
+    click.echo("{:,} MODS records".format(len(records)))
+    for count in sorted(set([1, processes])):
+        stats = run(records, count, rounds)
+        click.echo("{} process(es): {:,.0f} objects/s, {:,.0f} objects/s "
+                   "per core, {:.2f}s".format(
+                       count,
+                       stats["objects_per_second"],
+                       stats["per_core"],
+                       stats["seconds"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""Module provides the tiered cache shared by the web workers, the poller
+and the harvest scripts. Each process has a small LRU bounded by bytes in
+front of a shared store, Redis when CACHE_REDIS_URL is set and a SQLite
+file in CACHE_DIR otherwise. Keys are namespaced, namespaces have their
+own TTL and can be tied to the index generation so a reindex retires
+their entries without a flush."""
+__author__ = "Jeremy Nelson"
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Serialized values start with a flag byte
+PICKLED = b"p"
+COMPRESSED = b"z"
+
+# Namespace defaults, ttl of 0 never expires. Generational namespaces
+# key on the index generation so a reindex retires them
+NAMESPACES = {
+    "browse": {"ttl": 3600, "generational": True},
+    "facets": {"ttl": 86400, "generational": True},
+    "chrome": {"ttl": 0, "generational": False},
+    "static": {"ttl": 0, "generational": False},
+}
+
+
+def dumps(value, compress_min=1024):
+    """Function pickles a value, zlib compressing it when the pickle is at
+    least compress_min bytes and compression helps
+
+    Args:
+        value -- Any picklable value
+        compress_min -- Smallest pickle that is compressed
+    """
+    payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if len(payload) >= compress_min:
+        compressed = zlib.compress(payload, 6)
+        if len(compressed) < len(payload):
+            return COMPRESSED + compressed
+    return PICKLED + payload
+
+def loads(data):
+    """Function reverses dumps"""
+    if data[:1] == COMPRESSED:
+        return pickle.loads(zlib.decompress(data[1:]))
+    return pickle.loads(data[1:])
+
+
+class LRUCache(object):
+    """Thread-safe LRU map bounded by the serialized size of its values
+
+    Args:
+        max_bytes -- Size budget, default is 32MB
+    """
+
+    def __init__(self, max_bytes=32*1024*1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (True, value) or (False, None) if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            value, size, expires = entry
+            if expires < time.time():
+                del self.entries[key]
+                self.total_bytes -= size
+                return False, None
+            self.entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, size, ttl):
+        with self.lock:
+            self.__pop__(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size, time.time() + ttl)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                oldest, entry = self.entries.popitem(last=False)
+                self.total_bytes -= entry[1]
+
+    def __pop__(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def delete(self, key):
+        with self.lock:
+            self.__pop__(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+class RedisStore(object):
+    """Class stores serialized values in Redis, which handles expiry and
+    eviction itself
+
+    Args:
+        url -- Redis URL, redis://host:6379/0
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise ImportError("CACHE_REDIS_URL needs the redis package")
+        self.client = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, data, ttl):
+        self.client.set(key, data, ex=ttl or None)
+
+    def add(self, key, data, ttl):
+        return bool(self.client.set(key, data, ex=ttl or None, nx=True))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+class SQLiteStore(object):
+    """Class stores serialized values in a SQLite file shared by every
+    process on the host, a stand-in for Redis on a single server. Expired
+    rows are purged, and the oldest trimmed past max_entries, every
+    purge_every writes.
+
+    Args:
+        path -- SQLite database file
+        max_entries -- Row limit, default is 100,000
+        purge_every -- Writes between purges, default is 1,000
+    """
+
+    def __init__(self, path, max_entries=100000, purge_every=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.purge_every = purge_every
+        self.writes = 0
+        self.pid = None
+        self.local = None
+
+    def __connection__(self):
+        """Returns this thread's connection, opened on first use. sqlite3
+        connections can't be shared between threads or carried across a
+        fork, so a process that isn't the one the connections were opened
+        in, such as a uWSGI worker forked after import, starts afresh."""
+        if self.pid != os.getpid():
+            self.local = threading.local()
+            self.pid = os.getpid()
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                connection.execute(
+                    """CREATE TABLE IF NOT EXISTS cache (
+                           key TEXT PRIMARY KEY,
+                           value BLOB NOT NULL,
+                           expires REAL)""")
+            self.local.connection = connection
+        return connection
+
+    def __expires__(self, ttl):
+        if ttl:
+            return time.time() + ttl
+
+    def __written__(self):
+        self.writes += 1
+        if self.writes % self.purge_every == 0:
+            self.purge()
+
+    def get(self, key):
+        row = self.__connection__().execute(
+            "SELECT value, expires FROM cache WHERE key=?",
+            (key,)).fetchone()
+        if row is None:
+            return
+        value, expires = row
+        if expires is not None and expires < time.time():
+            return
+        return value
+
+    def set(self, key, data, ttl):
+        with self.__connection__() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires) "
+                "VALUES (?, ?, ?)",
+                (key, sqlite3.Binary(data), self.__expires__(ttl)))
+        self.__written__()
+
+    def add(self, key, data, ttl):
+        with self.__connection__() as connection:
+            connection.execute(
+                "DELETE FROM cache WHERE key=? AND expires < ?",
+                (key, time.time()))
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO cache (key, value, expires) "
+                "VALUES (?, ?, ?)",
+                (key, sqlite3.Binary(data), self.__expires__(ttl)))
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        with self.__connection__() as connection:
+            connection.execute("DELETE FROM cache WHERE key=?", (key,))
+
+    def purge(self):
+        """Method removes expired rows and trims the rows expiring soonest
+        when over max_entries"""
+        with self.__connection__() as connection:
+            connection.execute(
+                "DELETE FROM cache WHERE expires < ?",
+                (time.time(),))
+            count = connection.execute(
+                "SELECT COUNT(*) FROM cache").fetchone()[0]
+            if count > self.max_entries:
+                connection.execute(
+                    """DELETE FROM cache WHERE key IN (
+                           SELECT key FROM cache
+                           ORDER BY expires IS NULL, expires
+                           LIMIT ?)""",
+                    (count - self.max_entries,))
+
+
+class TieredCache(object):
+    """Class is the cache facade, reads try this process's LRU then the
+    shared store and writes go to both. Values found in the shared store
+    are kept in the LRU for at most l1_ttl seconds so other workers'
+    writes are seen.
+
+    Args:
+        store -- RedisStore or SQLiteStore
+        l1_bytes -- LRU size budget, default is 32MB
+        l1_ttl -- Max seconds a value stays in the LRU, default is 30
+        compress_min -- Smallest pickle that is compressed
+        generation -- Callable returning the current index generation
+        namespaces -- Dict of namespace to {"ttl", "generational"}
+    """
+
+    def __init__(self, store, l1_bytes=32*1024*1024, l1_ttl=30,
+                 compress_min=1024, generation=None, namespaces=NAMESPACES):
+        self.store = store
+        self.l1 = LRUCache(l1_bytes)
+        self.l1_ttl = l1_ttl
+        self.compress_min = compress_min
+        self.generation = generation
+        self.namespaces = dict(namespaces)
+        self.lock = threading.Lock()
+        self.counters = dict()
+
+    def __key__(self, namespace, key, generation=None):
+        settings = self.namespaces.get(namespace)
+        if settings is None:
+            raise KeyError("Unknown cache namespace {}".format(namespace))
+        if settings.get("generational"):
+            if generation is None:
+                generation = self.generation() if self.generation else 0
+            return "{}:{}:{}".format(namespace, generation, key)
+        return "{}:{}".format(namespace, key)
+
+    def __ttl__(self, namespace, ttl):
+        if ttl is None:
+            return self.namespaces[namespace].get("ttl", 0)
+        return ttl
+
+    def __count__(self, namespace, counter):
+        with self.lock:
+            counters = self.counters.setdefault(
+                namespace,
+                {"l1": 0, "l2": 0, "miss": 0, "set": 0})
+            counters[counter] += 1
+
+    def __l1_ttl__(self, ttl):
+        if ttl:
+            return min(ttl, self.l1_ttl)
+        return self.l1_ttl
+
+    def get(self, namespace, key, default=None, generation=None):
+        """Method returns the cached value or default
+
+        Args:
+            namespace -- Registered namespace
+            key -- Key within the namespace
+            default -- Returned on a miss
+            generation -- Index generation for generational namespaces,
+                          defaults to the current generation
+        """
+        full_key = self.__key__(namespace, key, generation)
+        found, value = self.l1.get(full_key)
+        if found:
+            self.__count__(namespace, "l1")
+            return value
+        data = self.store.get(full_key)
+        if data is None:
+            self.__count__(namespace, "miss")
+            return default
+        self.__count__(namespace, "l2")
+        value = loads(data)
+        self.l1.set(full_key,
+                    value,
+                    len(data),
+                    self.__l1_ttl__(self.__ttl__(namespace, None)))
+        return value
+
+    def set(self, namespace, key, value, ttl=None, generation=None):
+        """Method caches a value in this process and the shared store
+
+        Args:
+            namespace -- Registered namespace
+            key -- Key within the namespace
+            value -- Any picklable value
+            ttl -- Seconds, default is the namespace's ttl, 0 never expires
+            generation -- Index generation for generational namespaces
+        """
+        full_key = self.__key__(namespace, key, generation)
+        ttl = self.__ttl__(namespace, ttl)
+        data = dumps(value, self.compress_min)
+        self.store.set(full_key, data, ttl)
+        self.l1.set(full_key, value, len(data), self.__l1_ttl__(ttl))
+        self.__count__(namespace, "set")
+
+    def add(self, namespace, key, value, ttl=None):
+        """Method sets the key in the shared store only if it is missing,
+        returns True if it was added. For leases, so skips the LRU."""
+        full_key = self.__key__(namespace, key)
+        return self.store.add(
+            full_key,
+            dumps(value, self.compress_min),
+            self.__ttl__(namespace, ttl))
+
+    def delete(self, namespace, key, generation=None):
+        full_key = self.__key__(namespace, key, generation)
+        self.l1.delete(full_key)
+        self.store.delete(full_key)
+
+    def stats(self):
+        """Method returns this process's hit and miss counters and hit
+        ratio by namespace, with the LRU's size"""
+        with self.lock:
+            output = dict()
+            for namespace, counters in self.counters.items():
+                counters = dict(counters)
+                reads = counters["l1"] + counters["l2"] + counters["miss"]
+                counters["hit_ratio"] = 0.0
+                if reads > 0:
+                    counters["hit_ratio"] = \
+                        (counters["l1"] + counters["l2"]) / reads
+                output[namespace] = counters
+        output["l1_bytes"] = self.l1.total_bytes
+        output["l1_entries"] = len(self.l1.entries)
+        return output
+
+
+def from_config(config, generation=None, default_dir=None):
+    """Function builds a TieredCache from instance/conf.py settings
+
+    Args:
+        config -- conf module, or dict when there is none
+        generation -- Callable returning the current index generation
+        default_dir -- CACHE_DIR when the config doesn't have one
+    """
+    redis_url = getattr(config, "CACHE_REDIS_URL", None)
+    if redis_url:
+        store = RedisStore(redis_url)
+    else:
+        store = SQLiteStore(
+            os.path.join(getattr(config, "CACHE_DIR", default_dir),
+                         "cache.sqlite3"),
+            max_entries=getattr(config, "CACHE_MAX_ENTRIES", 100000))
+    namespaces = dict((name, dict(settings))
+                      for name, settings in NAMESPACES.items())
+    for name, ttl in getattr(config, "CACHE_TTLS", dict()).items():
+        namespaces.setdefault(name, {"generational": False})["ttl"] = ttl
+    return TieredCache(
+        store,
+        l1_bytes=getattr(config, "CACHE_L1_BYTES", 32*1024*1024),
+        l1_ttl=getattr(config, "CACHE_L1_TTL", 30),
+        compress_min=getattr(config, "CACHE_COMPRESS_MIN", 1024),
+        generation=generation,
+        namespaces=namespaces)
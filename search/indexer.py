@@ -0,0 +1,526 @@
+"""Module builds repository index documents from Fedora MODS, RELS-EXT
+and datastream listings and bulk loads them into Elasticsearch, MODS is
+mapped to fields by search.transform"""
+__author__ = "Jeremy Nelson"
+
+import contextlib
+import datetime
+import time
+import xml.etree.ElementTree as etree
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from elasticsearch import helpers
+
+from fedora import FedoraError, get_client
+from fedora.tree import RepositoryTree
+from .transform import apply_mods, new_pool, transform_many
+from . import AGGS_DSL, CONF, REPO_SEARCH, REPOSITORY_ALIAS, active_index,\
+    bump_generation, index_generations
+
+NS = {"rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+      "fedora": "info:fedora/fedora-system:def/relations-external#",
+      "fedora-model": "info:fedora/fedora-system:def/model#",
+      "islandora": "http://islandora.ca/ontology/relsext#"}
+RDF_RESOURCE = "{{{}}}resource".format(NS["rdf"])
+COMPOUND_MODEL = "islandora:compoundCModel"
+CONSTITUENTS_SPARQL = """SELECT ?s
+WHERE {{
+  ?s <fedora-rels-ext:isConstituentOf> <info:fedora/{0}> .
+}}"""
+# Content model, service definition and deployment objects aren't indexed
+SYSTEM_MODELS = set(["fedora-system:ContentModel-3.0",
+                     "fedora-system:ServiceDefinition-3.0",
+                     "fedora-system:ServiceDeployment-3.0"])
+# Full rebuilds go into repository-<timestamp> behind the repository alias
+GENERATION_FORMAT = "%Y%m%d%H%M%S"
+KEEP_GENERATIONS = getattr(CONF, "INDEX_KEEP_GENERATIONS", 2)
+
+
+class IndexerError(Exception):
+    """Raised when the indexer can't reach Fedora or Elasticsearch"""
+
+    def __init__(self, title, description):
+        super(IndexerError, self).__init__(title, description)
+        self.title = title
+        self.description = description
+
+
+def __text__(element):
+    if element is None or element.text is None:
+        return
+    text = " ".join(element.text.split())
+    if len(text) > 0:
+        return text
+
+def __resource_pid__(element):
+    return element.attrib.get(RDF_RESOURCE, "").split("/")[-1]
+
+def rels_ext_fields(raw_rels_ext):
+    """Function returns a dict with content_models, collections,
+    constituent_of and sequence from RELS-EXT
+
+    Args:
+        raw_rels_ext -- RELS-EXT RDF/XML as bytes or str
+    """
+    rdf = etree.XML(raw_rels_ext)
+    output = {"content_models": [], "collections": [], "constituent_of": [],
+              "sequence": None}
+    for element in rdf.iter():
+        tag = element.tag
+        if tag == "{{{}}}hasModel".format(NS["fedora-model"]):
+            output["content_models"].append(__resource_pid__(element))
+        elif tag == "{{{}}}isMemberOfCollection".format(NS["fedora"]):
+            output["collections"].append(__resource_pid__(element))
+        elif tag == "{{{}}}isConstituentOf".format(NS["fedora"]):
+            output["constituent_of"].append(__resource_pid__(element))
+        elif tag.startswith("{{{}}}isSequenceNumber".format(NS["islandora"])):
+            output["sequence"] = __text__(element)
+    return output
+
+
+class Indexer(object):
+    """Class builds repository documents, fetching each object's profile,
+    MODS, RELS-EXT and datastream listing on a thread pool, and streams
+    them into Elasticsearch with parallel_bulk.
+
+    Args:
+        elastic -- Elasticsearch client, default is search.REPO_SEARCH
+        fedora -- FedoraClient, default is the client for CONF
+        tree -- Optional loaded RepositoryTree, without one ancestors are
+                resolved from RELS-EXT and cached
+        index -- Index name, default is repository
+
+    Settings read from CONF are INDEXER_WORKERS, INDEXER_CHUNK_SIZE,
+    INDEXER_BULK_THREADS, INDEXER_REPORT_EVERY, INDEXER_RAISE_ON_ERROR and
+    INDEXER_PROCESSES, the number of processes mapping MODS to fields,
+    default 0 maps in the calling thread.
+    """
+
+    def __init__(self, elastic=None, fedora=None, tree=None,
+                 index="repository", **kwargs):
+        self.elastic = elastic or REPO_SEARCH
+        self.fedora = fedora or get_client(CONF)
+        self.tree = tree
+        self.index = index
+        self.workers = kwargs.get(
+            "workers", getattr(CONF, "INDEXER_WORKERS", 8))
+        self.chunk_size = kwargs.get(
+            "chunk_size", getattr(CONF, "INDEXER_CHUNK_SIZE", 500))
+        self.bulk_threads = kwargs.get(
+            "bulk_threads", getattr(CONF, "INDEXER_BULK_THREADS", 4))
+        self.report_every = kwargs.get(
+            "report_every", getattr(CONF, "INDEXER_REPORT_EVERY", 30))
+        self.raise_on_error = kwargs.get(
+            "raise_on_error", getattr(CONF, "INDEXER_RAISE_ON_ERROR", False))
+        self.processes = kwargs.get(
+            "processes", getattr(CONF, "INDEXER_PROCESSES", 0))
+        self.parents = dict()
+        self.constituents = None
+        self.errors = []
+
+    def __rels_ext__(self, pid):
+        result = self.fedora.get_datastream(pid, "RELS-EXT")
+        if result.status_code > 399:
+            raise FedoraError(result.status_code, result.text)
+        return rels_ext_fields(result.content)
+
+    def __parent__(self, pid):
+        """Returns the first collection of pid, cached since the same
+        collections are looked up for every member"""
+        if pid not in self.parents:
+            collections = self.__rels_ext__(pid).get("collections")
+            self.parents[pid] = collections[0] if collections else None
+        return self.parents[pid]
+
+    def __ancestors__(self, pid, parent):
+        if self.tree is not None:
+            return self.tree.ancestors(pid)
+        output, seen = [], set([pid])
+        while parent is not None and parent not in seen:
+            output.insert(0, parent)
+            seen.add(parent)
+            parent = self.__parent__(parent)
+        return output
+
+    def __constituents__(self, pid):
+        if self.tree is not None:
+            if self.constituents is None:
+                constituents = dict()
+                for child, parents in self.tree.constituent_of.items():
+                    for parent in parents:
+                        constituents.setdefault(parent, []).append(child)
+                self.constituents = constituents
+            return self.constituents.get(pid, [])
+        return [row.get("s").split("/")[-1]
+                for row in self.fedora.ri_sparql(CONSTITUENTS_SPARQL.format(pid))]
+
+    def __compound_datastreams__(self, pid):
+        """Returns the OBJ datastream of each part of a compound object with
+        its sequence number as order"""
+        output = []
+        for i, child in enumerate(sorted(self.__constituents__(pid))):
+            rels = self.__rels_ext__(child)
+            for datastream in self.fedora.list_datastreams(child):
+                if datastream.get("dsid") != "OBJ":
+                    continue
+                output.append({"pid": child,
+                               "dsid": "OBJ",
+                               "label": datastream.get("label"),
+                               "mimeType": datastream.get("mimeType"),
+                               "order": rels.get("sequence") or str(i+1)})
+        return output
+
+    def build_document(self, pid):
+        """Method returns the index document for a pid or None if the object
+        no longer exists. The raw MODS is left under _mods for
+        transform.apply_mods so the CPU bound mapping can run in another
+        process.
+
+        Args:
+            pid -- PID of Fedora Object
+        """
+        profile = self.fedora.object_profile(pid)
+        if profile is None:
+            return
+        rels = self.__rels_ext__(pid)
+        doc = {"pid": pid,
+               "content_models": rels["content_models"],
+               "lastModifiedDate": profile.get("objLastModDate"),
+               "datastreams": [],
+               "_label": profile.get("objLabel")}
+        mods_result = self.fedora.get_datastream(pid, "MODS")
+        if mods_result.status_code < 400:
+            doc["_mods"] = mods_result.content
+        parents = rels["constituent_of"] or rels["collections"]
+        parent = parents[0] if parents else None
+        if parent is not None:
+            doc["parent"] = parent
+        if rels["collections"]:
+            self.parents.setdefault(pid, rels["collections"][0])
+        if rels["constituent_of"]:
+            doc["inCollections"] = self.__ancestors__(
+                parent, self.__parent__(parent)) + [parent]
+        else:
+            doc["inCollections"] = self.__ancestors__(pid, parent)
+        for datastream in self.fedora.list_datastreams(pid):
+            doc["datastreams"].append(
+                {"pid": pid,
+                 "dsid": datastream.get("dsid"),
+                 "label": datastream.get("label"),
+                 "mimeType": datastream.get("mimeType")})
+        if COMPOUND_MODEL in doc["content_models"]:
+            doc["datastreams"].extend(self.__compound_datastreams__(pid))
+        return doc
+
+    def generate_actions(self, pids):
+        """Generator yields bulk index actions for pids, building documents
+        concurrently on a bounded window of futures so memory stays flat
+        for any number of pids. Objects that fail are recorded in errors.
+
+        Args:
+            pids -- Iterable of PIDs
+        """
+        transform_pool = new_pool(self.processes) if self.processes else None
+        batch = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                window = deque()
+                for pid in pids:
+                    window.append((pid, pool.submit(self.build_document, pid)))
+                    if len(window) >= self.workers * 4:
+                        self.__collect__(batch, *window.popleft())
+                    if len(batch) >= self.chunk_size:
+                        for action in self.__actions__(batch, transform_pool):
+                            yield action
+                        batch = []
+                while len(window) > 0:
+                    self.__collect__(batch, *window.popleft())
+                for action in self.__actions__(batch, transform_pool):
+                    yield action
+        finally:
+            if transform_pool is not None:
+                transform_pool.shutdown()
+
+    def __actions__(self, batch, transform_pool):
+        for doc in transform_many(batch, transform_pool):
+            if "_error" in doc:
+                # Indexed with its label so the object is still findable
+                self.errors.append((doc["pid"], doc.pop("_error")))
+            yield {"_index": self.index, "_id": doc["pid"], "_source": doc}
+
+    def __collect__(self, batch, pid, future):
+        try:
+            doc = future.result()
+        except Exception as error:
+            self.errors.append((pid, repr(error)))
+            if self.raise_on_error:
+                raise IndexerError(
+                    "Failed to build {}".format(pid), repr(error))
+            return
+        if doc is not None:
+            batch.append(doc)
+
+    @contextlib.contextmanager
+    def refresh_disabled(self):
+        """Context manager turns off index refresh during a bulk load and
+        restores it, with one refresh, afterwards"""
+        settings = self.elastic.indices.get_settings(index=self.index)
+        interval = None
+        for name, body in settings.items():
+            interval = body["settings"]["index"].get("refresh_interval")
+        self.elastic.indices.put_settings(
+            index=self.index,
+            body={"index": {"refresh_interval": "-1"}})
+        try:
+            yield
+        finally:
+            self.elastic.indices.put_settings(
+                index=self.index,
+                body={"index": {"refresh_interval": interval}})
+            self.elastic.indices.refresh(index=self.index)
+
+    def index_pid(self, pid):
+        """Method builds and indexes a single pid, returns True if indexed"""
+        doc = self.build_document(pid)
+        if doc is None:
+            return False
+        apply_mods(doc)
+        doc.pop("_error", None)
+        self.elastic.index(index=self.index, id=pid, body=doc)
+        return True
+
+    def index_pids(self, pids, total=None):
+        """Method streams documents for pids into the index with
+        parallel_bulk while refresh is disabled, reporting docs/s every
+        report_every seconds, and returns a dict of counts
+
+        Args:
+            pids -- Iterable of PIDs
+            total -- Optional number of pids for progress reports
+        """
+        start = last_report = time.time()
+        indexed, failed = 0, 0
+        with self.refresh_disabled():
+            for ok, info in helpers.parallel_bulk(
+                self.elastic,
+                self.generate_actions(pids),
+                thread_count=self.bulk_threads,
+                chunk_size=self.chunk_size,
+                raise_on_error=self.raise_on_error):
+                if ok:
+                    indexed += 1
+                else:
+                    failed += 1
+                    self.errors.append(
+                        (info.get("index", {}).get("_id"), info))
+                if time.time() - last_report >= self.report_every:
+                    last_report = time.time()
+                    click.echo("{:,}{} indexed, {:.1f} docs/s, {:,} errors".format(
+                        indexed,
+                        "/{:,}".format(total) if total else "",
+                        indexed / (last_report - start),
+                        len(self.errors)))
+        seconds = max(time.time() - start, 0.001)
+        return {"indexed": indexed,
+                "failed": len(self.errors),
+                "seconds": seconds,
+                "docs_per_second": indexed / seconds}
+
+    def reindex(self, pid=None):
+        """Method indexes every object below pid, or the whole repository,
+        using a RepositoryTree loaded with a few paged queries
+
+        Args:
+            pid -- Optional collection PID
+        """
+        if self.tree is None:
+            self.tree = RepositoryTree(self.fedora).load()
+        if pid is not None:
+            pids = [pid] + list(self.tree.walk(pid))
+        else:
+            pids = sorted(pid for pid, models in self.tree.models.items()
+                          if not pid.startswith("fedora-system:") and
+                          len(models & SYSTEM_MODELS) < 1)
+        return self.index_pids(pids, total=len(pids))
+
+
+def __serving_settings__(elastic, index):
+    """Returns the replica count and refresh interval of the index the
+    alias points to, so a new generation is served the same way"""
+    defaults = {"number_of_replicas": getattr(CONF, "INDEX_REPLICAS", 1),
+                "refresh_interval": getattr(CONF, "INDEX_REFRESH", "1s")}
+    if index is None:
+        return defaults
+    settings = elastic.indices.get_settings(index=index)[index]["settings"]
+    for key in defaults:
+        value = settings["index"].get(key)
+        if value is not None and value != "-1":
+            defaults[key] = value
+    return defaults
+
+def create_generation(elastic=None, name=None):
+    """Function creates an empty repository-<timestamp> index with the live
+    index's mappings and bulk load settings, no replicas and no refresh
+
+    Args:
+        elastic -- Elasticsearch client, default is search.REPO_SEARCH
+        name -- Index name, default is repository-<UTC timestamp>
+    """
+    elastic = elastic or REPO_SEARCH
+    if name is None:
+        name = "{}-{}".format(
+            REPOSITORY_ALIAS,
+            datetime.datetime.utcnow().strftime(GENERATION_FORMAT))
+    body = {"settings": {"index": {"number_of_replicas": 0,
+                                   "refresh_interval": "-1"}}}
+    current = active_index(elastic)
+    if current is not None:
+        mappings = elastic.indices.get_mapping(index=current)[current]
+        body["mappings"] = mappings.get("mappings", {})
+    elastic.indices.create(index=name, body=body)
+    return name
+
+def warm_generation(elastic, index, settings):
+    """Function restores serving settings on a freshly loaded index, waits
+    for its replicas and runs the browse and facet queries once so the
+    first users after the swap don't pay for cold caches"""
+    elastic.indices.put_settings(index=index, body={"index": settings})
+    elastic.indices.refresh(index=index)
+    elastic.indices.forcemerge(index=index, max_num_segments=5)
+    elastic.cluster.health(
+        index=index,
+        wait_for_status="yellow",
+        wait_for_no_relocating_shards=True,
+        request_timeout=600)
+    if int(settings.get("number_of_replicas", 0)) > 0:
+        elastic.cluster.health(index=index,
+                               wait_for_status="green",
+                               request_timeout=600)
+    elastic.search(index=index, body=AGGS_DSL, request_cache=True)
+    elastic.search(index=index,
+                   body={"query": {"match_all": {}},
+                         "sort": ["titlePrincipal.keyword", "pid.keyword"],
+                         "size": 25})
+
+def swap_alias(elastic, index, keep=KEEP_GENERATIONS):
+    """Function atomically points the repository alias at index and deletes
+    all but the keep newest older generations. The first swap replaces a
+    concrete repository index in the same atomic action.
+
+    Args:
+        elastic -- Elasticsearch client
+        index -- New generation's index name
+        keep -- Number of previous generations kept for rollback
+    """
+    actions = []
+    if elastic.indices.exists_alias(name=REPOSITORY_ALIAS):
+        for name in elastic.indices.get_alias(name=REPOSITORY_ALIAS):
+            actions.append({"remove": {"index": name,
+                                       "alias": REPOSITORY_ALIAS}})
+    elif elastic.indices.exists(index=REPOSITORY_ALIAS):
+        actions.append({"remove_index": {"index": REPOSITORY_ALIAS}})
+    actions.append({"add": {"index": index, "alias": REPOSITORY_ALIAS}})
+    elastic.indices.update_aliases(body={"actions": actions})
+    older = [name for name in index_generations(elastic) if name != index]
+    for name in older[keep:]:
+        elastic.indices.delete(index=name)
+    # New generation invalidates cached facets and titles everywhere
+    bump_generation()
+
+def rollback(elastic=None):
+    """Function points the repository alias back at the previous generation
+    and returns its name, or None if there is nothing to roll back to"""
+    elastic = elastic or REPO_SEARCH
+    current = active_index(elastic)
+    older = [name for name in index_generations(elastic)
+             if name != current and (current is None or name < current)]
+    if len(older) < 1:
+        return
+    swap_alias(elastic, older[0], keep=len(older))
+    return older[0]
+
+def rebuild(indexer=None, keep=KEEP_GENERATIONS):
+    """Function builds a new index generation from the whole repository,
+    warms it and swaps the repository alias, users keep querying the old
+    generation until the swap. Returns the indexer's stats with the new
+    generation's name.
+
+    Args:
+        indexer -- Optional Indexer, its index is replaced by the new one
+        keep -- Number of previous generations kept for rollback
+    """
+    indexer = indexer or Indexer()
+    elastic = indexer.elastic
+    settings = __serving_settings__(elastic, active_index(elastic))
+    indexer.index = create_generation(elastic)
+    try:
+        stats = indexer.reindex()
+        if indexer.raise_on_error and stats["failed"] > 0:
+            raise IndexerError(
+                "rebuild() errors",
+                "{:,} objects failed".format(stats["failed"]))
+        warm_generation(elastic, indexer.index, settings)
+    except Exception:
+        elastic.indices.delete(index=indexer.index, ignore=[404])
+        raise
+    swap_alias(elastic, indexer.index, keep)
+    stats["index"] = indexer.index
+    return stats
+
+
+def __indexer__(workers, chunk_size):
+    kwargs = dict()
+    if workers:
+        kwargs["workers"] = workers
+    if chunk_size:
+        kwargs["chunk_size"] = chunk_size
+    return Indexer(**kwargs)
+
+def __report__(indexer, stats):
+    click.echo("Indexed {:,} in {:.1f} seconds, {:.1f} docs/s, {:,} errors".format(
+        stats["indexed"],
+        stats["seconds"],
+        stats["docs_per_second"],
+        stats["failed"]))
+    for error_pid, error in indexer.errors[:25]:
+        click.echo("{} {}".format(error_pid, error), err=True)
+
+@click.group()
+def main():
+    pass
+
+@main.command()
+@click.option("--pid", default=None, help="Collection PID, default is all")
+@click.option("--workers", default=None, type=int)
+@click.option("--chunk_size", default=None, type=int)
+def update(pid=None, workers=None, chunk_size=None):
+    """Reindexes objects in place in the live index"""
+    indexer = __indexer__(workers, chunk_size)
+    __report__(indexer, indexer.reindex(pid))
+
+@main.command()
+@click.option("--keep", default=KEEP_GENERATIONS,
+    help="Previous generations kept for rollback")
+@click.option("--workers", default=None, type=int)
+@click.option("--chunk_size", default=None, type=int)
+def full(keep, workers=None, chunk_size=None):
+    """Builds a new index generation and swaps the repository alias"""
+    indexer = __indexer__(workers, chunk_size)
+    stats = rebuild(indexer, keep)
+    __report__(indexer, stats)
+    click.echo("{} now serves {}".format(stats["index"], REPOSITORY_ALIAS))
+
+@main.command(name="rollback")
+def rollback_command():
+    """Points the repository alias at the previous generation"""
+    previous = rollback()
+    if previous is None:
+        click.echo("No previous generation to roll back to", err=True)
+        return
+    click.echo("{} now serves {}".format(previous, REPOSITORY_ALIAS))
+
+
+if __name__ == "__main__":
+    main()
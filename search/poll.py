@@ -1,43 +1,205 @@
 #!/usr/bin/env python3
-"""Module polls repository and indexes any new Fedora objects"""
+"""Module polls repository and indexes any new or modified Fedora objects"""
 __author__ = "Jeremy Nelson"
 
 import datetime
-import requests
-from . import CONF, REPO_SEARCH
+
+import click
+from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError
+from fedora import FedoraError, get_client
+from . import CONF, META_INDEX, REPO_SEARCH, bump_generation,\
+    invalidate_titles, warm_facets
 from .indexer import Indexer, IndexerError
 
-# SPARQL Constants
-NEWEST_100_SPARQL = """SELECT DISTINCT ?s ?date
-WHERE { ?s <fedora-model:createdDate> ?date . }
-ORDER BY DESC(?date)
-LIMIT 100"""
+# Fedora objects and datastreams both have a lastModifiedDate in the
+# Resource Index, hasModel FedoraObject-3.0 limits rows to objects
+CHANGED_SPARQL = """SELECT ?s ?date
+WHERE {{
+  ?s <fedora-model:hasModel> <info:fedora/fedora-system:FedoraObject-3.0> .
+  ?s <fedora-view:lastModifiedDate> ?date .
+  FILTER (?date >= "{since}"^^<http://www.w3.org/2001/XMLSchema#dateTime>)
+}}
+ORDER BY ?date ?s
+LIMIT {limit}"""
+
+# High-water mark document in META_INDEX
+WATERMARK_ID = "poll-watermark"
+EPOCH = "1970-01-01T00:00:00Z"
+PAGE_SIZE = getattr(CONF, "POLL_PAGE_SIZE", 1000)
+# Reindexed pids are appended here for aristotle/prerender.py update
+PRERENDER_QUEUE = getattr(CONF, "PRERENDER_QUEUE", None)
 
 # Functions
+def parse_timestamp(value):
+    """Function returns a datetime for an ISO 8601 UTC timestamp. Fedora
+    trims trailing zeros from the fractional seconds, so 12:00:56Z and
+    12:00:56.5Z don't sort in time order as strings.
+
+    Args:
+        value -- Timestamp such as 2017-05-01T12:00:56.5Z
+    """
+    value = value.rstrip("Z")
+    if "." in value:
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+def newest_indexed():
+    """Function returns the newest lastModifiedDate in the repository
+    index, or None if the index is empty"""
+    result = REPO_SEARCH.search(
+        body={"query": {"exists": {"field": "lastModifiedDate"}},
+              "_source": ["lastModifiedDate"],
+              "sort": [{"lastModifiedDate": {"order": "desc",
+                                             "unmapped_type": "date"}}],
+              "size": 1},
+        index='repository')
+    hits = result['hits']['hits']
+    if len(hits) < 1:
+        return
+    return hits[0]['_source'].get('lastModifiedDate')
+
+def get_watermark():
+    """Function returns the lastModifiedDate of the newest object indexed
+    by the last successful poll. Before the first poll the watermark is
+    seeded from the newest object already in the index, which assumes the
+    index was built by a full indexing run. Only with an empty index does
+    the first poll start from the epoch and index the whole repository."""
+    try:
+        doc = REPO_SEARCH.get_source(index=META_INDEX, id=WATERMARK_ID)
+    except NotFoundError:
+        return newest_indexed() or EPOCH
+    return doc.get("value", EPOCH)
+
+def set_watermark(value):
+    REPO_SEARCH.index(
+        index=META_INDEX,
+        id=WATERMARK_ID,
+        body={"value": value,
+              "updated": datetime.datetime.utcnow().isoformat()},
+        refresh=True)
+
+def changed_since(since, page_size=PAGE_SIZE):
+    """Generator yields batches of (pid, lastModifiedDate) for every object
+    modified at or after since, one Resource Index query per batch. Each
+    query starts at the last date the previous one returned instead of
+    using an OFFSET, so an object modified during the poll moves to a
+    later page without shifting unread rows out of the next one. Rows at
+    that boundary date come back again and are skipped, the limit grows
+    by their number so every page has room for page_size new rows. The
+    boundary is inclusive so objects sharing the watermark's timestamp
+    are never missed, check_stale filters out the ones already indexed.
+
+    Args:
+        since -- ISO 8601 UTC timestamp
+        page_size -- New rows per query
+    """
+    fedora = get_client(CONF)
+    boundary = set()
+    while True:
+        limit = page_size + len(boundary)
+        try:
+            rows = fedora.ri_sparql(
+                CHANGED_SPARQL.format(
+                    since=since,
+                    limit=limit))
+        except FedoraError as error:
+            raise IndexerError(
+                "changed_since() HTTP error {}".format(error.status_code),
+                "Could not get modified PIDS from repository\n{}".format(
+                    error.message))
+        batch, keys = [], []
+        for row in rows:
+            pid = row.get('s').split("/")[-1]
+            key = (pid, parse_timestamp(row.get('date')))
+            keys.append(key)
+            if key in boundary or pid.startswith("fedora-system:"):
+                continue
+            batch.append((pid, row.get('date')))
+        if len(batch) > 0:
+            yield batch
+        if len(rows) < limit:
+            break
+        since = rows[-1].get('date')
+        last = keys[-1][1]
+        boundary = set(key for key in boundary.union(keys)
+                       if key[1] == last)
+
+def check_stale(batch):
+    """Function returns the pids in a batch that are missing from the index
+    or whose indexed lastModifiedDate is older than Fedora's, with one
+    terms query for the whole batch
+
+    Args:
+        batch -- List of (pid, lastModifiedDate)
+    """
+    pids = [pid for pid, modified in batch]
+    result = REPO_SEARCH.search(
+        body={"query": {"terms": {"pid.keyword": pids}},
+              "_source": ["pid", "lastModifiedDate"],
+              "size": len(pids)},
+        index='repository')
+    indexed = dict()
+    for hit in result['hits']['hits']:
+        source = hit['_source']
+        indexed[source.get('pid')] = source.get('lastModifiedDate')
+    stale = []
+    for pid, modified in batch:
+        if pid not in indexed or \
+           indexed[pid] is None or \
+           parse_timestamp(indexed[pid]) < parse_timestamp(modified):
+            stale.append(pid)
+    return stale
+
 def check_index_new():
-    """Function retrieves the newest 100 PIDS from Fedora, checks index
-	for existence, and indexes PID if not found."""
-    result = requests.post(
-        CONF.get('RI_URL'),
-        data={"type": "tuples",
-              "lang": "sparql",
-              "format": "json",
-              "query": NEWEST_100_SPARQL},
-        auth=CONF.get('FEDORA_AUTH'))
-	if result.status_code > 399:
-        raise IndexerError(
-            "check_index_new() HTTP error {}".format(result.status_code),
-            "Could not newest PIDS from repository\n{}".format(result.text))
+    """Function retrieves every PID modified since the stored watermark,
+    checks the index in batches, and bulk indexes new or changed objects.
+    The watermark only advances when every document indexed cleanly."""
+    since = get_watermark()
+    high_water = since
     indexer = Indexer()
-    for row in result.json().get('results'):
-        pid = row.get('s').split("/")[-1]
-        dsl = {
-            "query": {
-                "term": {"pid": pid}
-            }
-        }
-        exists_result = REPO_SEARCH.search(body=dsl, index='repository')
-        if exists_result['hits']['count'] > 0:
+    indexed, failed = [], 0
+    for batch in changed_since(since):
+        if parse_timestamp(batch[-1][1]) > parse_timestamp(high_water):
+            high_water = batch[-1][1]
+        stale = check_stale(batch)
+        if len(stale) < 1:
             continue
-	    # Now run indexer
-        indexer.index_pid(pid)
+        success, errors = helpers.bulk(
+            REPO_SEARCH,
+            indexer.generate_actions(stale),
+            raise_on_error=False)
+        failed += len(errors)
+        indexed.extend(stale)
+    if len(indexed) > 0:
+        invalidate_titles(indexed)
+        # New generation invalidates cached facets and titles in every
+        # worker, then recompute the top collections' facets
+        bump_generation()
+        warm_facets()
+        if PRERENDER_QUEUE is not None:
+            with open(PRERENDER_QUEUE, "a") as fo:
+                for pid in indexed:
+                    fo.write("{}\n".format(pid))
+    if failed > 0:
+        raise IndexerError(
+            "check_index_new() bulk errors",
+            "{} of {} documents failed, watermark kept at {}".format(
+                failed,
+                len(indexed),
+                since))
+    if high_water != since:
+        set_watermark(high_water)
+    return indexed
+
+
+@click.command()
+def main():
+    """Indexes objects modified since the last poll, run from cron as
+    python3 -m search.poll"""
+    indexed = check_index_new()
+    click.echo("Indexed {:,} objects".format(len(indexed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""Module maps MODS XML to repository index fields with a declarative field
+map compiled once into lxml XPath extractors, and fans batches of records
+out across a process pool"""
+__author__ = "Jeremy Nelson"
+
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+
+NS = {"mods": "http://www.loc.gov/mods/v3"}
+YEAR_RE = re.compile(r"\d{4}")
+# Name roles copied to their own fields, others are contributors
+NAME_ROLES = {"creator": "creator",
+              "author": "creator",
+              "thesis advisor": "thesisAdvisor",
+              "sponsor": "sponsor",
+              "degree grantor": "degreeGrantor"}
+
+# Field map, (field, MODS XPath, kind) where kind is
+#   text -- First non-empty value, omitted if missing
+#   list -- All distinct values, always present
+#   list? -- All distinct values, omitted if empty
+#   join -- All distinct values joined with ", ", omitted if empty
+# Dotted fields are nested, subject.topic is doc["subject"]["topic"]
+FIELD_MAP = [
+    ("abstract", "mods:abstract", "list"),
+    ("genre", "mods:genre", "list"),
+    ("language", "mods:language/mods:languageTerm[@type='text']", "list"),
+    ("note", "mods:note[not(@type='admin') and not(@type='thesis')]", "list?"),
+    ("adminNote", "mods:note[@type='admin']", "list?"),
+    ("thesis", "mods:note[@type='thesis']", "list?"),
+    ("subject.topic", "mods:subject/mods:topic", "list?"),
+    ("subject.geographic", "mods:subject/mods:geographic", "list?"),
+    ("subject.temporal", "mods:subject/mods:temporal", "list?"),
+    ("subject.name", "mods:subject/mods:name/mods:namePart", "list?"),
+    ("dateCreated", "mods:originInfo[1]/mods:dateCreated[1]", "text"),
+    ("dateIssued", "mods:originInfo[1]/mods:dateIssued[1]", "text"),
+    ("publisher", "mods:originInfo[1]/mods:publisher[1]", "text"),
+    ("place", "mods:originInfo[1]/mods:place/mods:placeTerm", "join"),
+    ("typeOfResource", "mods:typeOfResource[1]", "text"),
+    ("extent", "mods:physicalDescription[1]/mods:extent[1]", "text"),
+    ("digitalOrigin",
+     "mods:physicalDescription[1]/mods:digitalOrigin[1]", "text"),
+    ("useAndReproduction",
+     "mods:accessCondition[@type='useAndReproduction'][1]", "text"),
+    ("degreeName", "mods:extension//mods:degreeName", "list?"),
+    ("degreeType", "mods:extension//mods:degreeType", "list?"),
+]
+# Used when no languageTerm has type="text"
+LANGUAGE_FALLBACK = "mods:language/mods:languageTerm"
+TITLE_PATH = "mods:titleInfo[not(@type='alternative') and " \
+             "not(@type='abbreviated')][mods:title]"
+NAME_PATH = "mods:name"
+
+
+def __xpath__(path):
+    return etree.XPath(path, namespaces=NS, smart_strings=False)
+
+def __normalize__(element):
+    text = element.text
+    if text is None:
+        return
+    text = " ".join(text.split())
+    if len(text) > 0:
+        return text
+
+def __values__(extractor, node):
+    output = []
+    for element in extractor(node):
+        text = __normalize__(element)
+        if text is not None and text not in output:
+            output.append(text)
+    return output
+
+
+class ModsTransform(object):
+    """Class compiles a field map into XPath extractors once and reuses
+    a single parser for every record it transforms
+
+    Args:
+        field_map -- List of (field, xpath, kind), default is FIELD_MAP
+    """
+
+    def __init__(self, field_map=FIELD_MAP):
+        self.parser = etree.XMLParser(
+            remove_blank_text=True,
+            resolve_entities=False,
+            no_network=True)
+        self.extractors = [(field.split("."), __xpath__(path), kind)
+                           for field, path, kind in field_map]
+        self.language_fallback = __xpath__(LANGUAGE_FALLBACK)
+        self.title_info = __xpath__(TITLE_PATH)
+        self.title_parts = [__xpath__("mods:nonSort[1]"),
+                            __xpath__("mods:title[1]"),
+                            __xpath__("mods:subTitle[1]")]
+        self.names = __xpath__(NAME_PATH)
+        self.name_parts = __xpath__("mods:namePart")
+        self.role_terms = __xpath__("mods:role/mods:roleTerm")
+
+    def __title__(self, mods):
+        for title_info in self.title_info(mods):
+            non_sort, title, sub_title = [
+                next(iter([__normalize__(element)
+                           for element in extractor(title_info)]), None)
+                for extractor in self.title_parts]
+            if title is None:
+                continue
+            if non_sort:
+                title = "{} {}".format(non_sort, title)
+            if sub_title:
+                title = "{}: {}".format(title, sub_title)
+            return title
+
+    def __names__(self, mods, doc):
+        for name in self.names(mods):
+            name_part = ", ".join(__values__(self.name_parts, name))
+            if len(name_part) < 1:
+                continue
+            field = "contributor"
+            for role in __values__(self.role_terms, name):
+                if role.lower() in NAME_ROLES:
+                    field = NAME_ROLES[role.lower()]
+                    break
+            values = doc.setdefault(field, [])
+            if name_part not in values:
+                values.append(name_part)
+
+    def __call__(self, raw_mods):
+        """Returns the index fields for a MODS document
+
+        Args:
+            raw_mods -- MODS XML as bytes or str
+        """
+        if isinstance(raw_mods, str):
+            raw_mods = raw_mods.encode("utf-8")
+        mods = etree.fromstring(raw_mods, self.parser)
+        doc = {"titlePrincipal": self.__title__(mods), "subject": {}}
+        for path, extractor, kind in self.extractors:
+            values = __values__(extractor, mods)
+            if kind == "text":
+                if len(values) < 1:
+                    continue
+                value = values[0]
+            elif kind == "join":
+                if len(values) < 1:
+                    continue
+                value = ", ".join(values)
+            else:
+                if kind == "list?" and len(values) < 1:
+                    continue
+                value = values
+            target = doc
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+        if len(doc["language"]) < 1:
+            doc["language"] = __values__(self.language_fallback, mods)
+        self.__names__(mods, doc)
+        year = YEAR_RE.search(doc.get("dateIssued", doc.get("dateCreated", "")))
+        if year is not None:
+            doc["publicationYear"] = year.group(0)
+        return doc
+
+
+# One compiled transform per thread, lxml parsers can't be shared
+__local__ = threading.local()
+
+def mods_document(raw_mods):
+    """Function returns the index fields for a MODS document using this
+    thread's compiled ModsTransform
+
+    Args:
+        raw_mods -- MODS XML as bytes or str
+    """
+    transform = getattr(__local__, "transform", None)
+    if transform is None:
+        transform = __local__.transform = ModsTransform()
+    return transform(raw_mods)
+
+def apply_mods(doc):
+    """Function merges a document's raw MODS, held under _mods by the
+    indexer, into the document. Falls back to the object label, held
+    under _label, for the title. Invalid MODS is reported under _error."""
+    raw_mods = doc.pop("_mods", None)
+    label = doc.pop("_label", None)
+    if raw_mods is not None:
+        try:
+            doc.update(mods_document(raw_mods))
+        except etree.XMLSyntaxError as error:
+            doc["_error"] = "Invalid MODS {}".format(error)
+    if not doc.get("titlePrincipal"):
+        doc["titlePrincipal"] = label
+    return doc
+
+def transform_many(docs, pool=None, chunksize=32):
+    """Function applies apply_mods to a batch of documents, across a
+    ProcessPoolExecutor when one is given, and returns the list
+
+    Args:
+        docs -- List of document dicts with _mods and _label
+        pool -- Optional ProcessPoolExecutor
+        chunksize -- Documents sent to a worker process at a time
+    """
+    if pool is None:
+        return [apply_mods(doc) for doc in docs]
+    return list(pool.map(apply_mods, docs, chunksize=chunksize))
+
+def new_pool(processes=None):
+    """Function returns a ProcessPoolExecutor for transform_many"""
+    return ProcessPoolExecutor(max_workers=processes)